@@ -1,5 +1,4 @@
 import socket
-import time
 from PyQt6.QtWidgets import *
 from PyQt6.QtGui import QIcon, QFont, QStandardItem, QStandardItemModel
 from PyQt6.QtCore import Qt, pyqtSignal, QModelIndex, QTimer
@@ -9,7 +8,7 @@ import sys
 import psutil
 import stun
 from widgets.add_file_dialog import *
-from src import TorrentClient
+from src import TorrentClient, Session
 import threading
 from qt_material import apply_stylesheet
 
@@ -54,6 +53,8 @@ class MainWindow(QMainWindow):
         self.tabWidget.currentChanged.connect(self.on_tab_changed)
 
         self.current_tab_idx = 0
+        # Every torrent runs on this session, behind a single listening port
+        self.session = Session(**self.get_ip_and_port())
 
         self.timer = QTimer(self)
         self.timer.timeout.connect(self.display_client_UI)
@@ -68,16 +69,12 @@ class MainWindow(QMainWindow):
         dialog = dialog_class()
 
         if dialog.exec() == QDialog.DialogCode.Accepted:
-            threading.Thread(target=self.init_client, daemon=True, kwargs=(
-                {**self.get_ip_and_port(), **dialog.get_result()})).start()
+            threading.Thread(target=self.init_client, daemon=True, kwargs=dialog.get_result()).start()
 
     def init_client(self, **kwargs):
-        client = TorrentClient(**kwargs)
+        client = self.session.add_torrent(**kwargs)
         TORRENT_CLIENT_LIST.append(client)
 
-        while True:
-            time.sleep(1000)
-
     def create_torrent(self):
         self.start_torrent_client(CreateTorrentDialog)
 
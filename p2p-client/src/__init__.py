@@ -1 +1,3 @@
 from .client import TorrentClient
+from .session import Session
+from .rate_limiter import set_global_rate_limits
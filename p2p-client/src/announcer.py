@@ -0,0 +1,103 @@
+import threading
+import time
+
+from .utils import TorrentUtils, ANNOUNCE_INTERVAL, ANNOUNCE_MIN_INTERVAL, ANNOUNCE_RETRY_MIN, ANNOUNCE_RETRY_MAX
+
+
+class Announcer:
+    """Keeps a torrent announced to its tracker.
+
+    The first announce carries the started event, the first one after the download completed the completed
+    event, and stop sends stopped. In between the torrent announces again every interval given by the
+    tracker, and earlier while it has no peer to download from, though never before the tracker's min
+    interval. Announces run on the session's announce pool, so a slow tracker does not hold up the timer,
+    and the peers they return go to the connection manager, which ignores the ones it already knows.
+    A failed announce is retried after a delay that doubles with every failure in a row.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.event = 'started'              # Event of the next announce, cleared once the tracker has it
+        self.started = False                # The tracker got the started event
+        self.interval = ANNOUNCE_INTERVAL
+        self.min_interval = ANNOUNCE_MIN_INTERVAL
+        self.tracker_id = None
+        self.last_announce = None
+        self.next_announce = 0
+        self.failures = 0
+        self.announcing = False
+        self.lock = threading.Lock()
+
+    def on_timer(self):
+        """Called every second by the session's timer, starts the next announce once it is due."""
+        if self.is_due(time.monotonic()):
+            self.client.session.announce_executor.submit(self.announce)
+
+    def is_due(self, now) -> bool:
+        if self.announcing or not self.client.running:
+            return False
+        if now >= self.next_announce:
+            return True
+        if self.failures:
+            return False
+        # Events go out right away, and a torrent without peers asks for more as soon as the tracker allows
+        return self.event == 'completed' or (self.client.downloading and not self.client.peer_connections
+                                             and now - self.last_announce >= self.min_interval)
+
+    def announce(self):
+        """Send the next announce and hand the peers it returns to the connection manager."""
+        with self.lock:
+            if self.announcing:
+                return
+            self.announcing = True
+            event = self.event
+        try:
+            response = self.client.send_tracker_request(event, self.tracker_id)
+            if b'failure reason' in response:
+                raise ValueError(response[b'failure reason'].decode(errors='replace'))
+            peer_list, peer6_list = TorrentUtils.parse_compacted_peer_list(response.get(b'peers', b''),
+                                                                           response.get(b'peers6', b''))
+        except Exception as e:
+            self.failures += 1
+            delay = min(ANNOUNCE_RETRY_MIN * 2 ** (self.failures - 1), ANNOUNCE_RETRY_MAX)
+            self.next_announce = time.monotonic() + delay
+            self.client.log(f"Announce to the tracker failed: {e}. Retrying in {delay} s\n")
+        else:
+            self.announced(event, response)
+            self.client.add_peers(peer_list, peer6_list)
+            self.client.log(f"Announced to the tracker ({event or 'update'}): {len(peer_list) + len(peer6_list)} "
+                            f"peers, next announce in {self.interval} s\n")
+        finally:
+            self.announcing = False
+
+    def announced(self, event, response: dict):
+        now = time.monotonic()
+        with self.lock:
+            if self.event == event:         # Unless the download completed meanwhile
+                self.event = None
+            self.started = True
+        self.failures = 0
+        self.last_announce = now
+        self.interval = response.get(b'interval', self.interval)
+        self.min_interval = response.get(b'min interval', min(ANNOUNCE_MIN_INTERVAL, self.interval))
+        self.tracker_id = response.get(b'tracker id', self.tracker_id)
+        self.next_announce = now + self.interval
+
+    def completed(self):
+        """Send the completed event with the next announce, right away."""
+        with self.lock:
+            if self.started:
+                self.event = 'completed'
+
+    def stop(self):
+        """Tell the tracker the torrent leaves the swarm, waiting for its answer."""
+        with self.lock:
+            started = self.started
+            self.started = False
+            self.event = None
+        if not started:
+            return
+        try:
+            self.client.send_tracker_request('stopped', self.tracker_id)
+        except Exception as e:
+            self.client.log(f"Error sending the stopped event to the tracker: {e}\n")
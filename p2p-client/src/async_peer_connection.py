@@ -0,0 +1,182 @@
+import asyncio
+import threading
+
+from .peer_connection import PeerConnection
+from .piece_manager import PieceManager
+from .utils import TorrentUtils
+
+EVENT_LOOP_LOCK = threading.Lock()
+EVENT_LOOP: asyncio.AbstractEventLoop | None = None
+EVENT_LOOP_THREAD: threading.Thread | None = None
+
+
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    """Return the event loop shared by the asyncio engine of every torrent, starting its thread on first use."""
+    global EVENT_LOOP, EVENT_LOOP_THREAD
+    with EVENT_LOOP_LOCK:
+        if EVENT_LOOP is None:
+            EVENT_LOOP = asyncio.new_event_loop()
+            EVENT_LOOP_THREAD = threading.Thread(target=EVENT_LOOP.run_forever, name='peer-event-loop', daemon=True)
+            EVENT_LOOP_THREAD.start()
+    return EVENT_LOOP
+
+
+def run_in_event_loop(coroutine):
+    """Schedule a coroutine on the shared event loop from any thread and return its concurrent future."""
+    return asyncio.run_coroutine_threadsafe(coroutine, get_event_loop())
+
+
+class AsyncPeerConnection(PeerConnection, asyncio.BufferedProtocol):
+    """Peer connection driven by the shared event loop instead of an in and an out thread.
+
+    It is the protocol of its transport: the loop receives straight into the message framer's buffers
+    and the messages are handled by the same handlers as the threaded engine, on the loop thread.
+    Messages queued from other threads (the download engine, HAVE broadcasts) are written by the loop.
+    handshake_done resolves once the handshake is exchanged, or fails with the reason it was not.
+    """
+
+    def __init__(self, info_hash, my_id, target_peer: dict | None, piece_manager: PieceManager, outgoing, client):
+        self.loop = get_event_loop()
+        self.transport: asyncio.Transport | None = None
+        self.handshake_done = self.loop.create_future()
+        self.writing_paused = False
+        self.reading_throttled = False      # Reading or uploading is paused by the rate limits
+        self.upload_throttled = False
+        # Incoming connections learn the peer's address in connection_made
+        target_peer = target_peer or {'id': None, 'ip': None, 'port': None}
+        super().__init__(info_hash, my_id, None, target_peer, piece_manager, outgoing, client)
+
+    def init_connection(self, info_hash, my_id, outgoing):
+        # The handshake is exchanged once the transport is connected
+        self.info_hash = info_hash
+        self.my_id = my_id
+
+    # ---------------- Protocol callbacks ----------------
+
+    def connection_made(self, transport):
+        self.transport = transport
+        if self.outgoing:
+            self.transport.write(self.get_handshake_message(self.info_hash, self.my_id))
+            return
+
+        self.ip, self.port = transport.get_extra_info('peername')[:2]
+        self.id = TorrentUtils.generate_peer_id(self.ip, self.port)
+        self.client.log(f"New connection from {self.ip} : {self.port}\n")
+        # Registered first, so an INTERESTED message right after the handshake finds the peer
+        self.piece_manager.add_peer(self.id)
+
+    def get_buffer(self, sizehint):
+        return self.framer.get_buffer()
+
+    def buffer_updated(self, nbytes):
+        self.framer.buffer_updated(nbytes)
+        self.throttle_reading(self.download_limiter.consume(nbytes))
+        try:
+            if not self.handshake_done.done() and not self.receive_handshake():
+                return
+            for message, block in self.framer.messages():
+                self.handle_message(message, block)
+        except ValueError as e:
+            print(f"Error receiving message: {e}")
+            if not self.handshake_done.done():
+                self.handshake_done.set_exception(e)
+            self.transport.close()
+
+    def feed(self, data):
+        """Process bytes received before the connection took over its transport."""
+        view = memoryview(data)
+        while view and not self.transport.is_closing():
+            buffer = self.get_buffer(-1)
+            nbytes = min(len(buffer), len(view))
+            buffer[:nbytes] = view[:nbytes]
+            self.buffer_updated(nbytes)
+            view = view[nbytes:]
+
+    def connection_lost(self, exc):
+        self.queue_running = False
+        if not self.handshake_done.done():
+            self.handshake_done.set_exception(exc or ConnectionError("Connection closed during the handshake."))
+        self.client.remove_connection(self)
+
+    def pause_writing(self):
+        # Stop reading from a peer that does not keep up with the blocks sent to it. Its requests wait
+        # in upload_requests until the buffer drains, where a CANCEL can still drop them
+        self.writing_paused = True
+        self.transport.pause_reading()
+
+    def resume_writing(self):
+        self.writing_paused = False
+        if not self.reading_throttled:
+            self.transport.resume_reading()
+        self.send_upload_requests()
+
+    # -------------------------------------------------
+
+    def receive_handshake(self) -> bool:
+        """Validate the peer's handshake once it is complete and answer it. Return True when done."""
+        handshake = self.framer.read_handshake()
+        if handshake is None:
+            return False
+        self.extension_supported, self.peer_id = TorrentUtils.validate_handshake(handshake, self.info_hash)
+
+        if not self.outgoing:
+            # Send the handshake message. Both outgoing and incoming connections send the same message
+            self.transport.write(self.get_handshake_message(self.info_hash, self.my_id))
+        self.handshake_exchanged()
+        self.handshake_done.set_result(True)
+        return True
+
+    def throttle_reading(self, delay):
+        """Stop reading for delay seconds, the time the rate limits need to let the received bytes through."""
+        if delay and not self.reading_throttled:
+            self.reading_throttled = True
+            self.transport.pause_reading()
+            self.loop.call_later(delay, self.end_reading_throttle)
+
+    def end_reading_throttle(self):
+        self.reading_throttled = False
+        if not self.writing_paused and not self.transport.is_closing():
+            self.transport.resume_reading()
+
+    def end_upload_throttle(self):
+        self.upload_throttled = False
+        self.send_upload_requests()
+
+    def schedule_upload(self, request):
+        self.send_upload_requests()
+
+    def send_upload_requests(self):
+        """Answer the queued block requests while the transport accepts more data and the rate limits allow."""
+        try:
+            while self.upload_requests and not self.writing_paused and not self.upload_throttled \
+                    and self.queue_running:
+                request = next(iter(self.upload_requests))
+                header = self.get_piece_header(request)
+                if header is None:
+                    continue
+                index, begin, length = request
+                # Transports have no sendfile for single writes, the block goes out with the header in one
+                # vectored write straight from the file's memory map
+                self.write_message(header, self.piece_manager.get_block(index, begin, length, self.id))
+                delay = self.upload_limiter.consume(len(header) + length)
+                if delay:
+                    self.upload_throttled = True
+                    self.loop.call_later(delay, self.end_upload_throttle)
+        except Exception as e:
+            # Also called from loop callbacks, where an exception would leave the connection open
+            print(f"Error sending message: {e}")
+            self.transport.close()
+
+    def enqueue_send_message(self, message):
+        if threading.current_thread() is EVENT_LOOP_THREAD:
+            self.write_message(message)
+        else:
+            self.loop.call_soon_threadsafe(self.write_message, message)
+
+    def close(self):
+        if self.transport is not None:
+            self.loop.call_soon_threadsafe(self.transport.close)
+
+    def write_message(self, *buffers):
+        if self.queue_running and not self.transport.is_closing():
+            self.transport.writelines(buffers)
@@ -0,0 +1,109 @@
+import random
+import threading
+import time
+
+from .piece_manager import PieceManager
+from .utils import NUM_UNCHOKED, RECHOKE_INTERVAL, OPTIMISTIC_UNCHOKE_ROUNDS
+
+
+class Choker:
+    """Decides which interested peers the client uploads to (tit-for-tat).
+
+    Every rechoke round the regular upload slots go to the interested peers with the best rolling rate:
+    the rate they send to us while downloading, or the rate we send to them while seeding, so the slots go
+    to the peers that give us the best throughput back, or take the data fastest. One more slot, the
+    optimistic unchoke, goes to a random choked peer and moves every few rounds, so that peers that were
+    never unchoked get a chance to show their rate. Only changes of state are sent as CHOKE and UNCHOKE.
+    """
+
+    def __init__(self, client, piece_manager: PieceManager, num_unchoked=NUM_UNCHOKED,
+                 rechoke_interval=RECHOKE_INTERVAL, optimistic_rounds=OPTIMISTIC_UNCHOKE_ROUNDS):
+        self.client = client
+        self.piece_manager = piece_manager
+        self.num_unchoked = num_unchoked
+        self.rechoke_interval = rechoke_interval
+        self.optimistic_rounds = optimistic_rounds
+
+        self.interested_peers = set()
+        self.unchoked_peers = set()         # Peers we upload to, the optimistic unchoke included
+        self.optimistic_peer = None
+        self.rounds = 0
+        self.last_rechoke = time.monotonic()
+
+        self.lock = threading.Lock()
+
+    def on_timer(self):
+        """Called every second by the session's timer, runs a rechoke round every rechoke_interval."""
+        now = time.monotonic()
+        if now - self.last_rechoke >= self.rechoke_interval:
+            self.last_rechoke = now
+            self.rechoke()
+
+    def peer_interested(self, connection):
+        """Unchoke a newly interested peer right away if an upload slot is free, otherwise it waits for a round.
+        The connection is given, as an incoming one may not be registered in peer_connections yet.
+        """
+        id = connection.id
+        with self.lock:
+            self.interested_peers.add(id)
+            if id not in self.unchoked_peers and len(self.unchoked_peers) < self.num_unchoked + 1:
+                self.unchoked_peers.add(id)
+                connection.send_unchoke_message()
+
+    def peer_not_interested(self, connection):
+        id = connection.id
+        with self.lock:
+            self.interested_peers.discard(id)
+            if id in self.unchoked_peers:
+                self.unchoked_peers.discard(id)
+                connection.send_choke_message()
+            if self.optimistic_peer == id:
+                self.optimistic_peer = None
+
+    def remove_peer(self, id):
+        with self.lock:
+            self.interested_peers.discard(id)
+            self.unchoked_peers.discard(id)
+            if self.optimistic_peer == id:
+                self.optimistic_peer = None
+
+    def get_rate(self, id) -> float:
+        if self.piece_manager.is_seeding():
+            rate = self.piece_manager.get_upload_rate(id)
+        else:
+            rate = self.piece_manager.get_download_rate(id)
+        return rate or 0
+
+    def rechoke(self):
+        """Reassign the upload slots and send the peers whose state changed a CHOKE or UNCHOKE message."""
+        with self.lock:
+            self.rounds += 1
+            candidates = [id for id in self.interested_peers if id in self.client.peer_connections]
+            # Shuffled first, so peers with the same rate are ranked at random
+            random.shuffle(candidates)
+            candidates.sort(key=self.get_rate, reverse=True)
+            unchoked = set(candidates[:self.num_unchoked])
+
+            choked = [id for id in candidates if id not in unchoked]
+            if self.optimistic_peer not in choked or self.rounds % self.optimistic_rounds == 0:
+                others = [id for id in choked if id != self.optimistic_peer]
+                self.optimistic_peer = random.choice(others) if others else self.optimistic_peer
+            if self.optimistic_peer in choked:
+                unchoked.add(self.optimistic_peer)
+            else:
+                self.optimistic_peer = None
+
+            for id in unchoked - self.unchoked_peers:
+                connection = self.client.peer_connections.get(id)
+                if connection is not None:
+                    connection.send_unchoke_message()
+            for id in self.unchoked_peers - unchoked:
+                connection = self.client.peer_connections.get(id)
+                if connection is not None:
+                    connection.send_choke_message()
+            changed = unchoked != self.unchoked_peers
+            self.unchoked_peers = unchoked
+
+        if changed:
+            self.client.log(f'\nRechoke round {self.rounds} {'-' * 10}\n\nUnchoked peers: {self.client.get_peers(
+                unchoked)}\nOptimistic Unchoked Peer: {self.client.get_peers([self.optimistic_peer])}\n{'-' * 61}\n\n')
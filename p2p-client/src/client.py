@@ -1,21 +1,34 @@
+import asyncio
 import json
+import os
 from queue import Queue
 import socket
 import time
 import bencodepy
-import requests
 import threading
-from .utils import TorrentUtils, MagnetUtils, INIT_STRING
+from .utils import TorrentUtils, MagnetUtils, PeerEngine, INIT_STRING, PIPELINE_DEPTH, PEER_ENGINE, RESUME_DIR, \
+    RESUME_SAVE_INTERVAL, MAX_TORRENT_CONNECTIONS, CONNECT_TIMEOUT, TRACKER_TIMEOUT, \
+    ANNOUNCE_NUMWANT
 from .piece_manager import DownloadingFSM, PieceManager
 from .peer_connection import PeerConnection
+from .async_peer_connection import AsyncPeerConnection, run_in_event_loop
+from .session import Session
+from .download_engine import DownloadEngine
+from .choker import Choker
+from .connection_manager import ConnectionManager
+from .announcer import Announcer
+from .resume import ResumeData
+from .rate_limiter import TokenBucket
 
 LOCK = threading.Lock()
-REQ_LOCK = threading.Lock()
 
 class TorrentClient:
 
     def __init__(self, ip, port, torrent_file=None, magnet_link=None,
-                 download_dir=None, uploader_info: dict = None, cli=False):
+                 download_dir=None, uploader_info: dict = None, cli=False, pipeline_depth=PIPELINE_DEPTH,
+                 resume_dir=RESUME_DIR, engine=PEER_ENGINE, scheduler=None, upload_limit=None, download_limit=None,
+                 peer_upload_limit=None, peer_download_limit=None, session: Session = None,
+                 max_connections=MAX_TORRENT_CONNECTIONS):
         self.running = True
         self.ip = ip
         self.port = port
@@ -30,6 +43,17 @@ class TorrentClient:
         self.send_to_console = INIT_STRING
         self.full_string_log = INIT_STRING
         self.init_done = False
+        self.uploader_info = uploader_info
+        self.resume_dir = resume_dir
+        self.resume_data = None
+        self.cached_peers = []
+        self.recheck_pieces = False         # Pieces loaded from a stale resume file are hashed again
+        self.engine = PeerEngine(engine)
+        # Rate limits (bytes per second, None for unlimited) of the torrent and of each of its peers
+        self.upload_bucket = TokenBucket(upload_limit)
+        self.download_bucket = TokenBucket(download_limit)
+        self.peer_upload_limit = peer_upload_limit
+        self.peer_download_limit = peer_download_limit
         # ---------------- Process inputs -----------------
 
         if magnet_link:
@@ -43,32 +67,43 @@ class TorrentClient:
             self.init_uploader(params)
 
         # ----------------- Server socket -----------------
+        # A client created on its own listens on its own port, through a session of its own
+        self.session = session or Session(self.ip, self.port, engine=self.engine)
         self.log(f"Client listening on {self.ip}:{self.port} ...\n\n")
-        threading.Thread(target=self.listen_for_connections_ipv4, daemon=True).start()
-        threading.Thread(target=self.listen_for_connections_ipv6, daemon=True).start()
-
-        # -------------------------------------------------
-        # --------------- Start connections ---------------
-        self.peer_list, self.peer6_list, self.interval = self.send_tracker_request()
-
-        threading.Thread(target=self.send_tracker_request_periodic, daemon=True).start()
 
         # -------------------------------------------------
         # ---------------- Start Torrenting ---------------
+        # Peers cached by fast-resume are connected right away, tracker peers are added once it answers
+        self.peer_list = [peer for peer in self.cached_peers if ':' not in peer['ip']]
+        self.peer6_list = [peer for peer in self.cached_peers if ':' in peer['ip']]
         self.peer_connections: dict[str, PeerConnection] = dict()
-        self.piece_manager = PieceManager(peer_list=self.peer_list,
-                                          metadata=self.metadata, pieces=self.pieces, client=self)
+        self.piece_manager = PieceManager(peer_list=self.peer_list + self.peer6_list,
+                                          metadata=self.metadata, pieces=self.pieces, client=self,
+                                          storage_dir=self.storage_dir, recheck_pieces=self.recheck_pieces)
+        self.download_engine = DownloadEngine(self, self.piece_manager, pipeline_depth=pipeline_depth,
+                                              scheduler=scheduler)
+        self.choker = Choker(self, self.piece_manager)
+        self.connection_manager = ConnectionManager(self, self.session.connection_limits, max_connections)
+        self.announcer = Announcer(self)
+        self.session.register_torrent(self)
 
         if cli:
             threading.Thread(target=self.periodic_update_console, daemon=True).start()
 
         self.connected_to_peers = False
         self.init_connections()
+
+        # --------------- Start connections ---------------
+        # The first announce is sent right away, the session's timer sends the next ones
+        self.announcer.announce()
+
+        if self.resume_data is not None:
+            threading.Thread(target=self.periodic_save_resume_data, daemon=True).start()
         self.init_done = True
 
 
         if not uploader_info:
-            while not self.connected_to_peers:
+            while not self.connected_to_peers and not self.piece_manager.is_download_complete():
                 time.sleep(0.2)
             threading.Thread(target=self.start_downloading, daemon=True).start()
         else:
@@ -83,129 +118,184 @@ class TorrentClient:
 
     def init_downloader(self, params):
         self.info_hash, self.tracker_url, self.display_name, self.metadata = params
-        self.pieces = dict()
+        self.pieces = set()
+        self.storage_dir = None
         self.log(f"Downloading Torrent '{self.display_name}'  ...\n")
 
+        if self.resume_dir is None:
+            return
+        self.resume_data = ResumeData(self.resume_dir, self.info_hash)
+        resume_state = self.resume_data.load()
+        if resume_state is not None:
+            self.metadata = resume_state['metadata']
+            self.pieces = resume_state['pieces']
+            self.storage_dir = resume_state['storage_dir']
+            self.recheck_pieces = resume_state['recheck']
+            self.cached_peers = [{'id': TorrentUtils.generate_peer_id(peer['ip'], peer['port']), **peer}
+                                 for peer in resume_state['peers']]
+            self.log(f"Resuming with {len(self.pieces)}/{len(self.metadata['pieces']) // 20} pieces "
+                     f"and {len(self.cached_peers)} cached peers"
+                     f"{', checking the pieces as the files changed' if self.recheck_pieces else ''}\n")
+
     def init_uploader(self, params):
-        self.info_hash, self.tracker_url, self.display_name, self.metadata, pieces_dict = params
+        self.info_hash, self.tracker_url, self.display_name, self.metadata = params
 
         self.downloading = False
         self.left = 0
         self.downloaded = sum([file['length'] for file in self.metadata['files']])
         self.uploaded = 0
 
-        self.pieces = pieces_dict
+        # Seeded pieces are read back from the shared files themselves
+        upload_dir = self.uploader_info['upload_dir']
+        self.storage_dir = upload_dir if os.path.isdir(upload_dir) else os.path.dirname(upload_dir)
+        self.pieces = set(range(len(self.metadata['pieces']) // 20))
         self.log(f"Seeding Torrent '{self.display_name}'  ...\n")
 
     # -------------------------------------------------
     # ----------------- Server socket -----------------
 
-    def listen_for_connections_ipv4(self):
-        """Listens for incoming IPv4 connections and handles them.
-        """
-        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        server_socket.bind(('', self.port))
-        server_socket.listen()
-
-        while True:
-            try:
-                conn, addr = server_socket.accept()
-                ip, port = addr
-                threading.Thread(target=self.handle_peer_connection, args=(conn, ip, port), daemon=True).start()
-            except Exception as e:
-                self.log(f"Error accepting IPv4 connection: {e}\n")
-
-    def listen_for_connections_ipv6(self):
-        """Listens for incoming IPv6 connections and handles them.
+    def handle_peer_connection(self, conn, ip, port, handshake: bytes = None):
+        """Handle communication with a newly connected peer. The session passes the handshake it routed the
+        connection by, and the connection slot it took for it.
         """
-        server_socket = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
-        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        server_socket.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)
-        server_socket.bind(('', self.port))
-        server_socket.listen()
-
-        while True:
-            try:
-                conn, addr = server_socket.accept()
-                ip, port, _, _ = addr
-                threading.Thread(target=self.handle_peer_connection, args=(conn, ip, port), daemon=True).start()
-            except Exception as e:
-                self.log(f"Error accepting IPv6 connection: {e}\n")
-
-    def handle_peer_connection(self, conn, ip, port):
-        """Handle communication with a newly connected peer."""
         target_peer = {
             'id': TorrentUtils.generate_peer_id(ip, port),
             'ip': ip,
             'port': port
         }
         addr = f"{ip} : {port}"
+        if not self.connection_manager.can_accept():
+            conn.close()
+            self.session.connection_limits.connection_closed()
+            return
         self.log(f"New connection from {addr}\n")
         try:
-            connection = PeerConnection(self.info_hash, self.peer_id, conn,
-                                        target_peer, self.piece_manager, outgoing=False, client=self)
-            self.peer_connections[target_peer['id']] = connection
+            # Registered first, so an INTERESTED message right after the handshake finds the peer
             self.piece_manager.add_peer(target_peer['id'])
-            self.log(f"Successfully add connection to peer {target_peer['ip']}, {target_peer['port']}\n")
+            connection = PeerConnection(self.info_hash, self.peer_id, conn,
+                                        target_peer, self.piece_manager, outgoing=False, client=self,
+                                        handshake=handshake)
         except Exception as e:
+            conn.close()
+            self.session.connection_limits.connection_closed()
+            self.piece_manager.remove_peer(target_peer['id'])
             self.log(f"Error handling connection from {addr}: {e}\n")
+            return
+        if self.connection_manager.connection_established(connection):
+            self.log(f"Successfully add connection to peer {target_peer['ip']}, {target_peer['port']}\n")
+
+    def accept_async_peer_connection(self) -> AsyncPeerConnection:
+        """Create the connection an incoming transport is handed to, once the session routed it here."""
+        connection = AsyncPeerConnection(self.info_hash, self.peer_id, None, self.piece_manager,
+                                         outgoing=False, client=self)
+        asyncio.get_running_loop().create_task(self.handle_async_peer_connection(connection))
+        return connection
+
+    async def handle_async_peer_connection(self, connection: AsyncPeerConnection):
+        """Add a newly connected peer once its handshake is exchanged."""
+        try:
+            await asyncio.wait_for(asyncio.shield(connection.handshake_done), CONNECT_TIMEOUT)
+        except Exception as e:
+            connection.close()
+            self.log(f"Error handling connection from {connection.ip} : {connection.port}: {e}\n")
+            return
+        if self.connection_manager.connection_established(connection):
+            self.log(f"Successfully add connection to peer {connection.ip}, {connection.port}\n")
 
     # -------------------- Connect --------------------
     # -------------------------------------------------
 
+    def add_peers(self, peer_list, peer6_list):
+        """Add peers returned by the tracker, the connection manager connects to those that are not known yet."""
+        known_peers = {peer['id'] for peer in self.peer_list + self.peer6_list}
+        for peers, known_list, family in ((peer_list, self.peer_list, socket.AF_INET),
+                                          (peer6_list, self.peer6_list, socket.AF_INET6)):
+            for target_peer in peers:
+                if target_peer['id'] in known_peers:
+                    continue
+                known_list.append(target_peer)
+                self.connection_manager.add_peer(target_peer, family)
+
     def init_connections(self):
-        """Initiate connections to all peers in the peer list."""
+        """Hand the peers in the peer list to the connection manager."""
         for target_peer in self.peer_list:
-            threading.Thread(target=self.connect_to_peer, args=(target_peer, socket.AF_INET)).start()
+            self.connection_manager.add_peer(target_peer, socket.AF_INET)
         for target_peer in self.peer6_list:
-            threading.Thread(target=self.connect_to_peer, args=(target_peer, socket.AF_INET6)).start()
+            self.connection_manager.add_peer(target_peer, socket.AF_INET6)
+
+    def start_connection(self, target_peer: dict, family):
+        """Connect to a peer in the background, on the session's connect pool or on the event loop. Called by the
+        connection manager, which bounds the attempts in progress.
+        """
+        if self.engine == PeerEngine.ASYNCIO:
+            run_in_event_loop(self.async_connect_to_peer(target_peer, family))
+        else:
+            self.session.connect_executor.submit(self.connect_to_peer, target_peer, family)
 
     def connect_to_peer(self, target_peer: dict, family):
         self.log(f"Connecting to peer {target_peer['ip']}, {target_peer['port']}\n")
         sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.settimeout(CONNECT_TIMEOUT)
         addr = (target_peer['ip'], target_peer['port'])
         try:
             sock.connect(addr)
             connection = PeerConnection(self.info_hash, self.peer_id, sock,
                                         target_peer, self.piece_manager, outgoing=True, client=self)
-            self.peer_connections[target_peer['id']] = connection
+        except Exception as e:
+            sock.close()
+            self.connection_manager.connect_failed(target_peer['id'], e)
+            return
+        if self.connection_manager.connection_established(connection):
             self.log(f"Successfully connect to peer {addr}\n")
             self.connected_to_peers = True
+
+    async def async_connect_to_peer(self, target_peer: dict, family):
+        self.log(f"Connecting to peer {target_peer['ip']}, {target_peer['port']}\n")
+        addr = (target_peer['ip'], target_peer['port'])
+        connection = AsyncPeerConnection(self.info_hash, self.peer_id, target_peer, self.piece_manager,
+                                         outgoing=True, client=self)
+        try:
+            await asyncio.wait_for(asyncio.get_running_loop().create_connection(lambda: connection, *addr,
+                                                                                family=family), CONNECT_TIMEOUT)
+            await asyncio.wait_for(asyncio.shield(connection.handshake_done), CONNECT_TIMEOUT)
         except Exception as e:
-            self.log(f"Failed to connect to peer {addr}: {e}\n")
+            self.connection_manager.connect_failed(target_peer['id'], e, connection)
+            connection.close()
+            return
+        if self.connection_manager.connection_established(connection):
+            self.log(f"Successfully connect to peer {addr}\n")
+            self.connected_to_peers = True
+
+    def remove_connection(self, connection: PeerConnection):
+        """Called by a connection once it is closed."""
+        self.connection_manager.connection_closed(connection)
 
-    def remove_connection(self, id):
-        # self.peer_connections.pop(id)
-        # self.piece_manager.remove_peer(id)
-        pass
     # -------------------------------------------------
     # -------------------------------------------------
 
-    def send_tracker_request(self):
-        # Send a request to the tracker, initialize peer_list and interval
+    def send_tracker_request(self, event=None, tracker_id=None) -> dict:
+        """Announce the torrent to the tracker, over UDP for a udp:// tracker and otherwise over the session's
+        keep-alive HTTP connections, and return the decoded response.
+        """
         params = {
             'ip': self.ip,
             'port': self.port,
             'info_hash': self.info_hash,
             'peer_id': self.peer_id,
-            'uploaded': self.uploaded,
-            'downloaded': self.downloaded,
-            'left': self.left,
+            'uploaded': self.piece_manager.uploaded,
+            'downloaded': self.piece_manager.downloaded,
+            # Unknown until the metadata of a magnet link is in
+            'left': self.piece_manager.left if self.piece_manager.number_of_pieces is not None else None,
             'compact': 1,
-            'event': self.status
+            'event': event,
+            'numwant': ANNOUNCE_NUMWANT if event != 'stopped' else 0,
+            'trackerid': tracker_id,
         }
-        response = requests.get(self.tracker_url, params=params).content
-        response = bencodepy.decode(response)
-        peers = response[b'peers']
-        peers6 = response[b'peers6']
-        interval = response[b'interval']
-        peer_list, peer6_list = TorrentUtils.parse_compacted_peer_list(peers, peers6)
-        return peer_list, peer6_list, interval
-
-    def send_tracker_request_periodic(self):
-        # Send a request to the tracker, initialize peer_list and interval
-        pass
+        if self.tracker_url.startswith('udp://'):
+            return self.session.udp_tracker.announce(self.tracker_url, params)
+        response = self.session.http_session.get(self.tracker_url, params=params, timeout=TRACKER_TIMEOUT)
+        response.raise_for_status()
+        return bencodepy.decode(response.content)
 
     # ------------------ UI handling ------------------
     # -------------------------------------------------
@@ -235,8 +325,8 @@ class TorrentClient:
 
     def get_peers(self, id_list=None) -> list[tuple[str, int]]:
         if id_list is not None:
-            return [(c.ip, c.port) for c in self.peer_connections.values() if c.id in id_list]
-        return [(c.ip, c.port) for c in self.peer_connections.values()]
+            return [(c.ip, c.port) for c in list(self.peer_connections.values()) if c.id in id_list]
+        return [(c.ip, c.port) for c in list(self.peer_connections.values())]
 
     def get_self_torrent_info(self):
         seeds = len(self.piece_manager.not_interest_peers)
@@ -253,8 +343,26 @@ class TorrentClient:
             'left': self.piece_manager.left,
             'seeds': seeds,
             'peers': peers,
+            'uplimit': self.upload_bucket.rate,
+            'downlimit': self.download_bucket.rate,
+            # Seconds the torrent's transfers were held back by a rate limit, summed over its connections
+            'upthrottled': round(self.upload_bucket.throttled_time, 1),
+            'downthrottled': round(self.download_bucket.throttled_time, 1),
         }
 
+    def set_rate_limits(self, upload=None, download=None):
+        """Cap the upload and download rates (bytes per second) of the torrent. None means unlimited."""
+        self.upload_bucket.set_rate(upload)
+        self.download_bucket.set_rate(download)
+
+    def set_peer_rate_limits(self, upload=None, download=None):
+        """Cap the upload and download rates (bytes per second) of each peer of the torrent."""
+        self.peer_upload_limit = upload
+        self.peer_download_limit = download
+        for connection in list(self.peer_connections.values()):
+            connection.upload_bucket.set_rate(upload)
+            connection.download_bucket.set_rate(download)
+
     def pause(self):
         self.prev_status = self.status
         self.status = 'paused'
@@ -263,6 +371,15 @@ class TorrentClient:
     def resume(self):
         self.status = self.prev_status
 
+    def stop(self):
+        """Leave the swarm: stop routing and opening connections, send the stopped event and close the peers."""
+        self.running = False
+        self.session.remove_torrent(self.info_hash)
+        self.announcer.stop()
+        for connection in list(self.peer_connections.values()):
+            connection.close()
+        self.save_resume_data()
+
     # -------------------------------------------------
     # -------------------------------------------------
 
@@ -279,76 +396,47 @@ class TorrentClient:
             self.piece_manager.state = DownloadingFSM.PIECE_FIND
             self.log("\nMetadata downloaded!\n\n")
 
-        while True:
-            # (1) Initiate a new piece (if begin or no piece is being downloaded or no unchoked peer)
-            if self.piece_manager.state == DownloadingFSM.PIECE_FIND:
-                piece_idx, peers = self.piece_manager.find_next_rarest_piece()
-                if piece_idx is None:       # All pieces downloaded
-                    self.piece_manager.state = DownloadingFSM.SEEDING
-                    continue
-                elif piece_idx == -1:       # No pieces available
-                    self.log("\nNo pieces available...\n")
-                    time.sleep(0.2)
-                    continue
-
-                for id in peers:
-                    self.peer_connections[id].send_interest_message()
-
-                unchoked_peers = self.piece_manager.get_unchoked_peers()
-                get_unchoked_timeout = 0
-                while not unchoked_peers:
-                    self.log("Trying to get unchoked peers...\n")
-                    time.sleep(0.2)
-                    unchoked_peers = self.piece_manager.get_unchoked_peers()
-                    get_unchoked_timeout += 0.2
-                    if get_unchoked_timeout > 2:
-                        break
-                if get_unchoked_timeout > 2:
-                    continue
+        completed_here = not self.piece_manager.is_download_complete()
+        self.download_engine.run()
 
-                # Divide piece into blocks and request from peers
-                self.piece_manager.state = DownloadingFSM.PIECE_REQ
-                block_requests = TorrentUtils.divide_piece_into_blocks(
-                    piece_idx, self.piece_manager.piece_size, self.piece_manager.block_size)
-                self.piece_manager.add_block_request(piece_idx, block_requests)
-                self.log(f"\nREQUESTING PIECE {piece_idx} ...\n\n")
-                # Distribute blocks among unchoked peers
-
-                with REQ_LOCK:
-                    for i, args in enumerate(block_requests):
-                        peer = unchoked_peers[i % len(unchoked_peers)]
-                        self.peer_connections[peer].send_request_message(*args)
-                        ip, port = self.peer_connections[peer].ip, self.peer_connections[peer].port
-                        self.log(f"Requesting block {args} to peer {ip}, {port} ...\n")
-
-            # (2) Waitng for piece response
-            elif self.piece_manager.state == DownloadingFSM.PIECE_REQ:
-                if self.piece_manager.is_gathered_all_blocks():
-                    self.piece_manager.merge_blocks_to_piece()
-                    self.piece_manager.state = DownloadingFSM.PIECE_FIND
-
-                    piece = self.piece_manager.requesting_piece
-                    self.log(f'\n\nPIECE {piece} DOWNLOADED!\nSending "Have" message to all peers...\n\n')
-                    for connection in self.peer_connections.values():
-                        connection.send_have_message(piece)
-                else:
-                    time.sleep(0.2)
-
-            elif self.piece_manager.state == DownloadingFSM.SEEDING:
-                self.log(f'\n\n{'-'*40}\nDOWNLOAD COMPLETED!\nSTART SEEDING\n{"-"*40}\n')
-                self.piece_manager.state = DownloadingFSM.SEEDING
-                self.status = 'completed'
-                self.downloading = False
-                self.piece_manager.merge_all_pieces(self.download_dir)
-                self.start_uploading_only()
-                return
+        self.log(f'\n\n{'-'*40}\nDOWNLOAD COMPLETED!\nSTART SEEDING\n{"-"*40}\n')
+        self.piece_manager.state = DownloadingFSM.SEEDING
+        self.status = 'completed'
+        self.downloading = False
+        self.piece_manager.storage.flush()
+        self.save_resume_data()
+        if completed_here:
+            self.announcer.completed()
+        self.start_uploading_only()
 
 
     def start_uploading_only(self):
         """Start seeding the torrent."""
-        for connection in self.peer_connections.values():
+        for connection in list(self.peer_connections.values()):
             connection.seeding()
 
+    # -------------------------------------------------
+    # ------------------ Fast resume ------------------
+
+    def save_resume_data(self):
+        if self.resume_data is None or self.piece_manager.storage is None:
+            return
+        peers = [{'ip': c.ip, 'port': c.port} for c in list(self.peer_connections.values()) if c.outgoing]
+        try:
+            self.resume_data.save(self.piece_manager.metadata, set(self.piece_manager.pieces),
+                                  self.piece_manager.storage_dir, peers)
+        except OSError as e:
+            self.log(f"Error saving resume data: {e}\n")
+
+    def periodic_save_resume_data(self):
+        """Rewrite the resume file whenever pieces were completed since the last save."""
+        saved_pieces = len(self.pieces)
+        while self.downloading:
+            time.sleep(RESUME_SAVE_INTERVAL)
+            if self.piece_manager.storage is not None and len(self.piece_manager.pieces) != saved_pieces:
+                saved_pieces = len(self.piece_manager.pieces)
+                self.save_resume_data()
+
     def periodic_update_console(self):
         while True:
             print(self.get_console_output(), end="")
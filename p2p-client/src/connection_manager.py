@@ -0,0 +1,245 @@
+import heapq
+import threading
+import time
+
+from .utils import MAX_CONNECTIONS, MAX_HALF_OPEN, MAX_TORRENT_CONNECTIONS, RECONNECT_BACKOFF_MIN, \
+    RECONNECT_BACKOFF_MAX
+
+
+class ConnectionLimits:
+    """Connection counts of a session, shared by its torrents so sockets and threads stay bounded however many
+    torrents and peers there are. Outgoing attempts are half-open until their handshake is exchanged, incoming
+    connections hold a connection slot from the moment they are accepted.
+    """
+
+    def __init__(self, max_connections=MAX_CONNECTIONS, max_half_open=MAX_HALF_OPEN):
+        self.max_connections = max_connections
+        self.max_half_open = max_half_open
+        self.connections = 0
+        self.half_open = 0
+        self.lock = threading.Lock()
+
+    def start_connect(self) -> bool:
+        """Take a half-open slot for an outgoing attempt. Return False if none is free."""
+        with self.lock:
+            if self.half_open >= self.max_half_open or self.connections + self.half_open >= self.max_connections:
+                return False
+            self.half_open += 1
+            return True
+
+    def connect_done(self, connected):
+        """Release the half-open slot of an attempt, which holds a connection slot from now on if it succeeded."""
+        with self.lock:
+            self.half_open -= 1
+            if connected:
+                self.connections += 1
+
+    def try_accept(self) -> bool:
+        """Take a connection slot for an incoming connection. Return False if the session is full."""
+        with self.lock:
+            if self.connections + self.half_open >= self.max_connections:
+                return False
+            self.connections += 1
+            return True
+
+    def connection_closed(self):
+        with self.lock:
+            self.connections -= 1
+
+
+class PeerEntry:
+    """A peer learned from the tracker or the resume data, and how its connection attempts went."""
+
+    def __init__(self, peer: dict, family):
+        self.peer = peer
+        self.id = peer['id']
+        self.family = family
+        self.connection = None          # Connection registered for the peer, if any
+        self.failures = 0               # Failed attempts and disconnections in a row
+        self.retry_time = 0
+        self.banned = False             # The peer is ourselves
+
+
+class ConnectionManager:
+    """Opens and closes the peer connections of a torrent.
+
+    Known peers are connected while the torrent and its session are below their connection limits, at most
+    max_half_open attempts at a time across the session. A peer whose attempt fails or whose connection
+    closes is connected again after a delay that doubles with every failure in a row.
+
+    Connections are registered in the client once their handshake is exchanged, one per peer_id: when a
+    peer is connected twice, inbound and outbound, both sides keep the connection opened by the side with
+    the lower peer_id. A closed connection is forgotten by the download engine, the choker and the piece
+    manager, and the requests it held go back to the other peers.
+    """
+
+    def __init__(self, client, limits: ConnectionLimits, max_connections=MAX_TORRENT_CONNECTIONS):
+        self.client = client
+        self.limits = limits
+        self.max_connections = max_connections
+        self.my_peer_id = client.peer_id.encode('utf-8').hex()     # As peer_ids are read from handshakes
+
+        self.peers: dict[str, PeerEntry] = dict()
+        self.retry_queue: list[tuple[float, str]] = []          # Heap of (retry_time, id) of the idle peers
+        self.connecting = set()                                 # Ids with an outgoing attempt in progress
+        self.connections = set()                                # Registered connections
+        self.peer_id_connections = dict()                       # Registered connection of each peer_id
+        self.lock = threading.RLock()
+
+    def add_peer(self, peer: dict, family):
+        """Connect to a peer as soon as the limits allow. Peers that are already known are ignored."""
+        with self.lock:
+            if peer['id'] in self.peers:
+                return
+            entry = self.peers[peer['id']] = PeerEntry(peer, family)
+            self.schedule(entry, time.monotonic())
+        self.connect_more()
+
+    def schedule(self, entry: PeerEntry, retry_time):
+        entry.retry_time = retry_time
+        heapq.heappush(self.retry_queue, (retry_time, entry.id))
+
+    def schedule_retry(self, entry: PeerEntry):
+        entry.failures += 1
+        delay = min(RECONNECT_BACKOFF_MIN * 2 ** (entry.failures - 1), RECONNECT_BACKOFF_MAX)
+        self.schedule(entry, time.monotonic() + delay)
+
+    def can_accept(self) -> bool:
+        """Whether the torrent takes one more incoming connection."""
+        with self.lock:
+            return len(self.connecting) + len(self.connections) < self.max_connections
+
+    def on_timer(self):
+        """Called every second by the session's timer, starts the attempts whose retry time has come."""
+        self.connect_more()
+
+    def connect_more(self):
+        """Start connecting to the peers that are due, while the torrent and the session have free slots."""
+        if not self.client.running:
+            return
+        entries = []
+        with self.lock:
+            now = time.monotonic()
+            while self.retry_queue and self.retry_queue[0][0] <= now:
+                if len(self.connecting) + len(self.connections) >= self.max_connections:
+                    break
+                retry_time, id = self.retry_queue[0]
+                entry = self.peers[id]
+                if entry.retry_time != retry_time or entry.connection is not None or id in self.connecting \
+                        or entry.banned:
+                    heapq.heappop(self.retry_queue)     # Superseded by a later retry
+                    continue
+                if not self.limits.start_connect():
+                    break
+                heapq.heappop(self.retry_queue)
+                self.connecting.add(id)
+                entries.append(entry)
+
+        for entry in entries:
+            self.client.piece_manager.add_known_peer(entry.id)
+            self.client.start_connection(entry.peer, entry.family)
+
+    # ------------------ Connection events ------------------
+
+    def connect_failed(self, id, error, connection=None):
+        """An outgoing attempt failed before its handshake was exchanged. The attempt's connection, if it
+        was created, is forgotten here, so closing it does not schedule a second retry.
+        """
+        with self.lock:
+            if connection is not None:
+                connection.closed = True
+            self.connecting.discard(id)
+            self.limits.connect_done(False)
+            entry = self.peers[id]
+            self.schedule_retry(entry)
+            registered = id in self.client.peer_connections
+        self.client.log(f"Failed to connect to peer {entry.peer['ip']}, {entry.peer['port']}: {error}. "
+                        f"Retrying in {entry.retry_time - time.monotonic():.0f} s\n")
+        if not registered:
+            self.forget_peer(id)
+        self.connect_more()
+
+    def connection_established(self, connection) -> bool:
+        """Register a connection whose handshake is exchanged. Return False if it is closed instead,
+        because it duplicates another connection to the same peer or leads back to ourselves.
+        """
+        dropped = None
+        with self.lock:
+            closed = connection.closed
+            if connection.outgoing:
+                self.connecting.discard(connection.id)
+                self.limits.connect_done(not closed)
+                connection.holds_slot = not closed
+            entry = self.peers.get(connection.id) if connection.outgoing else None
+            if closed:
+                # Closed while the handshake was exchanged, connection_closed left the retry to us
+                if entry is not None:
+                    self.schedule_retry(entry)
+            elif connection.peer_id == self.my_peer_id:
+                if entry is not None:
+                    entry.banned = True
+                dropped = connection
+            else:
+                other = self.peer_id_connections.get(connection.peer_id)
+                if other is None or self.get_initiator(connection) < self.get_initiator(other):
+                    self.register(connection, entry)
+                if other is not None:
+                    dropped = other if self.peer_id_connections[connection.peer_id] is connection else connection
+
+        if closed:
+            if connection.outgoing:
+                self.forget_peer(connection.id)
+            return False
+        if dropped is not None:
+            reason = "to ourselves" if dropped.peer_id == self.my_peer_id else "duplicate"
+            self.client.log(f"Closing {reason} connection to peer {dropped.ip}, {dropped.port}\n")
+            dropped.close()
+        return dropped is not connection
+
+    def register(self, connection, entry: PeerEntry | None):
+        connection.connected_time = time.monotonic()
+        self.connections.add(connection)
+        self.peer_id_connections[connection.peer_id] = connection
+        self.client.peer_connections[connection.id] = connection
+        if entry is not None:
+            entry.connection = connection
+
+    def get_initiator(self, connection) -> str:
+        """peer_id of the side that opened a connection, the same on both ends of it."""
+        return self.my_peer_id if connection.outgoing else connection.peer_id
+
+    def connection_closed(self, connection):
+        """Forget a closed connection and, if it was opened by us, connect to the peer again later."""
+        with self.lock:
+            if connection.closed:
+                return
+            connection.closed = True
+            id = connection.id
+            self.connections.discard(connection)
+            if self.client.peer_connections.get(id) is connection:
+                del self.client.peer_connections[id]
+            if self.peer_id_connections.get(connection.peer_id) is connection:
+                del self.peer_id_connections[connection.peer_id]
+            if connection.holds_slot:
+                self.limits.connection_closed()
+
+            entry = self.peers.get(id) if connection.outgoing else None
+            if entry is not None and not entry.banned and id not in self.connecting \
+                    and entry.connection in (None, connection):
+                entry.connection = None
+                # A connection that stayed up longer than the delay it would get does not count as a failure
+                if connection.connected_time is not None and time.monotonic() - connection.connected_time > \
+                        min(RECONNECT_BACKOFF_MIN * 2 ** entry.failures, RECONNECT_BACKOFF_MAX):
+                    entry.failures = 0
+                self.schedule_retry(entry)
+            replaced = id in self.client.peer_connections or id in self.connecting
+
+        if not replaced:
+            self.forget_peer(id)
+        self.connect_more()
+
+    def forget_peer(self, id):
+        """Drop what the torrent knows about a peer that is no longer connected."""
+        self.client.download_engine.peer_disconnected(id)
+        self.client.choker.remove_peer(id)
+        self.client.piece_manager.remove_peer(id)
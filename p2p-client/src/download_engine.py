@@ -0,0 +1,280 @@
+import threading
+import time
+from collections import Counter
+
+from .piece_manager import BlockState, DownloadingFSM, PieceManager
+from .scheduler import BlockScheduler, RateWeightedScheduler
+from .utils import PIPELINE_DEPTH, MAX_ACTIVE_PIECES, REQUEST_TIMEOUT_MIN, REQUEST_TIMEOUT_MAX, \
+    REQUEST_TIMEOUT_FACTOR, SNUB_TIMEOUTS
+
+
+class DownloadEngine:
+    """Pipelined piece downloader.
+
+    Several pieces are kept in flight at once and every unchoked peer holds a queue of outstanding block
+    requests, which is refilled as soon as blocks arrive. The scheduler decides the depth of each queue and
+    which peers are served first, by default in proportion to the peers' measured download rates.
+
+    Once every remaining block has been requested the engine enters endgame: idle peers are also sent
+    the blocks outstanding at other peers, and the other copies are cancelled when the first one arrives.
+
+    Requests that a peer leaves unanswered for longer than its timeout, derived from its measured block
+    latency, or that are dropped because it chokes us, are released and requested again from other peers.
+    A peer that keeps timing out is snubbed and only gets one request at a time until it delivers again.
+    """
+
+    def __init__(self, client, piece_manager: PieceManager,
+                 pipeline_depth=PIPELINE_DEPTH, max_active_pieces=MAX_ACTIVE_PIECES, scheduler: BlockScheduler = None):
+        self.client = client
+        self.piece_manager = piece_manager
+        self.scheduler = scheduler or RateWeightedScheduler(initial_depth=pipeline_depth)
+        self.max_active_pieces = max_active_pieces
+
+        self.peer_requests: dict[str, dict[tuple[int, int, int], float]] = dict()  # Send time of outstanding requests
+        self.request_peers: dict[tuple[int, int, int], set[str]] = dict()   # Peers each request was sent to
+        self.in_place_requests = set()      # Blocks being received straight into their piece buffer
+        self.interested_peers = set()
+        self.endgame = False
+
+        self.peer_latency: dict[str, float] = dict()    # Moving average of the request to block time per peer
+        self.peer_timeouts = Counter()                  # Consecutive request timeouts per peer
+        self.snubbed_peers = set()
+
+        self.lock = threading.Lock()
+        self.block_event = threading.Event()
+
+    def run(self):
+        """Download pieces until every piece is held by the client."""
+        self.piece_manager.state = DownloadingFSM.PIECE_REQ
+        last_interest_time = 0
+
+        while not self.piece_manager.is_download_complete():
+            unchoked_peers = [id for id in self.piece_manager.get_unchoked_peers()
+                              if id in self.client.peer_connections]
+            self.send_interest_messages()
+            self.expire_requests()
+            if unchoked_peers:
+                self.fill_pipelines(unchoked_peers)
+            elif time.time() - last_interest_time > 2:
+                # Peers only reconsider choking us when they receive an INTERESTED message
+                self.client.log("Trying to get unchoked peers...\n")
+                self.send_interest_messages(resend=True)
+                last_interest_time = time.time()
+
+            self.block_event.wait(0.2)
+            self.block_event.clear()
+
+    def send_interest_messages(self, resend=False):
+        for id, connection in list(self.client.peer_connections.items()):
+            if (resend or id not in self.interested_peers) and self.piece_manager.peer_has_needed_piece(id):
+                connection.send_interest_message()
+                self.interested_peers.add(id)
+
+    def fill_pipelines(self, unchoked_peers):
+        """Top up the request queue of every unchoked peer to the pipeline depth given by the scheduler."""
+        rates = {id: self.piece_manager.get_download_rate(id) for id in unchoked_peers}
+        block_size = self.piece_manager.block_size
+        with self.lock:
+            # Peers that have been timing out are served last, so released blocks go to the others first
+            peers = sorted(self.scheduler.order_peers(unchoked_peers, rates), key=lambda id: self.peer_timeouts[id])
+            for id in peers:
+                connection = self.client.peer_connections.get(id)
+                if connection is None:      # Closed meanwhile, its requests are released once the lock is free
+                    continue
+                outstanding = self.peer_requests.setdefault(id, dict())
+                if id in self.snubbed_peers:
+                    pipeline_depth = 1
+                else:
+                    pipeline_depth = self.scheduler.get_pipeline_depth(id, rates[id], block_size)
+                while len(outstanding) < pipeline_depth:
+                    request = self.pick_block(id)
+                    if request is None and self.is_endgame():
+                        request = self.pick_endgame_block(id)
+                    if request is None:
+                        break
+                    outstanding[request] = time.time()
+                    self.request_peers.setdefault(request, set()).add(id)
+                    connection.send_request_message(*request)
+
+    def pick_block(self, id) -> tuple[int, int, int] | None:
+        """Pick the next block to request from a peer, preferring pieces that are already in flight."""
+        downloading_pieces = self.piece_manager.downloading_pieces
+        for piece_idx, piece in downloading_pieces.items():
+            if piece.has_missing_blocks() and self.piece_manager.peer_has_piece(id, piece_idx):
+                return piece.request_next_block()
+
+        if len(downloading_pieces) >= self.max_active_pieces:
+            return None
+        piece_idx, _ = self.piece_manager.find_next_rarest_piece(peer_id=id, exclude=downloading_pieces.keys())
+        if piece_idx is None or piece_idx == -1:
+            return None
+
+        self.client.log(f"\nREQUESTING PIECE {piece_idx} ...\n\n")
+        return self.piece_manager.start_piece(piece_idx).request_next_block()
+
+    # ------------ Timeouts and choked peers ------------
+
+    def get_request_timeout(self, id):
+        latency = self.peer_latency.get(id)
+        if latency is None:
+            return REQUEST_TIMEOUT_MAX
+        return min(max(REQUEST_TIMEOUT_FACTOR * latency, REQUEST_TIMEOUT_MIN), REQUEST_TIMEOUT_MAX)
+
+    def expire_requests(self):
+        """Release the requests that stayed unanswered past their peer's timeout, and snub repeat offenders."""
+        now = time.time()
+        expired_peers = []
+        with self.lock:
+            for id, outstanding in self.peer_requests.items():
+                timeout = self.get_request_timeout(id)
+                expired = [request for request, sent_time in outstanding.items() if now - sent_time > timeout]
+                if not expired:
+                    continue
+                self.release_requests(id, expired)
+                expired_peers.append((id, expired))
+                self.peer_timeouts[id] += 1
+                if self.peer_timeouts[id] >= SNUB_TIMEOUTS and id not in self.snubbed_peers:
+                    self.snubbed_peers.add(id)
+                    self.client.log(f"\nPeer {self.client.get_peers([id])} snubbed: {self.peer_timeouts[id]} "
+                                    f"request timeouts in a row\n\n")
+
+        for id, expired in expired_peers:
+            self.client.log(f"\n{len(expired)} requests to peer {self.client.get_peers([id])} timed out, "
+                            f"requesting them again\n\n")
+            connection = self.client.peer_connections.get(id)
+            if connection is not None:
+                for request in expired:
+                    connection.send_cancel_message(*request)
+        if expired_peers:
+            self.block_event.set()
+
+    def peer_choked(self, id):
+        """A peer that chokes us discards our requests, they are released for the other peers."""
+        with self.lock:
+            outstanding = self.peer_requests.get(id)
+            if outstanding:
+                self.release_requests(id, list(outstanding))
+        self.block_event.set()
+
+    def peer_disconnected(self, id):
+        """Release the requests of a closed connection and forget its state."""
+        with self.lock:
+            outstanding = self.peer_requests.get(id)
+            if outstanding:
+                self.release_requests(id, list(outstanding))
+            self.peer_requests.pop(id, None)
+            self.interested_peers.discard(id)
+            self.snubbed_peers.discard(id)
+            self.peer_latency.pop(id, None)
+            self.peer_timeouts.pop(id, None)
+        self.block_event.set()
+
+    def release_requests(self, id, requests):
+        """Forget requests sent to a peer. Blocks outstanding at no other peer are marked missing again."""
+        outstanding = self.peer_requests[id]
+        for request in requests:
+            outstanding.pop(request, None)
+            piece_idx, begin, _ = request
+            piece = self.piece_manager.downloading_pieces.get(piece_idx)
+            if request in self.in_place_requests:
+                # The peer may still write the block into the piece buffer later. The piece moves to a
+                # copy of its buffer, and whatever the peer writes into the old one is copied only if needed
+                self.in_place_requests.discard(request)
+                if piece is not None:
+                    piece.data = bytearray(piece.data)
+
+            peers = self.request_peers.get(request)
+            if peers is not None:
+                peers.discard(id)
+                if peers:
+                    continue
+                del self.request_peers[request]
+            if piece is not None:
+                piece.cancel_block_request(begin)
+
+    def is_endgame(self) -> bool:
+        """Endgame starts when every needed piece is in flight and none of them has unrequested blocks."""
+        if not self.endgame:
+            downloading_pieces = self.piece_manager.downloading_pieces
+            if len(self.piece_manager.pieces) + len(downloading_pieces) < self.piece_manager.number_of_pieces or \
+                    any(piece.has_missing_blocks() for piece in downloading_pieces.values()):
+                return False
+            self.endgame = True
+            self.client.log("\nENDGAME: requesting the remaining blocks from every peer that has them\n\n")
+        return True
+
+    def pick_endgame_block(self, id) -> tuple[int, int, int] | None:
+        """Pick a block that is outstanding at other peers only. Blocks that are being received in place
+        are left alone, so a second copy never writes into the piece buffer at the same time."""
+        outstanding = self.peer_requests[id]
+        for piece_idx, piece in self.piece_manager.downloading_pieces.items():
+            if not self.piece_manager.peer_has_piece(id, piece_idx):
+                continue
+            for request in piece.block_requests:
+                if piece.block_states[request[1]] == BlockState.REQUESTED and request not in outstanding \
+                        and request not in self.in_place_requests:
+                    return request
+        return None
+
+    def get_block_buffer(self, id, piece_idx, begin, length) -> memoryview | None:
+        """Return the slice of the piece buffer that a block requested from this peer can be received into."""
+        request = (piece_idx, begin, length)
+        with self.lock:
+            # Blocks also requested from other peers in endgame are received through the message buffer
+            if self.request_peers.get(request) != {id}:
+                return None
+            piece = self.piece_manager.downloading_pieces.get(piece_idx)
+            if piece is None or piece.block_states.get(begin) != BlockState.REQUESTED:
+                return None
+            self.in_place_requests.add(request)
+            return memoryview(piece.data)[begin:begin + length]
+
+    def block_received(self, id, piece_idx, begin, block):
+        """Called by a peer connection for every PIECE message it receives."""
+        request = (piece_idx, begin, len(block))
+        with self.lock:
+            self.in_place_requests.discard(request)
+            cancelled_peers = []
+            for other_id in self.request_peers.pop(request, ()):
+                sent_time = self.peer_requests[other_id].pop(request)
+                if other_id == id:
+                    self.update_latency(id, time.time() - sent_time)
+                else:
+                    cancelled_peers.append(other_id)
+            piece_completed = self.piece_manager.add_block(id, piece_idx, begin, block)
+
+        for other_id in cancelled_peers:
+            connection = self.client.peer_connections.get(other_id)
+            if connection is not None:
+                connection.send_cancel_message(*request)
+        if piece_completed:
+            self.piece_manager.verify_piece(piece_idx, self.piece_verified)
+        self.block_event.set()
+
+    def update_latency(self, id, sample):
+        latency = self.peer_latency.get(id)
+        self.peer_latency[id] = sample if latency is None else 0.75 * latency + 0.25 * sample
+        self.peer_timeouts[id] = 0
+        if id in self.snubbed_peers:
+            self.snubbed_peers.discard(id)
+            self.client.log(f"\nPeer {self.client.get_peers([id])} is no longer snubbed\n\n")
+
+    def piece_verified(self, piece_idx, is_valid):
+        """Called from the verifier pool once a completed piece has been hashed."""
+        if is_valid:
+            # Written before taking the lock, which only covers the bookkeeping
+            self.piece_manager.write_piece(piece_idx)
+        with self.lock:
+            if is_valid:
+                self.piece_manager.merge_blocks_to_piece(piece_idx)
+            else:
+                peers = self.piece_manager.reject_piece(piece_idx)
+
+        if is_valid:
+            self.client.log(f'\n\nPIECE {piece_idx} DOWNLOADED!\nSending "Have" message to all peers...\n\n')
+            for connection in list(self.client.peer_connections.values()):
+                connection.send_have_message(piece_idx)
+        else:
+            self.client.log(f"\nPIECE {piece_idx} FAILED HASH CHECK, requesting it again. "
+                            f"Supplied by peers {self.client.get_peers(peers)}\n\n")
+        self.block_event.set()
@@ -0,0 +1,123 @@
+import struct
+
+from .utils import MessageType
+
+RECV_BUFFER_SIZE = 16 * 1024
+MIN_RECV_SIZE = 1024
+MAX_MESSAGE_LENGTH = 16 * 1024 * 1024
+PIECE_HEADER_LENGTH = 13
+
+
+class MessageFramer:
+    """Splits the received byte stream into length-prefixed messages without copying them.
+
+    Bytes are received straight into a reusable buffer with recv_into, and complete messages are handed
+    out as memoryview slices of it, valid until the next get_buffer(). Once the header of a PIECE message
+    is in, get_block_buffer(piece_idx, begin, length) may return the slice of the piece being downloaded,
+    and the rest of the payload is then received directly into it.
+    """
+
+    def __init__(self, get_block_buffer=None, buffer_size=RECV_BUFFER_SIZE):
+        self.get_block_buffer = get_block_buffer
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.start = 0                  # Start of the bytes not handed out yet
+        self.end = 0                    # End of the received bytes
+        self.handshake_length = None    # Length of a handshake being received, which has no length prefix
+
+        self.block_header = None        # Header of the PIECE message whose payload goes into block
+        self.block = None
+        self.block_filled = 0
+
+    def get_buffer(self) -> memoryview:
+        """Return the buffer the next received bytes must be written to."""
+        if self.block is not None:
+            return self.block[self.block_filled:]
+
+        if self.start == self.end:
+            self.start = self.end = 0
+        available = self.end - self.start
+        if self.handshake_length is not None:
+            needed = self.handshake_length
+        else:
+            needed = self.get_message_length() if available >= 4 else 4
+        free = len(self.buffer) - self.end
+        if free < needed - available or free < MIN_RECV_SIZE:
+            self.compact(needed)
+        return self.view[self.end:]
+
+    def buffer_updated(self, nbytes):
+        """Account for nbytes written to the buffer returned by get_buffer()."""
+        if self.block is not None:
+            self.block_filled += nbytes
+        else:
+            self.end += nbytes
+
+    def compact(self, needed):
+        """Move the partial message to the front of the buffer, growing it if the message does not fit."""
+        pending = bytes(self.view[self.start:self.end])
+        if needed > len(self.buffer):
+            self.buffer = bytearray(needed)
+            self.view = memoryview(self.buffer)
+        self.view[:len(pending)] = pending
+        self.start, self.end = 0, len(pending)
+
+    def get_message_length(self):
+        length = int.from_bytes(self.view[self.start:self.start + 4], byteorder="big")
+        if length <= 4 or length > MAX_MESSAGE_LENGTH:
+            raise ValueError("Invalid message length received.")
+        return length
+
+    def read_handshake(self, length=68) -> memoryview | None:
+        """Take the raw handshake that precedes the messages, or return None if it is not complete yet."""
+        if self.end - self.start < length:
+            self.handshake_length = length
+            return None
+        self.handshake_length = None
+        handshake = self.view[self.start:self.start + length]
+        self.start += length
+        return handshake
+
+    def messages(self):
+        """Yield (message, block) for every complete message received so far.
+
+        message includes the length prefix. For a PIECE message received into a block buffer, message is
+        only the header and block is the payload, otherwise block is None.
+        """
+        while True:
+            if self.block is not None:
+                if self.block_filled < len(self.block):
+                    return
+                header, block = self.block_header, self.block
+                self.block_header = self.block = None
+                yield header, block
+                continue
+
+            available = self.end - self.start
+            if available < 4:
+                return
+            length = self.get_message_length()
+            if available < length:
+                if available >= PIECE_HEADER_LENGTH and self.buffer[self.start + 4] == MessageType.PIECE.value:
+                    self.start_block(length)
+                return
+
+            message = self.view[self.start:self.start + length]
+            self.start += length
+            yield message, None
+
+    def start_block(self, length):
+        """Receive the rest of a partially received PIECE message into its block buffer, if there is one."""
+        if self.get_block_buffer is None or length <= PIECE_HEADER_LENGTH:
+            return
+        piece_idx, begin = struct.unpack_from(">II", self.buffer, self.start + 5)
+        block = self.get_block_buffer(piece_idx, begin, length - PIECE_HEADER_LENGTH)
+        if block is None:
+            return
+
+        received = self.view[self.start + PIECE_HEADER_LENGTH:self.end]
+        block[:len(received)] = received
+        self.block_header = bytes(self.view[self.start:self.start + PIECE_HEADER_LENGTH])
+        self.block = block
+        self.block_filled = len(received)
+        self.start = self.end
@@ -0,0 +1,79 @@
+import errno
+import os
+import socket
+
+from .utils import USE_SENDFILE
+
+MAX_SEND_BUFFERS = 512          # Buffers per sendmsg call, below the IOV_MAX of common platforms
+SENDFILE_UNSUPPORTED = (errno.EINVAL, errno.ENOSYS, errno.ENOTSOCK, errno.EOPNOTSUPP)
+# Tells the kernel more data follows, so a header flushed before a sendfile is not sent as a packet of its own
+MSG_MORE = getattr(socket, 'MSG_MORE', 0)
+
+
+class MessageSender:
+    """Writes messages to a blocking socket with as few system calls and copies as possible.
+
+    Buffers added are gathered and written together with sendmsg (writev), which is resumed after partial
+    writes. File spans, the payloads of PIECE messages, go from the page cache to the socket with
+    os.sendfile and never pass through Python. Where sendmsg or sendfile is not available the buffers are
+    sent one at a time and the spans are read instead.
+    """
+
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+        self.buffers: list[memoryview] = []
+        self.pending = 0                # Bytes in buffers
+        self.use_sendmsg = hasattr(sock, 'sendmsg')
+        self.use_sendfile = USE_SENDFILE and hasattr(os, 'sendfile') and hasattr(os, 'pread')
+
+    def add(self, buffer):
+        buffer = memoryview(buffer)
+        self.buffers.append(buffer)
+        self.pending += buffer.nbytes
+
+    def add_file_span(self, fd, offset, length):
+        """Send length bytes of an open file from offset, after the buffers added before."""
+        if self.use_sendfile:
+            self.flush(MSG_MORE)
+            if self.sendfile(fd, offset, length):
+                return
+        self.add(os.pread(fd, length, offset))
+
+    def sendfile(self, fd, offset, length) -> bool:
+        """Return False, and stop using sendfile, if the socket or the file does not support it."""
+        sent = 0
+        while sent < length:
+            try:
+                count = os.sendfile(self.sock.fileno(), fd, offset + sent, length - sent)
+            except OSError as e:
+                if sent == 0 and e.errno in SENDFILE_UNSUPPORTED:
+                    self.use_sendfile = False
+                    return False
+                raise
+            if count == 0:
+                raise ValueError("File span ends before the requested length.")
+            sent += count
+        return True
+
+    def flush(self, flags=0):
+        """Write every buffer added so far."""
+        while self.buffers:
+            if self.use_sendmsg:
+                sent = self.sock.sendmsg(self.buffers[:MAX_SEND_BUFFERS], [], flags)
+            else:
+                sent = self.sock.send(self.buffers[0], flags)
+            self.consume(sent)
+
+    def consume(self, sent):
+        """Drop the sent bytes from the front of the buffers."""
+        self.pending -= sent
+        if not self.pending:
+            self.buffers.clear()
+            return
+        done = 0
+        while done < len(self.buffers) and sent >= self.buffers[done].nbytes:
+            sent -= self.buffers[done].nbytes
+            done += 1
+        del self.buffers[:done]
+        if sent:
+            self.buffers[0] = self.buffers[0].cast('B')[sent:]
@@ -1,17 +1,23 @@
-from queue import Queue
+from queue import Queue, Empty
 import socket
 import struct
 import threading
 from enum import Enum
 import time
 from .piece_manager import PieceManager
-from .utils import TorrentUtils, MagnetUtils, ExtensionMessageType, MessageType
+from .message_framer import MessageFramer
+from .message_sender import MessageSender
+from .rate_limiter import TokenBucket, BandwidthLimiter, GLOBAL_UPLOAD_BUCKET, GLOBAL_DOWNLOAD_BUCKET
+from .utils import TorrentUtils, MagnetUtils, ExtensionMessageType, MessageType, MAX_REQUEST_LENGTH
 
 import bencodepy
 
+MAX_SEND_BATCH = 64             # Queued messages written together by the threaded engine
+
 
 class PeerConnection:
-    def __init__(self, info_hash, my_id, sock: socket.socket, target_peer: dict, piece_manager: PieceManager, outgoing, client):
+    def __init__(self, info_hash, my_id, sock: socket.socket, target_peer: dict, piece_manager: PieceManager, outgoing, client,
+                 handshake: bytes = None):
         self.in_queue = Queue()
         self.out_queue = Queue()
 
@@ -19,8 +25,14 @@ class PeerConnection:
         self.peer_id = None                # peer id received from the handshake
         self.ip = target_peer['ip']
         self.port = target_peer['port']
+        self.outgoing = outgoing
         self.piece_manager = piece_manager
         self.queue_running = True
+        self.upload_requests = dict()       # Blocks requested by the peer and not sent yet, in request order
+        self.choking_peer = True            # We do not upload to the peer until the choker unchokes it
+        self.closed = False                 # Set once the connection manager forgot the connection
+        self.holds_slot = not outgoing      # Counted in the session's connections, incoming ones from the start
+        self.connected_time = None
 
         self.extension_message_id = 0
         self.ut_metadata_id = 3
@@ -30,65 +42,85 @@ class PeerConnection:
 
         self.sock = sock
         self.client = client
+        self.received_handshake = handshake     # Handshake of an incoming connection, already read by the session
+        self.framer = MessageFramer(self.get_block_buffer)
+        # Blocks sent and bytes received are charged to the process', the torrent's and the peer's limits
+        self.upload_bucket = TokenBucket(client.peer_upload_limit)
+        self.download_bucket = TokenBucket(client.peer_download_limit)
+        self.upload_limiter = BandwidthLimiter(GLOBAL_UPLOAD_BUCKET, client.upload_bucket, self.upload_bucket)
+        self.download_limiter = BandwidthLimiter(GLOBAL_DOWNLOAD_BUCKET, client.download_bucket, self.download_bucket)
         self.init_connection(info_hash, my_id, outgoing)
 
     def init_connection(self, info_hash, my_id, outgoing):
+        self.sender = MessageSender(self.sock)
         self.send_handshake_message(info_hash, my_id, outgoing)
-
-        self.in_thread = threading.Thread(target=self.process_recv_messages, daemon=True)
-        self.in_thread.start()
+        # The connect timeout also bounded the handshake, the connection blocks from now on
+        self.sock.settimeout(None)
 
         self.out_thread = threading.Thread(target=self.process_send_messages, daemon=True)
         self.out_thread.start()
 
+        self.in_thread = threading.Thread(target=self.process_recv_messages, daemon=True)
+        self.in_thread.start()
+
     def send_handshake_message(self, info_hash, my_id, outgoing):
         """Send base handshake message. Send an extension message if the peer supports the extension protocol."""
         if not outgoing:
             # Receive and validate the peer's handshake request
-            self.extension_supported, self.peer_id = TorrentUtils.receive_and_validate_handshake(self.sock, info_hash)
-            self.send_bitfield_message()
-            if self.piece_manager.is_seeding():
-                self.seeding()
+            if self.received_handshake is not None:
+                self.extension_supported, self.peer_id = TorrentUtils.validate_handshake(self.received_handshake,
+                                                                                         info_hash)
+            else:
+                self.extension_supported, self.peer_id = TorrentUtils.receive_and_validate_handshake(self.sock,
+                                                                                                     info_hash)
 
         # Send the handshake message. Both outgoing and incoming connections send the same message
-        reserved_bytes = MagnetUtils.get_reserved_bytes(self.extension_supported)
-        handshake_message = (
-            b"\x13BitTorrent protocol"
-            + reserved_bytes
-            + bytes.fromhex(info_hash)
-            + my_id.encode('utf-8')
-        )
-        self.sock.send(handshake_message)
+        self.sock.sendall(self.get_handshake_message(info_hash, my_id))
 
         if outgoing:
             # Receive and validate the peer's handshake response
             self.extension_supported, self.peer_id = TorrentUtils.receive_and_validate_handshake(self.sock, info_hash)
-            if self.extension_supported:
-                self.send_extension_handshake()
+        self.handshake_exchanged()
 
-    def recv_message(self):
-        length_prefix = self.sock.recv(4)
-        if not length_prefix or len(length_prefix) < 4:
-            print(f"Received length prefix: {length_prefix.hex()}")
-            raise ConnectionError("Incomplete message length prefix received.")
+    def handshake_exchanged(self):
+        """Open the connection once both handshakes are through. Both sides advertise their pieces, so either
+        of two connections between the same peers can be the one kept. Shared by the threaded and the asyncio
+        engine.
+        """
+        self.send_bitfield_message()
+        if self.piece_manager.is_seeding():
+            self.seeding()
+        if self.outgoing and self.extension_supported:
+            self.send_extension_handshake()
 
-        message_length = int.from_bytes(length_prefix, byteorder="big")
-        if message_length <= 0:
-            raise ValueError("Invalid message length received.")
+    def get_handshake_message(self, info_hash, my_id) -> bytes:
+        reserved_bytes = MagnetUtils.get_reserved_bytes(self.extension_supported)
+        return (
+            b"\x13BitTorrent protocol"
+            + reserved_bytes
+            + bytes.fromhex(info_hash)
+            + my_id.encode('utf-8')
+        )
 
-        message = length_prefix
-        while len(message) < message_length:
-            chunk = self.sock.recv(min(4096, message_length - len(message)))
-            if not chunk:
-                raise ConnectionError("Connection closed before full message received.")
-            message += chunk
+    def recv_messages(self):
+        """Receive from the socket straight into the framer's buffer and yield the completed messages."""
+        nbytes = self.sock.recv_into(self.framer.get_buffer())
+        if not nbytes:
+            raise ConnectionError("Connection closed by peer.")
+        self.framer.buffer_updated(nbytes)
+        delay = self.download_limiter.consume(nbytes)
+        yield from self.framer.messages()
+        if delay:
+            time.sleep(delay)
 
-        return message
+    def get_block_buffer(self, piece_idx, begin, length):
+        return self.client.download_engine.get_block_buffer(self.id, piece_idx, begin, length)
 
 
     def handle_extension_message(self, message):
         """Handle an extension message from the peer."""
         try:
+            message = bytes(message)
             payload = message[6:]
             decoded_payload = bencodepy.decode(payload)
 
@@ -115,7 +147,7 @@ class PeerConnection:
         try:
             handshake_message = {b"m": {b"ut_metadata": self.ut_metadata_id}}
             payload = MagnetUtils.construct_extension_payload(handshake_message, self.extension_message_id)
-            self.sock.send(payload)
+            self.enqueue_send_message(payload)
             self.client.log(f"Sent extension handshake to {self.ip}, {self.port}.\n")
         except Exception as e:
             self.client.log(f"Error sending extension handshake: {e}\n")
@@ -129,7 +161,7 @@ class PeerConnection:
             if metadata_size is not None:
                 response[b"metadata_size"] = metadata_size
             payload = MagnetUtils.construct_extension_payload(response, self.extension_message_id)
-            self.sock.send(payload)
+            self.enqueue_send_message(payload)
             self.client.log(f"Sent extension handshake response {self.ip}, {self.port}.\n")
         except Exception as e:
             self.client.log(f"Error handling extension handshake request: {e}\n")
@@ -157,7 +189,7 @@ class PeerConnection:
             if piece_idx is not None:
                 request_dict = {b"msg_type": ExtensionMessageType.REQUEST.value, b"piece": piece_idx}
                 payload = MagnetUtils.construct_extension_payload(request_dict, self.extension_message_id)
-                self.sock.send(payload)
+                self.enqueue_send_message(payload)
                 self.client.log(f"Requested metadata piece {piece_idx}.\n")
             else:
                 self.client.log("All metadata pieces downloaded.\n")
@@ -202,59 +234,105 @@ class PeerConnection:
                 response = {b"msg_type": ExtensionMessageType.DATA.value, b"piece": piece_index}
                 payload = MagnetUtils.construct_extension_payload(
                     response, self.extension_message_id, added_length=len(metadata_piece)) + metadata_piece
-                self.sock.send(payload)
+                self.enqueue_send_message(payload)
                 self.client.log(f"Sent metadata piece {piece_index} to peer.\n")
             else:
                 response = {b"msg_type": ExtensionMessageType.REJECT.value, b"piece": piece_index}
                 payload = MagnetUtils.construct_extension_payload(response, self.extension_message_id)
-                self.sock.send(payload)
+                self.enqueue_send_message(payload)
                 self.client.log(f"Rejected metadata piece {piece_index} request from peer.\n")
         except Exception as e:
             self.client.log(f"Error handling metadata request: {e}\n")
 
 
     def process_send_messages(self):
-        """Send messages from the out queue to the peer."""
+        """Send messages from the out queue to the peer. Everything queued is written at once."""
         while self.queue_running:
             try:
-                message = self.out_queue.get()
-                self.sock.send(message)
-            except (ConnectionError, ValueError) as e:
+                batch = [self.out_queue.get()]
+                if not self.queue_running:
+                    break
+                while len(batch) < MAX_SEND_BATCH:
+                    try:
+                        message = self.out_queue.get_nowait()
+                    except Empty:
+                        break
+                    if message is None:     # Put by close()
+                        break
+                    batch.append(message)
+                if not self.queue_running:
+                    break
+
+                for message in batch:
+                    if not isinstance(message, tuple):
+                        self.sender.add(message)
+                        continue
+                    # A block request, read when its turn comes so a CANCEL can still drop it
+                    uploaded = self.add_piece_message(message)
+                    delay = self.upload_limiter.consume(uploaded) if uploaded else 0
+                    if delay:
+                        self.sender.flush()
+                        time.sleep(delay)
+                self.sender.flush()
+            except Exception as e:
+                # Whatever failed, the connection is closed rather than left without its sending thread
                 print(f"Error sending message: {e}")
-                self.queue_running = False
+                self.close()
 
     def process_recv_messages(self):
         """Receive message from a queue, including handling the BitTorrent protocol length prefix.
             Return the complete message, including the 4-byte length prefix, or None on failure.
         """
-        while self.queue_running:
-            try:
-                message = self.recv_message()
-                match message[4]:
-                    case MessageType.EXTENDED.value:
-                        self.handle_extension_message(message)
-                    case MessageType.BITFIELD.value:
-                        self.handle_bitfield_message(message)
-                    case MessageType.PIECE.value:
-                        self.handle_piece_message(message)
-                    case MessageType.HAVE.value:
-                        self.handle_have_message(message)
-                    case MessageType.CHOKE.value:
-                        self.handle_choke_message()
-                    case MessageType.UNCHOKE.value:
-                        self.handle_unchoke_message()
-                    case MessageType.INTERESTED.value:
-                        self.handle_interest_message()
-                    case MessageType.NOT_INTERESTED.value:
-                        self.handle_not_interested_message()
-                    case MessageType.REQUEST.value:
-                        self.handle_request_message(message)
-                    case _:
-                        print(f"Unhandled message type: {message[4]}")
-            except (ConnectionError, ValueError) as e:
-                print(f"Error receiving message: {e}")
-                self.queue_running = False
-                self.client.remove_connection(self.id)
+        try:
+            while self.queue_running:
+                for message, block in self.recv_messages():
+                    self.handle_message(message, block)
+        except (OSError, ValueError) as e:
+            print(f"Error receiving message: {e}")
+        finally:
+            self.close()
+            # The socket is closed only once the sending thread is done with it, so its descriptor
+            # cannot be reused by another connection while still in use here
+            self.out_thread.join()
+            self.sock.close()
+            self.client.remove_connection(self)
+
+    def close(self):
+        """Stop both threads. The receiving thread then closes the socket and removes the connection."""
+        self.queue_running = False
+        self.out_queue.put(None)
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def handle_message(self, message, block=None):
+        """Dispatch a complete message to its handler. Shared by the threaded and the asyncio engine.
+        block is the payload of a PIECE message that was received directly into its piece.
+        """
+        match message[4]:
+            case MessageType.EXTENDED.value:
+                self.handle_extension_message(message)
+            case MessageType.BITFIELD.value:
+                self.handle_bitfield_message(message)
+            case MessageType.PIECE.value:
+                self.handle_piece_message(message, block)
+            case MessageType.HAVE.value:
+                self.handle_have_message(message)
+            case MessageType.CHOKE.value:
+                self.handle_choke_message()
+            case MessageType.UNCHOKE.value:
+                self.handle_unchoke_message()
+            case MessageType.INTERESTED.value:
+                self.handle_interest_message()
+            case MessageType.NOT_INTERESTED.value:
+                self.handle_not_interested_message()
+            case MessageType.REQUEST.value:
+                self.handle_request_message(message)
+            case MessageType.CANCEL.value:
+                self.handle_cancel_message(message)
+            case _:
+                print(f"Unhandled message type: {message[4]}")
 
     def send_bitfield_message(self):
         """Send a bitfield message to the peer."""
@@ -272,13 +350,19 @@ class PeerConnection:
         self.piece_manager.add_peer_bitfield(self.id, bitfield, self.ip, self.port)
 
     def send_choke_message(self):
+        # Requests of a choked peer are discarded, it requests them again once unchoked
+        self.choking_peer = True
+        self.upload_requests.clear()
         message = struct.pack(">IB", 1+4, MessageType.CHOKE.value)
         self.enqueue_send_message(message)
 
     def handle_choke_message(self):
+        self.piece_manager.remove_unchoked_peer(self.id)
+        self.client.download_engine.peer_choked(self.id)
         self.client.log(f"Peer {self.ip}, {self.port} choked.\n")
 
     def send_unchoke_message(self):
+        self.choking_peer = False
         message = struct.pack(">IB", 1+4, MessageType.UNCHOKE.value)
         self.enqueue_send_message(message)
 
@@ -290,15 +374,70 @@ class PeerConnection:
         message = struct.pack(">IBIII", 17, MessageType.REQUEST.value, piece_index, begin, length)
         self.enqueue_send_message(message)
 
+    @staticmethod
+    def unpack_request(message) -> tuple[int, int, int]:
+        """(index, begin, length) of a REQUEST or CANCEL message. Raises ValueError if it is malformed."""
+        if len(message) != 17:
+            raise ValueError(f"Malformed request message of {len(message)} bytes")
+        return struct.unpack_from(">III", message, 5)
+
     def handle_request_message(self, message):
-        if self.peer_not_interest:
+        request = self.unpack_request(message)
+        if request[2] > MAX_REQUEST_LENGTH or not self.piece_manager.has_block(*request):
+            # Oversized, or not a block of a piece we hold: nothing is queued or read for it
+            self.client.log(f"Dropped invalid request from peer {self.ip}, {self.port}: {request}\n")
+            return
+        if self.peer_not_interest or self.choking_peer:
             return
+        self.upload_requests[request] = None
+        self.schedule_upload(request)
+        self.client.log(f"Receive request message from peer {self.ip}, {self.port}: {request}\n")
+
+    def schedule_upload(self, request):
+        self.out_queue.put(request)
+
+    def get_piece_header(self, request) -> bytes | None:
+        """Return the header of the PIECE message answering a queued request, or None if it was cancelled
+        meanwhile. The block follows the header as a separate buffer, so it is never copied into the message.
+        """
+        try:
+            del self.upload_requests[request]
+        except KeyError:
+            return None
+        index, begin, length = request
+        return struct.pack(">IBII", length + 13, MessageType.PIECE.value, index, begin)
+
+    def add_piece_message(self, request) -> int:
+        """Add the PIECE message answering a request to the sender, the block as file spans sent with
+        sendfile where supported. Return the size of the message, 0 if the request was cancelled.
+        """
+        header = self.get_piece_header(request)
+        if header is None:
+            return 0
+        index, begin, length = request
+        # The block is looked up before its header is added, so a failure leaves no header without payload
+        if self.sender.use_sendfile:
+            spans = self.piece_manager.get_block_spans(index, begin, length, self.id)
+            self.sender.add(header)
+            for fd, offset, span_length in spans:
+                self.sender.add_file_span(fd, offset, span_length)
         else:
-            index, begin, length = struct.unpack(">III", message[5:])
-            block = self.piece_manager.get_block(index, begin, length)
-            self.send_piece_message(index, begin, block)
-        self.client.log(f"Receive request message from peer {self.ip}, {
-                                 self.port}: {index}, {begin}, {length}\n")
+            block = self.piece_manager.get_block(index, begin, length, self.id)
+            self.sender.add(header)
+            self.sender.add(block)
+        return len(header) + length
+
+    def send_cancel_message(self, piece_index, begin, length):
+        message = struct.pack(">IBIII", 17, MessageType.CANCEL.value, piece_index, begin, length)
+        self.enqueue_send_message(message)
+
+    def handle_cancel_message(self, message):
+        request = self.unpack_request(message)
+        if request[2] > MAX_REQUEST_LENGTH:
+            self.client.log(f"Dropped invalid cancel from peer {self.ip}, {self.port}: {request}\n")
+            return
+        self.upload_requests.pop(request, None)
+        self.client.log(f"Receive cancel message from peer {self.ip}, {self.port}: {request}\n")
 
     def send_have_message(self, piece_index):
         message = struct.pack(">IBI", 9, MessageType.HAVE.value, piece_index)
@@ -309,14 +448,11 @@ class PeerConnection:
         self.piece_manager.add_peer_piece(self.id, piece_index)
         self.client.log(f"\nPeer {self.ip}, {self.port} has piece {piece_index}\n")
 
-    def send_piece_message(self, piece_index, begin, block):
-        message = struct.pack(">IBII", len(block) + 13, MessageType.PIECE.value, piece_index, begin) + block
-        self.enqueue_send_message(message)
-
-    def handle_piece_message(self, message):
-        _, begin = struct.unpack(">II", message[5:13])
-        block = message[13:]
-        self.piece_manager.add_block(self.id, begin, block)
+    def handle_piece_message(self, message, block=None):
+        index, begin = struct.unpack(">II", message[5:13])
+        if block is None:
+            block = message[13:]
+        self.client.download_engine.block_received(self.id, index, begin, block)
         self.client.log(f"Receive a block from peer ({self.ip}, {self.port})\n")
 
     def send_interest_message(self):
@@ -324,10 +460,7 @@ class PeerConnection:
         self.enqueue_send_message(message)
 
     def handle_interest_message(self):
-        if self.id in self.piece_manager.select_peers_for_unchoking():
-            self.send_unchoke_message()
-        else:
-            self.send_choke_message()
+        self.client.choker.peer_interested(self)
 
     def send_not_interested_message(self):
         message = struct.pack(">IB", 5, MessageType.NOT_INTERESTED.value)
@@ -336,8 +469,11 @@ class PeerConnection:
     def handle_not_interested_message(self):
         self.peer_not_interest = True
         self.piece_manager.add_not_interest_peers(self.id)
+        self.client.choker.peer_not_interested(self)
 
     def enqueue_send_message(self, message):
+        """Send primitive of every outgoing message after the handshake. The threaded engine hands them
+        to the sending thread, other engines override it."""
         self.out_queue.put(message)
 
     def seeding(self):
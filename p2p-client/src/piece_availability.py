@@ -0,0 +1,254 @@
+import random
+
+import numpy as np
+
+
+class PieceAvailability:
+    """Which pieces each peer holds, kept as packed bit arrays in the layout of a BITFIELD message.
+
+    piece_counter, the number of peers holding each piece, is derived from them with vectorized numpy
+    operations and kept up to date as bitfields and HAVE messages arrive. needed marks the pieces the client
+    does not hold yet. Before the metadata is known the number of pieces is not either: bitfields are only
+    stored, and counted once set_number_of_pieces is called. Callers serialize access with PIECE_LOCK.
+
+    Two indexes are maintained incrementally for picking pieces:
+    - buckets[c] lists the needed pieces held by exactly c peers, so the rarest pieces are found without
+      scanning every piece. bucket_positions gives the position of each piece in its bucket.
+    - piece_peers[i] is a packed bitset of the peer slots holding piece i, the transpose of the peer bitfields,
+      so the peers holding a piece are found without scanning every peer.
+    """
+
+    def __init__(self, number_of_pieces=None, pieces=()):
+        self.number_of_pieces = None
+        self.peer_bitfields: dict[str, np.ndarray] = dict()
+        self.piece_counter = np.zeros(0, dtype=np.int32)
+        self.needed = np.zeros(0, dtype=bool)
+        self.needed_bitfield = np.zeros(0, dtype=np.uint8)     # needed, packed like the peer bitfields
+        self.needed_count = 0
+
+        self.buckets: list[list[int]] = [[]]
+        self.bucket_positions: list[int] = []
+
+        self.peer_slots: dict[str, int] = dict()               # Column of each peer in piece_peers
+        self.slot_peers: list[str | None] = []
+        self.free_slots: list[int] = []
+        self.piece_peers = np.zeros((0, 1), dtype=np.uint8)
+
+        if number_of_pieces is not None:
+            self.set_number_of_pieces(number_of_pieces, pieces)
+
+    def set_number_of_pieces(self, number_of_pieces, pieces=()):
+        """Size the arrays once the metadata is known and count the bitfields received so far."""
+        self.number_of_pieces = number_of_pieces
+        for id, bitfield in self.peer_bitfields.items():
+            self.peer_bitfields[id] = self.resize_bitfield(bitfield)
+
+        self.needed = np.ones(number_of_pieces, dtype=bool)
+        self.needed[list(pieces)] = False
+        self.needed_bitfield = np.packbits(self.needed)
+        self.needed_count = int(self.needed.sum())
+
+        self.piece_counter = np.zeros(number_of_pieces, dtype=np.int32)
+        self.piece_peers = np.zeros((number_of_pieces, max(1, (len(self.slot_peers) + 7) // 8)), dtype=np.uint8)
+        for id, bitfield in self.peer_bitfields.items():
+            bits = self.unpack(bitfield)
+            self.piece_counter += bits
+            self.set_peer_column(self.peer_slots[id], bits)
+
+        self.buckets = [[] for _ in range(int(self.piece_counter.max(initial=0)) + 1)]
+        self.bucket_positions = [0] * number_of_pieces
+        for piece_index in np.flatnonzero(self.needed).tolist():
+            self.bucket_add(piece_index, int(self.piece_counter[piece_index]))
+
+    def resize_bitfield(self, bitfield: np.ndarray) -> np.ndarray:
+        """Return a copy of a bitfield padded or cut to the number of pieces, with the spare bits cleared."""
+        length = (self.number_of_pieces + 7) // 8
+        resized = np.zeros(length, dtype=np.uint8)
+        resized[:min(length, len(bitfield))] = bitfield[:length]
+        if self.number_of_pieces % 8:
+            resized[-1] &= 0xFF << (8 - self.number_of_pieces % 8) & 0xFF
+        return resized
+
+    def unpack(self, bitfield: np.ndarray) -> np.ndarray:
+        return np.unpackbits(bitfield, count=self.number_of_pieces)
+
+    # ------------------ Count buckets ------------------
+
+    def bucket_add(self, piece_index, count):
+        while len(self.buckets) <= count:
+            self.buckets.append([])
+        bucket = self.buckets[count]
+        self.bucket_positions[piece_index] = len(bucket)
+        bucket.append(piece_index)
+
+    def bucket_remove(self, piece_index, count):
+        """Remove a piece from its bucket by moving the bucket's last piece into its place."""
+        bucket = self.buckets[count]
+        position = self.bucket_positions[piece_index]
+        last = bucket.pop()
+        if last != piece_index:
+            bucket[position] = last
+            self.bucket_positions[last] = position
+
+    def update_counts(self, bits: np.ndarray, delta):
+        """Add delta to the count of every piece whose bit is set, moving the needed ones between buckets."""
+        indices = np.flatnonzero(bits & self.needed)
+        for piece_index, count in zip(indices.tolist(), self.piece_counter[indices].tolist()):
+            self.bucket_remove(piece_index, count)
+            self.bucket_add(piece_index, count + delta)
+        if delta > 0:
+            self.piece_counter += bits
+        else:
+            self.piece_counter -= bits
+
+    # ----------------- Peers per piece -----------------
+
+    def get_peer_slot(self, id) -> int:
+        slot = self.peer_slots.get(id)
+        if slot is not None:
+            return slot
+        if self.free_slots:
+            slot = self.free_slots.pop()
+            self.slot_peers[slot] = id
+        else:
+            slot = len(self.slot_peers)
+            self.slot_peers.append(id)
+            if slot // 8 >= self.piece_peers.shape[1]:
+                # Out of columns, double them
+                grown = np.zeros((self.piece_peers.shape[0], self.piece_peers.shape[1] * 2), dtype=np.uint8)
+                grown[:, :self.piece_peers.shape[1]] = self.piece_peers
+                self.piece_peers = grown
+        self.peer_slots[id] = slot
+        return slot
+
+    def set_peer_column(self, slot, bits: np.ndarray):
+        """Set the bit of a peer slot in the rows of the pieces whose bit is set in bits."""
+        self.piece_peers[:, slot // 8] |= bits << (7 - slot % 8)
+
+    def clear_peer_column(self, slot):
+        self.piece_peers[:, slot // 8] &= ~(1 << (7 - slot % 8)) & 0xFF
+
+    def get_peers_with_piece(self, piece_index) -> list:
+        if self.number_of_pieces is None:
+            return [id for id in self.peer_bitfields if self.peer_has_piece(id, piece_index)]
+        slots = np.flatnonzero(np.unpackbits(self.piece_peers[piece_index]))
+        return [self.slot_peers[slot] for slot in slots.tolist()]
+
+    # -------------------------------------------------
+
+    def add_peer(self, id):
+        """Register a peer that holds no piece yet, forgetting what was known about a previous connection."""
+        self.remove_peer(id)
+        length = (self.number_of_pieces + 7) // 8 if self.number_of_pieces is not None else 0
+        self.peer_bitfields[id] = np.zeros(length, dtype=np.uint8)
+        self.get_peer_slot(id)
+
+    def remove_peer(self, id):
+        bitfield = self.peer_bitfields.pop(id, None)
+        slot = self.peer_slots.pop(id, None)
+        if slot is not None:
+            self.slot_peers[slot] = None
+            self.free_slots.append(slot)
+        if bitfield is None or self.number_of_pieces is None:
+            return
+        self.update_counts(self.unpack(bitfield), -1)
+        self.clear_peer_column(slot)
+
+    def set_peer_bitfield(self, id, bitfield: bytes) -> int:
+        """Replace a peer's bitfield with the one it sent. Return the number of pieces it holds."""
+        received = np.frombuffer(bitfield, dtype=np.uint8)
+        if self.number_of_pieces is None:
+            self.peer_bitfields[id] = received.copy()
+            self.get_peer_slot(id)
+            return int(np.unpackbits(received).sum())
+
+        self.remove_peer(id)
+        resized = self.resize_bitfield(received)
+        bits = self.unpack(resized)
+        self.peer_bitfields[id] = resized
+        self.update_counts(bits, 1)
+        self.set_peer_column(self.get_peer_slot(id), bits)
+        return int(bits.sum())
+
+    def add_peer_piece(self, id, piece_index):
+        """Record a HAVE message. A piece the peer was already known to hold is not counted twice."""
+        bitfield = self.peer_bitfields.get(id)
+        if bitfield is None or piece_index // 8 >= len(bitfield):
+            if self.number_of_pieces is not None:
+                return
+            # The number of pieces is not known yet, grow the bitfield to fit
+            grown = np.zeros(piece_index // 8 + 1, dtype=np.uint8)
+            if bitfield is not None:
+                grown[:len(bitfield)] = bitfield
+            bitfield = self.peer_bitfields[id] = grown
+            self.get_peer_slot(id)
+
+        mask = 1 << (7 - piece_index % 8)
+        if bitfield[piece_index // 8] & mask:
+            return
+        bitfield[piece_index // 8] |= mask
+        if self.number_of_pieces is None:
+            return
+
+        count = int(self.piece_counter[piece_index])
+        self.piece_counter[piece_index] = count + 1
+        if self.needed[piece_index]:
+            self.bucket_remove(piece_index, count)
+            self.bucket_add(piece_index, count + 1)
+        slot = self.peer_slots[id]
+        self.piece_peers[piece_index, slot // 8] |= 1 << (7 - slot % 8)
+
+    def add_have_piece(self, piece_index):
+        """Mark a piece as held by the client."""
+        if not self.needed[piece_index]:
+            return
+        self.bucket_remove(piece_index, int(self.piece_counter[piece_index]))
+        self.needed[piece_index] = False
+        self.needed_bitfield[piece_index // 8] &= ~(1 << (7 - piece_index % 8)) & 0xFF
+        self.needed_count -= 1
+
+    # -------------------------------------------------
+
+    def peer_has_piece(self, id, piece_index) -> bool:
+        bitfield = self.peer_bitfields.get(id)
+        if bitfield is None or piece_index // 8 >= len(bitfield):
+            return False
+        return bool(bitfield[piece_index // 8] >> (7 - piece_index % 8) & 1)
+
+    def peer_has_needed_piece(self, id) -> bool:
+        bitfield = self.peer_bitfields.get(id)
+        if bitfield is None or self.number_of_pieces is None:
+            return False
+        return bool(np.bitwise_and(bitfield, self.needed_bitfield).any())
+
+    def is_complete(self) -> bool:
+        return self.number_of_pieces is not None and self.needed_count == 0
+
+    def pick_rarest_piece(self, peer_id=None, exclude=()) -> int | None:
+        """Return a random needed piece among those held by the fewest peers, but by at least one.
+        If peer_id is given, only pieces held by that peer are considered. Pieces in exclude are skipped.
+        Return None if there is no such piece.
+        """
+        bitfield = None
+        if peer_id is not None:
+            bitfield = self.peer_bitfields.get(peer_id)
+            if bitfield is None:
+                return None
+            bitfield = memoryview(bitfield)
+
+        for bucket in self.buckets[1:]:
+            if not bucket:
+                continue
+            # Walk the bucket from a random position, so ties are broken at random
+            start = random.randrange(len(bucket))
+            for i in range(len(bucket)):
+                piece_index = bucket[(start + i) % len(bucket)]
+                if piece_index in exclude:
+                    continue
+                if bitfield is None or bitfield[piece_index // 8] >> (7 - piece_index % 8) & 1:
+                    return piece_index
+        return None
+
+    def get_bitfield(self) -> bytes:
+        """Return the client's own bitfield."""
+        return np.packbits(~self.needed).tobytes()
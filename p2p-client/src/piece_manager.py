@@ -3,12 +3,14 @@ import json
 import os
 from queue import Queue
 from collections import Counter
-import random
 import threading
-import time
 import bencodepy
 
-from .utils import TorrentUtils, MagnetUtils
+from .utils import TorrentUtils, MagnetUtils, BLOCK_SIZE
+from .storage import PieceStorage
+from .piece_verifier import PieceVerifier
+from .piece_availability import PieceAvailability
+from .rate_meter import RateMeter
 
 PIECE_LOCK = threading.Lock()
 METADATA_LOCK = threading.Lock()
@@ -17,22 +19,73 @@ METADATA_LOCK = threading.Lock()
 class DownloadingFSM(enumerate):
     META_DOWN, META_DONE, PIECE_FIND, PIECE_REQ, SEEDING = range(5)
 
+
+class BlockState(enumerate):
+    MISSING, REQUESTED, RECEIVED = range(3)
+
+
+class PieceDownload:
+    """Block bookkeeping of a single piece that is currently being downloaded."""
+
+    def __init__(self, piece_idx, piece_length, block_size):
+        self.piece_idx = piece_idx
+        self.piece_length = piece_length
+        self.block_requests = TorrentUtils.divide_piece_into_blocks(piece_idx, piece_length, block_size)
+        self.block_states = {begin: BlockState.MISSING for _, begin, _ in self.block_requests}
+        self.data = bytearray(piece_length)
+        self.received_blocks = 0
+        self.block_peers = dict()              # Peer that supplied each received block
+
+    def has_missing_blocks(self):
+        return any(state == BlockState.MISSING for state in self.block_states.values())
+
+    def request_next_block(self) -> tuple[int, int, int] | None:
+        """Mark the first missing block as requested and return its (index, begin, length) request."""
+        for request in self.block_requests:
+            begin = request[1]
+            if self.block_states[begin] == BlockState.MISSING:
+                self.block_states[begin] = BlockState.REQUESTED
+                return request
+        return None
+
+    def cancel_block_request(self, begin):
+        if self.block_states.get(begin) == BlockState.REQUESTED:
+            self.block_states[begin] = BlockState.MISSING
+
+    def add_block(self, begin, block, id) -> bool:
+        """Store a received block. Return False if the block is unexpected or already received."""
+        if self.block_states.get(begin, BlockState.RECEIVED) == BlockState.RECEIVED:
+            return False
+        if not (isinstance(block, memoryview) and block.obj is self.data):
+            # Blocks received in place by the message framer are already in data
+            self.data[begin:begin + len(block)] = block
+        self.block_states[begin] = BlockState.RECEIVED
+        self.block_peers[begin] = id
+        self.received_blocks += 1
+        return True
+
+    def is_complete(self):
+        return self.received_blocks == len(self.block_requests)
+
 class PieceManager:
-    def __init__(self, peer_list, metadata: dict, pieces: dict, client, piece_size=512*1024, block_size=64*1024, num_unchoked=4):
-        self.piece_size = piece_size
+    def __init__(self, peer_list, metadata: dict, pieces: set, client, storage_dir=None,
+                 piece_size=512*1024, block_size=BLOCK_SIZE, recheck_pieces=False):
+        self.piece_size = piece_size            # Replaced by the torrent's piece length once metadata is known
+        self.metadata_piece_size = piece_size   # Size of the metadata pieces exchanged with ut_metadata
         self.block_size = block_size
         self.metadata = metadata
-        self.pieces = pieces                    # Pieces the client holds
+        self.pieces = pieces                    # Indices of the pieces the client holds
         self.client = client
+        self.storage_dir = storage_dir          # Directory holding the torrent's files, download_dir/name by default
+        self.storage = None
+        self.recheck_pieces = recheck_pieces    # Hash the given pieces again before trusting them
 
-        self.peer_upload = {peer['id']: 0 for peer in peer_list}
+        self.peer_download_rates: dict[str, RateMeter] = dict()     # Rolling rate of the blocks received per peer
+        self.peer_upload_rates: dict[str, RateMeter] = dict()       # Rolling rate of the blocks sent per peer
 
-        self.num_unchoked = num_unchoked
-        self.unchoked_peers = []
-        self.optimistic_unchoked_peer = None
+        self.unchoked_peers = []                # Peers that unchoked us
 
         self.not_interest_peers = []
-        self.top_uploaders = []
 
         self.file_manager = None
         self.piece2file_map = None
@@ -47,27 +100,26 @@ class PieceManager:
         self.dl_mark = 0
         self.dl_speed = 0
 
-        threading.Thread(target=self.calculating_speed, daemon=True).start()
-
-        self.requesting_blocks = dict()
-        self.requesting_piece = None
-        self.number_of_blocks = -1
-        self.block_request_complete = None
-
+        self.downloading_pieces: dict[int, PieceDownload] = dict()      # Pieces that are partially downloaded
+        self.verifier = None
+        self.corrupt_peers = Counter()         # Number of pieces that failed verification per supplying peer
+        self.availability = PieceAvailability()
+        for peer in peer_list:
+            self.availability.add_peer(peer['id'])
 
         if metadata:
-            self.metadata_pieces, self.metadata_size = self.split_metadata_for_sharing(metadata, piece_size)
-            self.metadata_piece_count = self.metadata_size // piece_size + (1 if self.metadata_size % piece_size else 0)
+            self.metadata_pieces, self.metadata_size = self.split_metadata_for_sharing(metadata, self.metadata_piece_size)
+            self.metadata_piece_count = self.metadata_size // self.metadata_piece_size + \
+                (1 if self.metadata_size % self.metadata_piece_size else 0)
 
             self.number_of_pieces = len(self.metadata['pieces'])//20
-            self.piece_counter = {i: 0 for i in range(self.number_of_pieces)}
-            if pieces:
+            # The file manager comes first, as it drops the pieces that fail a recheck
+            self.init_file_manager()
+            self.availability.set_number_of_pieces(self.number_of_pieces, self.pieces)
+            if len(self.pieces) == self.number_of_pieces:
                 self.state = DownloadingFSM.SEEDING
             else:
                 self.state = DownloadingFSM.PIECE_FIND
-            self.peer_bitfields = {peer['id']: [0] * self.number_of_pieces for peer in peer_list}
-            self.init_file_manager()
-            threading.Thread(target=self.calculating_top_uploaders, daemon=True).start()
         else:
             self.state = DownloadingFSM.META_DOWN
             self.needed_metadata_pieces = None
@@ -77,8 +129,6 @@ class PieceManager:
             self.metadata_piece_count = None
 
             self.number_of_pieces = None
-            self.piece_counter = dict()             # Counter of pieces that held by the client
-            self.peer_bitfields = {peer['id']: [] for peer in peer_list}
 
 
     def is_seeding(self):
@@ -99,7 +149,7 @@ class PieceManager:
         if size is None:
             return None
         self.metadata_size = size
-        self.metadata_piece_count = size // self.piece_size + (1 if size % self.piece_size else 0)
+        self.metadata_piece_count = size // self.metadata_piece_size + (1 if size % self.metadata_piece_size else 0)
 
         self.needed_metadata_pieces = [True] * self.metadata_piece_count
         self.metadata_ongoing_requests = [False] * self.metadata_piece_count
@@ -132,12 +182,9 @@ class PieceManager:
         self.metadata = MagnetUtils.convert_to_normal_dict(self.metadata)
         self.number_of_pieces = len(self.metadata['pieces']) // 20
 
-        for peer in self.peer_bitfields:
-            if not self.peer_bitfields[peer]:
-                self.peer_bitfields[peer] = [0] * self.number_of_pieces
-        self.piece_counter = {i: self.piece_counter[i] for i in range(self.number_of_pieces)}
+        with PIECE_LOCK:
+            self.availability.set_number_of_pieces(self.number_of_pieces, self.pieces)
         self.init_file_manager()
-        threading.Thread(target=self.calculating_top_uploaders, daemon=True).start()
 
 
     # -------------------------------------------------
@@ -151,144 +198,179 @@ class PieceManager:
             return b""
 
         with PIECE_LOCK:
-            # Initialize a byte array with enough bytes to represent all pieces
-            bitfield = [0] * ((self.number_of_pieces + 7) // 8)  # One byte for every 8 pieces
+            return self.availability.get_bitfield()
 
-            # Set the corresponding bit for each piece
-            for piece_index in self.pieces.keys():
-                byte_index = piece_index // 8
-                bit_index = 7 - (piece_index % 8)
-                bitfield[byte_index] |= (1 << bit_index)
-        return bytes(bitfield)
+    def add_known_peer(self, id):
+        """Register a peer learned from the tracker before it is connected."""
+        with PIECE_LOCK:
+            if id not in self.availability.peer_bitfields:
+                self.availability.add_peer(id)
 
     def add_peer(self, id):
-        self.peer_bitfields[id] = [0] * self.number_of_pieces if self.number_of_pieces else []
-        self.peer_upload[id] = 0
-        self.optimistic_unchoked_peer = id
-
-    def add_peer_bitfield(self, id, bitfield: bytes, ip, port):
-        parsed_bitfield = []
-        for byte in bitfield:
-            for bit_position in range(8):
-                parsed_bitfield.append((byte >> (7 - bit_position)) & 1)
+        with PIECE_LOCK:
+            self.availability.add_peer(id)
 
-        parsed_bitfield = parsed_bitfield[:self.number_of_pieces]
-        self.peer_bitfields[id] = parsed_bitfield
-        self.client.log(f"Receive bitfield from peer {ip}, {port}: {parsed_bitfield}\n")
+    def remove_peer(self, id):
+        """Forget a peer whose connection closed: its pieces no longer count toward their availability."""
+        with PIECE_LOCK:
+            self.availability.remove_peer(id)
+            self.peer_download_rates.pop(id, None)
+            self.peer_upload_rates.pop(id, None)
+        self.remove_unchoked_peer(id)
+        while id in self.not_interest_peers:
+            self.not_interest_peers.remove(id)
 
+    def add_peer_bitfield(self, id, bitfield: bytes, ip, port):
         with PIECE_LOCK:
-            if not self.piece_counter:
-                self.number_of_pieces = len(parsed_bitfield)
-                self.piece_counter = {i: parsed_bitfield[i] for i in range(self.number_of_pieces)}
-            else:
-                for i in self.piece_counter.keys():
-                    self.piece_counter[i] += parsed_bitfield[i]
+            piece_count = self.availability.set_peer_bitfield(id, bitfield)
+        self.client.log(f"Receive bitfield from peer {ip}, {port}: {piece_count} pieces\n")
 
-    def find_next_rarest_piece(self) -> tuple[int, list]:
-        """Return the next rarest piece. Return None if all pieces are downloaded, return -1 if no pieces are available."""
+    def find_next_rarest_piece(self, peer_id=None, exclude=()) -> tuple[int, list]:
+        """Return the next rarest piece. Return None if all pieces are downloaded, return -1 if no pieces are available.
+        If peer_id is given, only pieces held by that peer are considered. Pieces in exclude are skipped.
+        """
         with PIECE_LOCK:
-            if not self.piece_counter:
+            if self.number_of_pieces is None or self.availability.is_complete():
                 return None, []
 
-            data = {k: v for (k, v) in self.piece_counter.items() if v > 0}
-            if not data:
+            idx = self.availability.pick_rarest_piece(peer_id, exclude)
+            if idx is None:
                 return -1, []
-            min_count = min(data.values())
-            idx_list = [k for k, v in data.items() if v == min_count]
-            idx = random.choice(idx_list)
-            peers = [id for (id, bitfield) in self.peer_bitfields.items() if bitfield[idx] == 1]
+            peers = self.availability.get_peers_with_piece(idx)
         return idx, peers
 
+    def peer_has_piece(self, id, piece_index):
+        return self.availability.peer_has_piece(id, piece_index)
+
+    def peer_has_needed_piece(self, id):
+        with PIECE_LOCK:
+            return self.availability.peer_has_needed_piece(id)
+
     def delete_piece(self, indices: int):
         with PIECE_LOCK:
-            self.piece_counter.pop(indices, None)
+            self.availability.add_have_piece(indices)
 
     def add_peer_piece(self, id, piece_index):
-        if self.peer_bitfields[id]:
-            self.peer_bitfields[id][piece_index] = 1
-
         with PIECE_LOCK:
-            if self.piece_counter.get(piece_index) is not None:
-                self.piece_counter[piece_index] += 1
-
-    def select_peers_for_unchoking(self) -> list:
-        list_peers = self.top_uploaders + [self.optimistic_unchoked_peer]
-        if len(list_peers) < self.num_unchoked + 1:
-            list_peers += self.not_interest_peers
-
-        return list(set(list_peers))
+            self.availability.add_peer_piece(id, piece_index)
 
     def get_unchoked_peers(self):
         return self.unchoked_peers
 
     def add_unchoked_peer(self, id):
-        self.unchoked_peers.append(id)
+        if id not in self.unchoked_peers:
+            self.unchoked_peers.append(id)
+
+    def remove_unchoked_peer(self, id):
+        if id in self.unchoked_peers:
+            self.unchoked_peers.remove(id)
 
     def add_not_interest_peers(self, id):
         self.not_interest_peers.append(id)
 
-    def calculating_top_uploaders(self):
-        optimistic_timer = 0
-        while True:
-            if not self.peer_upload:
-                continue
-            not_fully_downloaded_peers = list(set(self.peer_upload.keys()) - set(self.not_interest_peers))
-            peer_upload = {id: self.peer_upload[id] for id in not_fully_downloaded_peers}
-
-            if self.state == DownloadingFSM.SEEDING:
-                self.top_uploaders = random.sample(list(peer_upload.keys()), min(self.num_unchoked, len(peer_upload)))
-            else:
-                self.top_uploaders = [id for id, _ in Counter(peer_upload).most_common(self.num_unchoked)]
-
-            time.sleep(10)
-
-            optimistic_timer = (optimistic_timer + 10) % 30
-            if optimistic_timer == 0:
-                remaining_peers = list(set(peer_upload.keys()) - set(self.top_uploaders))
-                if remaining_peers:
-                    self.optimistic_unchoked_peer = random.choice(remaining_peers)
-                optimistic_timer = 0
-            self.client.log(f'\nRegular "calculating top uploaders" routine update {'-' * 10}\n\nTop uploaders: {self.client.get_peers(
-                self.top_uploaders)}\nOptimistic Unchoked Peer: {self.client.get_peers([self.optimistic_unchoked_peer])}\n{'-' * 61}\n\n')
-
     def calculating_speed(self):
-        while True:
-            self.up_mark = self.uploaded
-            self.dl_mark = self.downloaded
-            time.sleep(1)
-            self.up_speed = (self.uploaded - self.up_mark)
-            self.dl_speed = (self.downloaded - self.dl_mark)
+        """Called every second by the session's timer."""
+        self.up_speed = (self.uploaded - self.up_mark)
+        self.dl_speed = (self.downloaded - self.dl_mark)
+        self.up_mark = self.uploaded
+        self.dl_mark = self.downloaded
 
     # -------------------------------------------------
     # -------------------------------------------------
     # -------------------------------------------------
-    def get_block(self, piece_idx, begin, length):
+    def has_block(self, piece_idx, begin, length) -> bool:
+        """Whether a block can be uploaded: it lies within a piece that is held, and so verified."""
+        return piece_idx in self.pieces and length > 0 and begin + length <= self.get_piece_length(piece_idx)
+
+    def check_block(self, piece_idx, begin, length):
+        if not self.has_block(piece_idx, begin, length):
+            raise ValueError(f"Block {piece_idx}, {begin}, {length} is not in a held piece")
+
+    def get_block(self, piece_idx, begin, length, id=None):
+        """Read a block to upload. Raises ValueError for a block that is not in a held piece."""
+        self.check_block(piece_idx, begin, length)
+        self.add_uploaded(length, id)
+        return self.storage.read_block(piece_idx, begin, length)
+
+    def get_block_spans(self, piece_idx, begin, length, id=None) -> list[tuple[int, int, int]]:
+        """Like get_block, but return the (fd, offset, length) file spans of the block, to be sent with sendfile."""
+        self.check_block(piece_idx, begin, length)
+        self.add_uploaded(length, id)
+        return self.storage.get_file_spans(piece_idx, begin, length)
+
+    def add_uploaded(self, length, id=None):
         with PIECE_LOCK:
             self.uploaded += length
-        return self.pieces[piece_idx][begin:begin + length]
+        if id is not None:
+            self.get_rate_meter(self.peer_upload_rates, id).add(length)
 
-    def add_block_request(self, piece_idx, block_requests):
-        self.requesting_blocks = dict()
-        self.requesting_piece = piece_idx
-        self.number_of_blocks = len(block_requests)
+    def get_piece_length(self, piece_idx):
+        if piece_idx == self.number_of_pieces - 1:
+            return self.total_length - self.piece_size * (self.number_of_pieces - 1)
+        return self.piece_size
 
-    def add_block(self, id, start, block_data):
-        data_sz = len(block_data)
-        self.peer_upload[id] = data_sz
-        self.downloaded += data_sz
-        self.left -= data_sz
-        self.requesting_blocks[start] = block_data
+    def start_piece(self, piece_idx) -> PieceDownload:
+        piece = PieceDownload(piece_idx, self.get_piece_length(piece_idx), self.block_size)
+        self.downloading_pieces[piece_idx] = piece
+        return piece
 
-    def is_gathered_all_blocks(self):
-        return len(self.requesting_blocks.keys()) == self.number_of_blocks
+    def is_download_complete(self):
+        return self.number_of_pieces is not None and len(self.pieces) == self.number_of_pieces
 
-    def merge_blocks_to_piece(self):
-        self.unchoked_peers = []
-        piece_data = b''.join([self.requesting_blocks[i] for i in sorted(self.requesting_blocks.keys())])
-        self.pieces[self.requesting_piece] = piece_data
+    def add_block(self, id, piece_idx, start, block_data) -> bool:
+        """Store a received block. Return True if the block completes its piece."""
+        data_sz = len(block_data)
+        self.downloaded += data_sz
+        self.get_rate_meter(self.peer_download_rates, id).add(data_sz)
 
-        # update download progress
-        for file in self.piece2file_map[self.requesting_piece]:
+        piece = self.downloading_pieces.get(piece_idx)
+        if piece is None or not piece.add_block(start, block_data, id):
+            return False
+        self.left -= data_sz
+        return piece.is_complete()
+
+    def get_rate_meter(self, rate_meters: dict, id) -> RateMeter:
+        rate_meter = rate_meters.get(id)
+        if rate_meter is None:
+            rate_meter = rate_meters[id] = RateMeter()
+        return rate_meter
+
+    def get_download_rate(self, id) -> float | None:
+        """Rolling rate (bytes per second) of the blocks received from a peer, None if it sent none yet."""
+        rate_meter = self.peer_download_rates.get(id)
+        return rate_meter.get_rate() if rate_meter is not None else None
+
+    def get_upload_rate(self, id) -> float | None:
+        """Rolling rate (bytes per second) of the blocks sent to a peer, None if it was sent none yet."""
+        rate_meter = self.peer_upload_rates.get(id)
+        return rate_meter.get_rate() if rate_meter is not None else None
+
+    def verify_piece(self, piece_idx, callback):
+        """Hash a fully received piece on the verifier pool, then call callback(piece_idx, is_valid)."""
+        self.verifier.submit(piece_idx, self.downloading_pieces[piece_idx].data, callback)
+
+    def reject_piece(self, piece_idx) -> list:
+        """Drop a piece that failed verification so it is requested again. Return the peers that supplied it."""
+        piece = self.downloading_pieces.pop(piece_idx)
+        self.left += piece.piece_length
+        peers = list(set(piece.block_peers.values()))
+        for id in peers:
+            self.corrupt_peers[id] += 1
+        return peers
+
+    def write_piece(self, piece_idx):
+        """Write a verified piece to storage. All its blocks are received, so no other thread changes its data."""
+        self.storage.write_piece(piece_idx, self.downloading_pieces[piece_idx].data)
+
+    def merge_blocks_to_piece(self, piece_idx):
+        """Count a piece written by write_piece as held."""
+        self.downloading_pieces.pop(piece_idx)
+        self.pieces.add(piece_idx)
+        self.update_file_progress(piece_idx)
+        self.delete_piece(piece_idx)
+
+    def update_file_progress(self, piece_idx):
+        for file in self.piece2file_map[piece_idx]:
             length_in_file = file['length_in_file']
             file_key = file['file']
             file_length = self.file_manager[file_key]['length']
@@ -300,46 +382,48 @@ class PieceManager:
             self.file_manager[file_key]['downloaded'] += add_percentage
             self.file_manager[file_key]['remaining'] -= length_in_file
 
-        self.delete_piece(self.requesting_piece)
-
-    def merge_all_pieces(self, directory):
-        if sorted(self.pieces.keys()) != list(range(self.number_of_pieces)):
-            return None
-
-        all_pieces = [self.pieces[i] for i in sorted(self.pieces.keys())]
-        all_pieces = b''.join(all_pieces)
-
-        directory = os.path.join(directory, self.metadata['name'])
-        os.makedirs(directory, exist_ok=True)
-
-        global_len = 0
-        for file in self.metadata['files']:
-            file_path = os.path.join(directory, *file['path'])
-            os.makedirs(os.path.dirname(file_path), exist_ok=True)
-            with open(file_path, 'wb') as f:
-                f.write(all_pieces[global_len:global_len + file['length']])
-            global_len += file['length']
-
-        return all_pieces
-
     def init_file_manager(self):
+        self.piece_size = self.metadata['piece length']
+        if self.storage_dir is None:
+            self.storage_dir = os.path.join(self.client.download_dir, self.metadata['name'])
+        self.storage = PieceStorage(self.storage_dir, self.metadata['files'], self.piece_size,
+                                    preallocate=self.client.downloading)
+        self.verifier = PieceVerifier(self.metadata['pieces'], executor=self.client.session.io_executor)
+
         self.file_manager = dict()
-        self.piece2file_map = TorrentUtils.piece2file_map(self.metadata['files'], self.piece_size)
+        self.piece2file_map = self.storage.piece2file_map
 
         for file in self.metadata['files']:
             file_path = os.path.join(*file['path'])
             length = file['length']
             self.file_manager[file_path] = {
                 'length': length,
-                'downloaded': 1 if self.pieces != {} or length == 0 else 0,
-                'remaining': length if not self.pieces else 0
+                'downloaded': 1 if length == 0 else 0,
+                'remaining': length
             }
             self.total_length += length
 
-        if self.pieces:
-            self.downloaded = self.total_length
-        else:
-            self.left = self.total_length
+        if self.recheck_pieces:
+            self.recheck_stored_pieces()
+        for piece_idx in self.pieces:
+            self.update_file_progress(piece_idx)
+        self.downloaded = sum(self.get_piece_length(piece_idx) for piece_idx in self.pieces)
+        self.left = self.total_length - self.downloaded
+
+    def recheck_stored_pieces(self):
+        """Hash the pieces on disk in the verifier's pool and keep only those that still match."""
+        def check(piece_idx):
+            try:
+                return self.verifier.verify(piece_idx, self.storage.read_block(piece_idx, 0,
+                                                                               self.get_piece_length(piece_idx)))
+            except (OSError, ValueError):
+                return False
+
+        pieces = sorted(self.pieces)
+        valid = [piece_idx for piece_idx, is_valid in zip(pieces, self.verifier.executor.map(check, pieces))
+                 if is_valid]
+        self.pieces.intersection_update(valid)
+        self.client.log(f"Rechecked {len(pieces)} saved pieces, {len(valid)} are intact\n")
 
     def get_progress(self):
         if self.file_manager:
@@ -362,9 +446,9 @@ class PieceManager:
     def print_self_info(self):
         print(json.dumps({
             'state': self.state,
-            'piece_counter': self.piece_counter,
+            'piece_counter': self.availability.piece_counter.tolist(),
             'number_of_pieces': self.number_of_pieces,
-            'peer_bitfields': self.peer_bitfields,
+            'peer_bitfields': {id: bitfield.tobytes() for id, bitfield in self.availability.peer_bitfields.items()},
             'file_manager': self.file_manager,
             'piece2file_map': self.piece2file_map,
         }, indent=2, default=bytes_serializer))
@@ -0,0 +1,34 @@
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+
+class PieceVerifier:
+    """Checks completed pieces against the SHA-1 digests of the metadata.
+
+    Hashing runs on a pool of worker threads: hashlib releases the GIL while hashing, so pieces are
+    verified in parallel on multi-core machines without blocking the network threads.
+    """
+
+    def __init__(self, piece_hashes: bytes, max_workers=None, executor: ThreadPoolExecutor = None):
+        self.piece_hashes = piece_hashes
+        # A pool shared by the torrents of a session is left running on shutdown
+        self.owns_executor = executor is None
+        self.executor = executor or ThreadPoolExecutor(max_workers=max_workers or os.cpu_count(),
+                                                       thread_name_prefix='piece-verifier')
+
+    def get_piece_hash(self, piece_idx) -> bytes:
+        return self.piece_hashes[piece_idx * 20: piece_idx * 20 + 20]
+
+    def verify(self, piece_idx, data) -> bool:
+        return hashlib.sha1(data).digest() == self.get_piece_hash(piece_idx)
+
+    def submit(self, piece_idx, data, callback):
+        """Hash a piece in the pool and call callback(piece_idx, is_valid) from a worker thread."""
+        future = self.executor.submit(self.verify, piece_idx, data)
+        future.add_done_callback(lambda f: callback(piece_idx, f.result()))
+        return future
+
+    def shutdown(self):
+        if self.owns_executor:
+            self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,79 @@
+import threading
+import time
+
+from .utils import UPLOAD_RATE_LIMIT, DOWNLOAD_RATE_LIMIT
+
+
+class TokenBucket:
+    """Token bucket capping a transfer rate, in bytes per second. A rate of None means unlimited.
+
+    Transfers are charged after the fact and may drive the bucket into debt. The caller then waits until
+    the debt is paid back, so connections sharing a bucket are served in the order they transferred and
+    get an even share of the rate. The bucket holds at most burst bytes, one second of rate by default.
+    throttled_time is the total time the transfers charged to the bucket were made to wait, by any bucket.
+    """
+
+    def __init__(self, rate=None, burst=None):
+        self.lock = threading.Lock()
+        self.rate = None
+        self.burst = None
+        self.tokens = 0
+        self.last_update = time.monotonic()
+        self.throttled_time = 0
+        self.set_rate(rate, burst)
+        self.tokens = self.burst or 0
+
+    def set_rate(self, rate=None, burst=None):
+        """Change the rate at runtime. The transfers already waiting keep their delay."""
+        if rate is not None and rate <= 0:
+            raise ValueError("Rate limit must be positive, or None for unlimited.")
+        with self.lock:
+            self.refill(time.monotonic())
+            self.rate = rate
+            self.burst = burst if burst is not None else rate
+            if rate is not None:
+                self.tokens = min(self.tokens, self.burst)
+
+    def refill(self, now):
+        if self.rate is not None:
+            self.tokens = min(self.tokens + (now - self.last_update) * self.rate, self.burst)
+        self.last_update = now
+
+    def consume(self, nbytes) -> float:
+        """Charge nbytes to the bucket. Return the seconds to wait before transferring more."""
+        with self.lock:
+            if self.rate is None:
+                return 0
+            self.refill(time.monotonic())
+            self.tokens -= nbytes
+            return max(0, -self.tokens / self.rate)
+
+    def add_throttled_time(self, seconds):
+        with self.lock:
+            self.throttled_time += seconds
+
+
+# Shared by every torrent and every peer connection of the process
+GLOBAL_UPLOAD_BUCKET = TokenBucket(UPLOAD_RATE_LIMIT)
+GLOBAL_DOWNLOAD_BUCKET = TokenBucket(DOWNLOAD_RATE_LIMIT)
+
+
+def set_global_rate_limits(upload=None, download=None):
+    """Cap the upload and download rates (bytes per second) of the whole process. None means unlimited."""
+    GLOBAL_UPLOAD_BUCKET.set_rate(upload)
+    GLOBAL_DOWNLOAD_BUCKET.set_rate(download)
+
+
+class BandwidthLimiter:
+    """The buckets a connection's transfers in one direction are charged to: global, torrent and peer."""
+
+    def __init__(self, *buckets: TokenBucket):
+        self.buckets = buckets
+
+    def consume(self, nbytes) -> float:
+        """Charge nbytes to every bucket. Return the seconds to wait, set by the most limiting one."""
+        delay = max(bucket.consume(nbytes) for bucket in self.buckets)
+        if delay:
+            for bucket in self.buckets:
+                bucket.add_throttled_time(delay)
+        return delay
@@ -0,0 +1,39 @@
+import threading
+import time
+from collections import deque
+
+from .utils import RATE_WINDOW
+
+
+class RateMeter:
+    """Transfer rate over a sliding window of the last `window` seconds, kept in one-second buckets."""
+
+    def __init__(self, window=RATE_WINDOW):
+        self.window = window
+        self.buckets = deque()          # [second, bytes] of the seconds with traffic, oldest first
+        self.total = 0                  # Bytes in the window
+        self.created = time.time()
+        self.lock = threading.Lock()
+
+    def add(self, nbytes, now=None):
+        now = time.time() if now is None else now
+        second = int(now)
+        with self.lock:
+            if self.buckets and self.buckets[-1][0] == second:
+                self.buckets[-1][1] += nbytes
+            else:
+                self.buckets.append([second, nbytes])
+            self.total += nbytes
+            self.expire(second)
+
+    def expire(self, second):
+        while self.buckets and self.buckets[0][0] <= second - self.window:
+            self.total -= self.buckets.popleft()[1]
+
+    def get_rate(self, now=None) -> float:
+        """Bytes per second. A meter younger than the window is averaged over its lifetime."""
+        now = time.time() if now is None else now
+        with self.lock:
+            self.expire(int(now))
+            span = min(self.window - 1 + now % 1, now - self.created)
+            return self.total / max(span, 1)
@@ -0,0 +1,93 @@
+import os
+import threading
+
+import bencodepy
+
+from .utils import MagnetUtils
+
+
+class ResumeData:
+    """Fast-resume state of a torrent, kept as a bencoded file per info_hash.
+
+    It records the completed-piece bitfield, the size and mtime of every file, the metadata and the
+    last known peers, so a restarted client can skip the metadata download, the finished pieces and
+    the wait for the tracker.
+    """
+
+    def __init__(self, resume_dir, info_hash):
+        self.resume_dir = resume_dir
+        self.info_hash = info_hash
+        self.path = os.path.join(resume_dir, f'{info_hash}.resume')
+        self.lock = threading.Lock()
+
+    def load(self) -> dict | None:
+        """Return the saved state, or None if there is none. When a file is missing or its size or mtime
+        changed since the state was written, 'recheck' is set and the saved pieces must be hashed again."""
+        try:
+            with open(self.path, 'rb') as f:
+                data = bencodepy.decode(f.read())
+        except (OSError, bencodepy.DecodingError):
+            return None
+
+        try:
+            storage_dir = data[b'storage_dir'].decode('utf-8')
+            recheck = False
+            for file in data[b'files']:
+                file_path = os.path.join(storage_dir, *[e.decode('utf-8') for e in file[b'path']])
+                try:
+                    stat = os.stat(file_path)
+                except OSError:
+                    recheck = True
+                    continue
+                if stat.st_size != file[b'size'] or stat.st_mtime_ns != file[b'mtime']:
+                    recheck = True
+            metadata = MagnetUtils.convert_to_normal_dict(data[b'metadata'])
+            number_of_pieces = len(metadata['pieces']) // 20
+            bitfield = data[b'bitfield']
+            pieces = {i for i in range(number_of_pieces) if bitfield[i // 8] >> (7 - i % 8) & 1}
+            peers = [{'ip': peer[b'ip'].decode('utf-8'), 'port': peer[b'port']} for peer in data[b'peers']]
+        except (OSError, KeyError, IndexError, TypeError, ValueError):
+            return None
+
+        return {
+            'storage_dir': storage_dir,
+            'metadata': metadata,
+            'pieces': pieces,
+            'peers': peers,
+            'recheck': recheck,
+        }
+
+    def save(self, metadata: dict, pieces: set, storage_dir, peers: list[dict]):
+        """Write the state atomically. Sizes and mtimes are taken after the bitfield, so a file written
+        in between makes the saved pieces be hashed again on the next load."""
+        number_of_pieces = len(metadata['pieces']) // 20
+        bitfield = bytearray((number_of_pieces + 7) // 8)
+        for piece_index in list(pieces):
+            bitfield[piece_index // 8] |= 1 << (7 - piece_index % 8)
+
+        files = []
+        for file in metadata['files']:
+            stat = os.stat(os.path.join(storage_dir, *file['path']))
+            files.append({'path': file['path'], 'size': stat.st_size, 'mtime': stat.st_mtime_ns})
+
+        data = {
+            'info_hash': self.info_hash,
+            'metadata': metadata,
+            'bitfield': bytes(bitfield),
+            'files': files,
+            'storage_dir': os.path.abspath(storage_dir),
+            'peers': [{'ip': peer['ip'], 'port': peer['port']} for peer in peers],
+        }
+
+        with self.lock:
+            os.makedirs(self.resume_dir, exist_ok=True)
+            temp_path = self.path + '.tmp'
+            with open(temp_path, 'wb') as f:
+                f.write(bencodepy.encode(data))
+            os.replace(temp_path, self.path)
+
+    def delete(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
@@ -0,0 +1,51 @@
+import math
+
+from .utils import PIPELINE_DEPTH, MAX_PIPELINE_DEPTH, REQUEST_QUEUE_TIME
+
+
+class BlockScheduler:
+    """Strategy of the download engine: how many block requests each unchoked peer may have outstanding,
+    and in which order peers are given new requests. rate is the peer's measured download rate in bytes
+    per second, or None before it delivered anything.
+    """
+
+    def get_pipeline_depth(self, id, rate: float | None, block_size) -> int:
+        raise NotImplementedError
+
+    def order_peers(self, peers: list, rates: dict) -> list:
+        return list(peers)
+
+
+class FixedDepthScheduler(BlockScheduler):
+    """The same number of outstanding requests for every peer, whatever its speed."""
+
+    def __init__(self, pipeline_depth=PIPELINE_DEPTH):
+        self.pipeline_depth = pipeline_depth
+
+    def get_pipeline_depth(self, id, rate, block_size) -> int:
+        return self.pipeline_depth
+
+
+class RateWeightedScheduler(BlockScheduler):
+    """Requests in proportion to each peer's throughput.
+
+    A peer is kept busy with REQUEST_QUEUE_TIME seconds worth of blocks at its measured rate, so a fast peer
+    gets proportionally more blocks than a slow one and no peer sits on blocks it takes long to deliver.
+    The fastest peers are served first.
+    """
+
+    def __init__(self, initial_depth=PIPELINE_DEPTH, max_depth=MAX_PIPELINE_DEPTH, queue_time=REQUEST_QUEUE_TIME,
+                 min_depth=2):
+        self.initial_depth = initial_depth
+        self.max_depth = max_depth
+        self.min_depth = min_depth
+        self.queue_time = queue_time
+
+    def get_pipeline_depth(self, id, rate, block_size) -> int:
+        if rate is None:
+            return self.initial_depth
+        depth = math.ceil(rate * self.queue_time / block_size)
+        return min(max(depth, self.min_depth), self.max_depth)
+
+    def order_peers(self, peers, rates) -> list:
+        return sorted(peers, key=lambda id: rates.get(id) or 0, reverse=True)
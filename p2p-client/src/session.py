@@ -0,0 +1,188 @@
+import asyncio
+import os
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from .async_peer_connection import run_in_event_loop
+from .connection_manager import ConnectionLimits
+from .rate_limiter import set_global_rate_limits
+from .udp_tracker import UDPTrackerClient
+from .utils import TorrentUtils, PeerEngine, PEER_ENGINE, MAX_CONNECTIONS, MAX_HALF_OPEN, CONNECT_TIMEOUT, \
+    ANNOUNCE_WORKERS
+
+HANDSHAKE_LENGTH = 68
+
+
+class Session:
+    """What the torrents of a process share: one listening socket per address family, the peer engine,
+    the rate limits, the connection limits, the pools that hash and write pieces, open connections and
+    announce to the trackers, the trackers' keep-alive HTTP connections and UDP connection ids, and the
+    timer thread of their periodic work.
+
+    Incoming connections are handed to the torrent named by the info_hash of their handshake, so any number
+    of torrents is served on a single port. Torrents are added with add_torrent.
+    """
+
+    def __init__(self, ip, port, engine=PEER_ENGINE, upload_limit=None, download_limit=None, io_workers=None,
+                 max_connections=MAX_CONNECTIONS, max_half_open=MAX_HALF_OPEN):
+        self.ip = ip
+        self.port = port
+        self.engine = PeerEngine(engine)
+        self.torrents: dict[str, 'TorrentClient'] = dict()      # By info_hash
+        self.lock = threading.Lock()
+        self.connection_limits = ConnectionLimits(max_connections, max_half_open)
+        self.io_executor = ThreadPoolExecutor(max_workers=io_workers or os.cpu_count(),
+                                              thread_name_prefix='piece-io')
+        # Outgoing connections of the threaded engine are opened here, never more at a time than are half-open
+        self.connect_executor = ThreadPoolExecutor(max_workers=max_half_open, thread_name_prefix='peer-connect')
+        self.announce_executor = ThreadPoolExecutor(max_workers=ANNOUNCE_WORKERS, thread_name_prefix='tracker-announce')
+        # Announces reuse the connections to a tracker instead of opening one each
+        self.http_session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=ANNOUNCE_WORKERS)
+        self.http_session.mount('http://', adapter)
+        self.http_session.mount('https://', adapter)
+        self.udp_tracker = UDPTrackerClient()
+        if upload_limit is not None or download_limit is not None:
+            self.set_rate_limits(upload_limit, download_limit)
+
+        if self.engine == PeerEngine.ASYNCIO:
+            run_in_event_loop(self.start_async_servers()).result()
+        else:
+            for family in (socket.AF_INET, socket.AF_INET6):
+                threading.Thread(target=self.listen_for_connections, args=(family,), daemon=True).start()
+        threading.Thread(target=self.run_timer, daemon=True).start()
+
+    # -------------------------------------------------
+
+    def add_torrent(self, **kwargs) -> 'TorrentClient':
+        """Create a torrent client on the session, with the arguments of TorrentClient but ip, port and engine."""
+        from .client import TorrentClient
+        return TorrentClient(self.ip, self.port, engine=self.engine, session=self, **kwargs)
+
+    def register_torrent(self, client):
+        """Route the incoming connections for the client's info_hash to it. Called by the client when ready."""
+        with self.lock:
+            self.torrents[client.info_hash] = client
+
+    def remove_torrent(self, info_hash):
+        with self.lock:
+            return self.torrents.pop(info_hash, None)
+
+    def get_torrent(self, info_hash):
+        with self.lock:
+            return self.torrents.get(info_hash)
+
+    def run_timer(self):
+        """Drive the once-a-second work of every torrent: transfer speeds, rechoke rounds, reconnections and
+        announces."""
+        while True:
+            time.sleep(1)
+            with self.lock:
+                torrents = list(self.torrents.values())
+            for client in torrents:
+                try:
+                    client.piece_manager.calculating_speed()
+                    client.choker.on_timer()
+                    client.connection_manager.on_timer()
+                    client.announcer.on_timer()
+                except Exception as e:
+                    client.log(f"Error in the periodic work of the torrent: {e}\n")
+
+    def set_rate_limits(self, upload=None, download=None):
+        """Cap the upload and download rates (bytes per second) of all torrents together. None means unlimited."""
+        set_global_rate_limits(upload, download)
+
+    # ----------------- Server socket -----------------
+
+    def create_server_socket(self, family) -> socket.socket:
+        server_socket = socket.socket(family, socket.SOCK_STREAM)
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if family == socket.AF_INET6:
+            server_socket.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)
+        server_socket.bind(('', self.port))
+        server_socket.listen()
+        return server_socket
+
+    def listen_for_connections(self, family):
+        """Accept connections of an address family and route each one once its handshake is in (threaded engine)."""
+        server_socket = self.create_server_socket(family)
+
+        while True:
+            try:
+                conn, addr = server_socket.accept()
+                if not self.connection_limits.try_accept():
+                    conn.close()
+                    continue
+                threading.Thread(target=self.route_connection, args=(conn, *addr[:2]), daemon=True).start()
+            except Exception as e:
+                print(f"Error accepting connection: {e}")
+
+    def route_connection(self, conn: socket.socket, ip, port):
+        conn.settimeout(CONNECT_TIMEOUT)
+        try:
+            handshake = TorrentUtils.receive_handshake(conn, HANDSHAKE_LENGTH)
+        except OSError as e:
+            print(f"Error receiving handshake from {ip} : {port}: {e}")
+            conn.close()
+            self.connection_limits.connection_closed()
+            return
+        client = self.get_torrent(TorrentUtils.get_handshake_info_hash(handshake))
+        if client is None:
+            conn.close()
+            self.connection_limits.connection_closed()
+            return
+        client.handle_peer_connection(conn, ip, port, handshake)
+
+    async def start_async_servers(self):
+        """Accept IPv4 and IPv6 connections on the shared event loop (asyncio engine)."""
+        loop = asyncio.get_running_loop()
+        for family in (socket.AF_INET, socket.AF_INET6):
+            await loop.create_server(lambda: HandshakeRouter(self), sock=self.create_server_socket(family))
+
+
+class HandshakeRouter(asyncio.Protocol):
+    """First protocol of an incoming connection on the asyncio engine. Once the handshake is in, the transport
+    is handed to a new connection of the torrent it names, along with the bytes received so far and the
+    connection slot taken for it.
+    """
+
+    def __init__(self, session: Session):
+        self.session = session
+        self.transport: asyncio.Transport | None = None
+        self.data = bytearray()
+        self.holds_slot = False
+        self.timeout: asyncio.TimerHandle | None = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        if not self.session.connection_limits.try_accept():
+            transport.close()
+            return
+        self.holds_slot = True
+        self.timeout = asyncio.get_running_loop().call_later(CONNECT_TIMEOUT, transport.close)
+
+    def data_received(self, data):
+        self.data += data
+        if len(self.data) < HANDSHAKE_LENGTH or self.transport.is_closing():
+            return
+        client = self.session.get_torrent(TorrentUtils.get_handshake_info_hash(self.data))
+        if client is None or not client.connection_manager.can_accept():
+            self.transport.close()
+            return
+        self.timeout.cancel()
+        self.holds_slot = False
+        connection = client.accept_async_peer_connection()
+        self.transport.set_protocol(connection)
+        connection.connection_made(self.transport)
+        connection.feed(bytes(self.data))
+
+    def connection_lost(self, exc):
+        if self.timeout is not None:
+            self.timeout.cancel()
+        if self.holds_slot:
+            self.session.connection_limits.connection_closed()
@@ -0,0 +1,115 @@
+import mmap
+import os
+import threading
+
+from .utils import TorrentUtils
+
+
+class PieceStorage:
+    """Disk-backed piece store. Pieces are written straight into the torrent's files, at the offsets
+    given by the piece-to-file map. Blocks are served from read-only memory maps of the files, so
+    seeding reads straight from the page cache without loading the files into memory.
+    """
+
+    def __init__(self, root_dir, files: list[dict], piece_size, preallocate=True):
+        self.root_dir = root_dir
+        self.files = files
+        self.piece_size = piece_size
+        self.piece2file_map = TorrentUtils.piece2file_map(files, piece_size)
+        self.writable = preallocate
+
+        self.file_handles = dict()
+        self.file_maps: dict[str, mmap.mmap] = dict()
+        self.lock = threading.Lock()
+
+        if preallocate:
+            self.preallocate_files()
+
+    def get_file_path(self, file_key):
+        return os.path.join(self.root_dir, file_key)
+
+    def preallocate_files(self):
+        """Create every file of the torrent with its final size, so pieces can be written in any order."""
+        for file in self.files:
+            file_path = self.get_file_path(os.path.join(*file['path']))
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            with open(file_path, 'ab') as f:
+                if f.tell() != file['length']:
+                    f.truncate(file['length'])
+
+    def get_file_handle(self, file_key):
+        handle = self.file_handles.get(file_key)
+        if handle is None:
+            # Unbuffered, so written pieces are visible through the memory maps right away
+            handle = open(self.get_file_path(file_key), 'r+b' if self.writable else 'rb', buffering=0)
+            self.file_handles[file_key] = handle
+        return handle
+
+    def get_file_map(self, file_key) -> mmap.mmap:
+        file_map = self.file_maps.get(file_key)
+        if file_map is None:
+            with self.lock:
+                file_map = self.file_maps.get(file_key)
+                if file_map is None:
+                    handle = self.get_file_handle(file_key)
+                    file_map = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+                    self.file_maps[file_key] = file_map
+        return file_map
+
+    def iter_spans(self, piece_idx, begin, length):
+        """Yield (file_key, offset_in_file, length) spans covering [begin, begin + length) of a piece."""
+        piece_offset = 0
+        end = begin + length
+        for span in self.piece2file_map[piece_idx]:
+            span_start = max(begin, piece_offset)
+            span_end = min(end, piece_offset + span['length_in_file'])
+            if span_start < span_end:
+                offset = span['offset_in_file'] + span_start - piece_offset
+                yield span['file'], offset, span_end - span_start
+            piece_offset += span['length_in_file']
+            if piece_offset >= end:
+                break
+
+    def write_piece(self, piece_idx, data):
+        """Write a complete piece to its file spans."""
+        view = memoryview(data)
+        position = 0
+        with self.lock:
+            for file_key, offset, length in self.iter_spans(piece_idx, 0, len(data)):
+                handle = self.get_file_handle(file_key)
+                handle.seek(offset)
+                handle.write(view[position:position + length])
+                position += length
+
+    def get_file_spans(self, piece_idx, begin, length) -> list[tuple[int, int, int]]:
+        """Return the (fd, offset_in_file, length) spans of a block, for sending it with sendfile."""
+        with self.lock:
+            return [(self.get_file_handle(file_key).fileno(), offset, span_length)
+                    for file_key, offset, span_length in self.iter_spans(piece_idx, begin, length)]
+
+    def read_block(self, piece_idx, begin, length) -> memoryview | bytes:
+        """Read a block of a piece from the memory-mapped files.
+        A block that lies within a single file is returned as a zero-copy memoryview of the map.
+        """
+        chunks = [memoryview(self.get_file_map(file_key))[offset:offset + span_length]
+                  for file_key, offset, span_length in self.iter_spans(piece_idx, begin, length)]
+        if len(chunks) == 1:
+            return chunks[0]
+        return b''.join(chunks)
+
+    def flush(self):
+        with self.lock:
+            for handle in self.file_handles.values():
+                handle.flush()
+
+    def close(self):
+        with self.lock:
+            for file_map in self.file_maps.values():
+                try:
+                    file_map.close()
+                except BufferError:     # A block is still referenced, the map is released with it
+                    pass
+            for handle in self.file_handles.values():
+                handle.close()
+            self.file_maps = dict()
+            self.file_handles = dict()
@@ -1,3 +1,10 @@
 from .magnet_utils import MagnetUtils
 from .torrent_utils import TorrentUtils
-from .config import MessageType, ExtensionMessageType, INIT_STRING
+from .torrent_creator import TorrentCreator, choose_piece_size
+from .config import MessageType, ExtensionMessageType, PeerEngine, INIT_STRING, PIPELINE_DEPTH, MAX_PIPELINE_DEPTH, \
+    REQUEST_QUEUE_TIME, RATE_WINDOW, MAX_ACTIVE_PIECES, REQUEST_TIMEOUT_MIN, REQUEST_TIMEOUT_MAX, \
+    REQUEST_TIMEOUT_FACTOR, SNUB_TIMEOUTS, NUM_UNCHOKED, RECHOKE_INTERVAL, OPTIMISTIC_UNCHOKE_ROUNDS, \
+    UPLOAD_RATE_LIMIT, DOWNLOAD_RATE_LIMIT, USE_SENDFILE, MAX_CONNECTIONS, MAX_HALF_OPEN, \
+    MAX_TORRENT_CONNECTIONS, CONNECT_TIMEOUT, RECONNECT_BACKOFF_MIN, RECONNECT_BACKOFF_MAX, ANNOUNCE_INTERVAL, \
+    ANNOUNCE_MIN_INTERVAL, ANNOUNCE_RETRY_MIN, ANNOUNCE_RETRY_MAX, TRACKER_TIMEOUT, ANNOUNCE_WORKERS, PEER_ENGINE, \
+    ANNOUNCE_NUMWANT, UDP_TRACKER_RETRIES, RESUME_DIR, RESUME_SAVE_INTERVAL, BLOCK_SIZE, MAX_REQUEST_LENGTH
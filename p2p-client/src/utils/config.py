@@ -1,3 +1,4 @@
+import os
 from enum import Enum
 
 
@@ -21,5 +22,82 @@ class ExtensionMessageType(Enum):
     REJECT = 2
 
 
+class PeerEngine(Enum):
+    THREADED = 'threaded'     # Two threads per peer connection, blocking sockets
+    ASYNCIO = 'asyncio'       # Every connection on one shared event loop thread
+
+
+# Size of the blocks requested from peers. Peers may ask for blocks of up to MAX_REQUEST_LENGTH, longer REQUEST
+# and CANCEL messages are dropped
+BLOCK_SIZE = 16 * 1024
+MAX_REQUEST_LENGTH = 16 * 1024
+# Number of block requests kept in flight per peer
+PIPELINE_DEPTH = 64
+# Bounds of the per-peer pipeline of the rate-weighted scheduler, which keeps REQUEST_QUEUE_TIME seconds of
+# blocks outstanding at each peer's measured rate
+MAX_PIPELINE_DEPTH = 512
+REQUEST_QUEUE_TIME = 2
+# Window (seconds) of the rolling transfer rates
+RATE_WINDOW = 5
+# Number of pieces that may be partially downloaded at the same time
+MAX_ACTIVE_PIECES = 16
+# Seconds a block request may stay unanswered. Peers with a measured latency get REQUEST_TIMEOUT_FACTOR times it,
+# within these bounds
+REQUEST_TIMEOUT_MIN = 2
+REQUEST_TIMEOUT_MAX = 20
+REQUEST_TIMEOUT_FACTOR = 4
+# Consecutive request timeouts after which a peer is snubbed: it is sent a single request at a time
+SNUB_TIMEOUTS = 2
+# Regular upload slots, given to the interested peers with the best rate every RECHOKE_INTERVAL seconds. One more
+# slot, the optimistic unchoke, moves to another peer every OPTIMISTIC_UNCHOKE_ROUNDS rechoke rounds
+NUM_UNCHOKED = 4
+RECHOKE_INTERVAL = 10
+OPTIMISTIC_UNCHOKE_ROUNDS = 3
+
+# Default rate limits (bytes per second) of the whole process, None for unlimited. Torrents and peers can be
+# capped further at runtime
+UPLOAD_RATE_LIMIT = None
+DOWNLOAD_RATE_LIMIT = None
+
+# Send the blocks uploaded by the threaded engine from the files to the sockets with sendfile. Otherwise they are
+# written with sendmsg from the files' memory maps
+USE_SENDFILE = True
+
+# Peer connections of a session, all torrents together, and connection attempts in progress at a time. Each torrent
+# keeps at most MAX_TORRENT_CONNECTIONS of them
+MAX_CONNECTIONS = 200
+MAX_HALF_OPEN = 8
+MAX_TORRENT_CONNECTIONS = 50
+# Seconds a connection attempt may take, the handshake included
+CONNECT_TIMEOUT = 10
+# Delay (seconds) before a peer is connected again after a failed attempt or a disconnection. It doubles with
+# every failure in a row, up to RECONNECT_BACKOFF_MAX
+RECONNECT_BACKOFF_MIN = 5
+RECONNECT_BACKOFF_MAX = 600
+
+# Announces to the tracker. ANNOUNCE_INTERVAL (seconds) is used until the tracker gives an interval, and
+# ANNOUNCE_MIN_INTERVAL bounds the early announces of a torrent without peers when it gives no min interval.
+# A failed announce is retried after ANNOUNCE_RETRY_MIN seconds, doubling up to ANNOUNCE_RETRY_MAX
+ANNOUNCE_INTERVAL = 1800
+ANNOUNCE_MIN_INTERVAL = 30
+ANNOUNCE_RETRY_MIN = 15
+ANNOUNCE_RETRY_MAX = 1800
+# Seconds a tracker may take to answer, and announces of a session in progress at a time, which is also the number
+# of keep-alive connections kept open to each tracker
+TRACKER_TIMEOUT = 15
+ANNOUNCE_WORKERS = 4
+# Peers asked for in an announce
+ANNOUNCE_NUMWANT = 50
+# Times a request to a udp:// tracker is sent again when it gets no answer, waiting twice as long each time
+UDP_TRACKER_RETRIES = 2
+
+# Networking engine of the peer connections
+PEER_ENGINE = PeerEngine.THREADED
+
+# Fast-resume files, one per info_hash, and how often (seconds) they are rewritten while downloading
+RESUME_DIR = os.path.join(os.path.expanduser('~'), '.p2p-client', 'resume')
+RESUME_SAVE_INTERVAL = 5
+
+
 INIT_STRING = "----------- Simple BitTorrent Application ----------\n"
 INIT_STRING += '-' * len(INIT_STRING) + '--' + '\n\n\n'
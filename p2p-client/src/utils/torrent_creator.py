@@ -0,0 +1,160 @@
+import hashlib
+import math
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, wait
+from queue import Empty
+
+MIN_PIECE_SIZE = 256 * 1024
+MAX_PIECE_SIZE = 16 * 1024 * 1024
+TARGET_PIECE_COUNT = 1500
+PIECES_PER_TASK = 64
+PROGRESS_INTERVAL = 0.1         # Seconds between progress reports while the worker processes hash
+
+worker_progress_queue = None    # Set in each worker process, the size of every hashed piece is put on it
+
+
+def choose_piece_size(total_length) -> int:
+    """Pick a power-of-two piece size that gives roughly TARGET_PIECE_COUNT pieces."""
+    if total_length <= 0:
+        return MIN_PIECE_SIZE
+    piece_size = 2 ** math.ceil(math.log2(max(total_length / TARGET_PIECE_COUNT, 1)))
+    return min(max(piece_size, MIN_PIECE_SIZE), MAX_PIECE_SIZE)
+
+
+def hash_piece_range(file_list: list[tuple[str, int]], piece_size, start, end, progress=None) -> bytes:
+    """Hash the pieces covering bytes [start, end) of the concatenated files, reading one piece-sized
+    window at a time. progress(length) is called with the length of every hashed piece.
+    """
+    pieces_hash = []
+    piece_hash, piece_filled = hashlib.sha1(), 0
+    file_offset = 0
+    for path, length in file_list:
+        file_start, file_end = max(start, file_offset), min(end, file_offset + length)
+        if file_start < file_end:
+            with open(path, 'rb') as f:
+                f.seek(file_start - file_offset)
+                remaining = file_end - file_start
+                while remaining:
+                    chunk = f.read(min(piece_size - piece_filled, remaining))
+                    if not chunk:
+                        raise IOError(f"File {path} changed while hashing")
+                    piece_hash.update(chunk)
+                    piece_filled += len(chunk)
+                    remaining -= len(chunk)
+                    if piece_filled == piece_size:
+                        pieces_hash.append(piece_hash.digest())
+                        if progress is not None:
+                            progress(piece_filled)
+                        piece_hash, piece_filled = hashlib.sha1(), 0
+        file_offset += length
+        if file_offset >= end:
+            break
+    if piece_filled:
+        pieces_hash.append(piece_hash.digest())
+        if progress is not None:
+            progress(piece_filled)
+    return b''.join(pieces_hash)
+
+
+def init_worker(progress_queue):
+    global worker_progress_queue
+    worker_progress_queue = progress_queue
+
+
+def hash_piece_range_in_worker(file_list: list[tuple[str, int]], piece_size, start, end) -> bytes:
+    return hash_piece_range(file_list, piece_size, start, end, worker_progress_queue.put)
+
+
+class TorrentCreator:
+    """Builds the info dictionary of a file or folder.
+
+    The content is split into ranges of PIECES_PER_TASK pieces that are hashed in parallel worker
+    processes, each streaming its range from disk, so memory stays bounded whatever the size. The workers
+    are spawned rather than forked, as the creating process may be a GUI with threads of its own.
+    progress_callback(hashed_bytes, total_bytes) is called from the creating thread as pieces are hashed,
+    at most every PROGRESS_INTERVAL while the workers run.
+    """
+
+    def __init__(self, file_path, piece_size=None, max_workers=None, progress_callback=None):
+        self.file_path = os.path.normpath(file_path)
+        self.files, self.file_paths = self.list_files(self.file_path)
+        self.total_length = sum(file['length'] for file in self.files)
+        self.piece_size = piece_size or choose_piece_size(self.total_length)
+        self.max_workers = max_workers or os.cpu_count()
+        self.progress_callback = progress_callback
+
+    @staticmethod
+    def list_files(file_path) -> tuple[list[dict], list[str]]:
+        """Return the 'files' entries of the info dictionary and the matching paths on disk."""
+        def generate_file_dictionary(root, path: str):
+            length = os.path.getsize(path)
+            path = os.path.relpath(path, root).split(os.sep)
+            if path == [os.curdir]:
+                path = [os.path.basename(root)]
+            return {
+                'length': length,
+                'path': path
+            }
+
+        if os.path.isdir(file_path):
+            files, file_paths = [], []
+            for root, dirnames, file_names in os.walk(file_path):
+                for file_name in file_names:
+                    p = os.path.join(root, file_name)
+                    files.append(generate_file_dictionary(file_path, p))
+                    file_paths.append(p)
+        else:
+            files = [generate_file_dictionary(file_path, file_path)]
+            file_paths = [file_path]
+        return files, file_paths
+
+    def create(self) -> dict:
+        file_list = [(path, file['length']) for path, file in zip(self.file_paths, self.files)]
+        task_size = self.piece_size * PIECES_PER_TASK
+        ranges = [(start, min(start + task_size, self.total_length))
+                  for start in range(0, self.total_length, task_size)]
+
+        results = dict()
+        hashed_bytes = 0
+        self.report_progress(hashed_bytes)
+        if len(ranges) <= 1 or self.max_workers <= 1:
+            def piece_hashed(length):
+                nonlocal hashed_bytes
+                hashed_bytes += length
+                self.report_progress(hashed_bytes)
+
+            for start, end in ranges:
+                results[start] = hash_piece_range(file_list, self.piece_size, start, end, piece_hashed)
+        else:
+            context = multiprocessing.get_context('spawn')
+            progress_queue = context.Queue()
+            with ProcessPoolExecutor(max_workers=min(self.max_workers, len(ranges)), mp_context=context,
+                                     initializer=init_worker, initargs=(progress_queue,)) as executor:
+                futures = {executor.submit(hash_piece_range_in_worker, file_list, self.piece_size, start, end): start
+                           for start, end in ranges}
+                pending = set(futures)
+                while pending:
+                    done, pending = wait(pending, timeout=PROGRESS_INTERVAL)
+                    for future in done:
+                        results[futures[future]] = future.result()
+                    try:
+                        while True:
+                            hashed_bytes += progress_queue.get_nowait()
+                    except Empty:
+                        pass
+                    self.report_progress(min(hashed_bytes, self.total_length))
+            progress_queue.close()
+            # Sizes still in the queue's pipe when the last range finished are not waited for
+            self.report_progress(self.total_length)
+
+        return {
+            'piece length': self.piece_size,
+            'pieces': b''.join(results[start] for start, _ in ranges),
+            'name': os.path.basename(self.file_path),
+            'files': self.files
+        }
+
+    def report_progress(self, hashed_bytes):
+        if self.progress_callback is not None:
+            self.progress_callback(hashed_bytes, self.total_length)
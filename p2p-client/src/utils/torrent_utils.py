@@ -4,6 +4,9 @@ import socket
 import struct
 import bencodepy
 
+from .torrent_creator import TorrentCreator
+from .config import BLOCK_SIZE
+
 class TorrentUtilsClass:
     @staticmethod
     def generate_peer_id(ip=None, port=None) -> str:
@@ -143,9 +146,29 @@ class TorrentUtilsClass:
 
     @staticmethod
     def receive_and_validate_handshake(sock, info_hash):
-        handshake = sock.recv(68)
+        handshake = TorrentUtilsClass.receive_handshake(sock)
+        return TorrentUtilsClass.validate_handshake(handshake, info_hash)
+
+    @staticmethod
+    def receive_handshake(sock, length=68) -> bytes:
+        """Receive the complete handshake that opens a connection."""
+        handshake = bytearray()
+        while len(handshake) < length:
+            chunk = sock.recv(length - len(handshake))
+            if not chunk:
+                raise ConnectionError("Connection closed during the handshake.")
+            handshake += chunk
+        return bytes(handshake)
+
+    @staticmethod
+    def get_handshake_info_hash(handshake: bytes) -> str:
+        """Return the info_hash a handshake is for, used to route incoming connections to their torrent."""
+        return bytes(handshake[28:48]).hex()
+
+    @staticmethod
+    def validate_handshake(handshake: bytes, info_hash):
         extension_supported = bool(handshake[25] & 0x10)
-        handshake_info_hash = handshake[28:48].hex()
+        handshake_info_hash = TorrentUtilsClass.get_handshake_info_hash(handshake)
         peer_id = handshake[48:].hex()
 
         if handshake_info_hash != info_hash:
@@ -153,7 +176,7 @@ class TorrentUtilsClass:
         return extension_supported, peer_id
 
     @staticmethod
-    def divide_piece_into_blocks(piece_index, piece_size, block_size=64*1024):
+    def divide_piece_into_blocks(piece_index, piece_size, block_size=BLOCK_SIZE):
         """
         Divide a piece into blocks and prepare request arguments for each block.
         """
@@ -168,59 +191,30 @@ class TorrentUtilsClass:
         return args_list
 
     @staticmethod
-    def generate_info_dictionary(file_path, piece_size=512*1024) -> tuple[dict, dict]:
-        """Generate the info dictionary and pieces used for downloading"""
-        def generate_file_dictionary(root, path: str):
-            length = os.path.getsize(path)
-            path = path.split(os.sep)
-            path.remove(root)
-            if path == []:
-                path = [os.path.basename(root)]
-            return {
-                'length': length,
-                'path': path
-            }
-
-        pieces = b''
-        if os.path.isdir(file_path):
-            files = []
-            for root, dirnames, file_names in os.walk(file_path):
-                for file_name in file_names:
-                    p = os.path.join(root, file_name)
-                    files.append(generate_file_dictionary(file_path, p))
-
-                    file_content = open(p, 'rb').read()
-                    pieces += file_content
-        else:
-            files = [generate_file_dictionary(file_path, file_path)]
-            pieces = open(file_path, 'rb').read()
-
-        pieces_dict = dict(enumerate(pieces[i:i+piece_size] for i in range(0, len(pieces), piece_size)))
-        pieces_hash = b''.join([hashlib.sha1(pieces_dict[k]).digest() for k in sorted(pieces_dict.keys())])
-
-        metadata = {
-            'piece length': piece_size,
-            'pieces': pieces_hash,
-            'name': os.path.basename(file_path),
-            'files': files
-        }
-
-        return metadata, pieces_dict
+    def generate_info_dictionary(file_path, piece_size=None, progress_callback=None) -> dict:
+        """Generate the info dictionary used for downloading. Pieces are hashed in parallel by TorrentCreator,
+        the piece size is chosen from the total size when not given.
+        """
+        return TorrentCreator(file_path, piece_size, progress_callback=progress_callback).create()
 
-    def parse_uploaded_torrent(self, uploader_info: dict, piece_size=512*1024) -> tuple[str, dict, dict]:
-        """ Parse the uploaded torrent information and return metadata and pieces"""
+    def parse_uploaded_torrent(self, uploader_info: dict, piece_size=None) -> tuple[str, str, str, dict]:
+        """ Parse the uploaded torrent information and return info_hash, tracker_url, display_name, metadata.
+        The info dictionary is generated unless it was already created (e.g. by the torrent creator dialog).
+        """
         tracker_url = uploader_info['tracker_url']
         save_torrent_dir = uploader_info['save_torrent_dir']
         upload_dir = uploader_info['upload_dir']
 
-        metadata, pieces_dict = self.generate_info_dictionary(upload_dir, piece_size)
+        metadata = uploader_info.get('metadata')
+        if metadata is None:
+            metadata = self.generate_info_dictionary(upload_dir, uploader_info.get('piece_size', piece_size))
         torrent_file = self.generate_torrent_file(tracker_url, metadata, save_torrent_dir)
 
         info_hash = self.compute_info_hash(torrent_file).hex()
         display_name = metadata['name']
 
         self.generate_magnet_link(info_hash, tracker_url, display_name, save_torrent_dir)
-        return info_hash, tracker_url, display_name, metadata, pieces_dict
+        return info_hash, tracker_url, display_name, metadata
 
     @staticmethod
     def generate_torrent_file(tracker_url, metadata, save_torrent_dir=None):
@@ -247,6 +241,7 @@ class TorrentUtilsClass:
     @staticmethod
     def piece2file_map(files, piece_size):
         """Maps each piece to the corresponding file(s), handling pieces that span multiple files.
+        Zero-length files hold no part of any piece and are left out.
         """
         piece_to_file_map = dict()
         current_file_index = 0
@@ -259,7 +254,7 @@ class TorrentUtilsClass:
             piece_to_file_map[current_piece] = []
 
             # Continue mapping until the entire piece is accounted for
-            while piece_remaining > 0:
+            while piece_remaining > 0 and current_file_index < len(files):
                 # Get current file info
                 current_file = files[current_file_index]
                 file_name = current_file["path"]
@@ -268,10 +263,15 @@ class TorrentUtilsClass:
                 # Calculate how much data can fit in the current file
                 available_in_file = file_length - current_file_offset
 
-                if piece_remaining <= available_in_file:
+                if available_in_file <= 0:
+                    # Zero-length file
+                    current_file_index += 1
+                    current_file_offset = 0
+                elif piece_remaining <= available_in_file:
                     # The piece fits within the remaining part of the current file
                     piece_to_file_map[current_piece].append({
                         "file": os.path.join(*file_name),
+                        "offset_in_file": current_file_offset,
                         "length_in_file": piece_remaining,
                         # "is_last": piece_remaining == available_in_file
                     })
@@ -281,10 +281,12 @@ class TorrentUtilsClass:
                     # Move to the next file if the current file is exhausted
                     if current_file_offset >= file_length:
                         current_file_index += 1
+                        current_file_offset = 0
                 else:
                     # The piece spans into the next file
                     piece_to_file_map[current_piece].append({
                         "file": os.path.join(*file_name),
+                        "offset_in_file": current_file_offset,
                         "length_in_file": available_in_file,
                         # "is_last": True  # This is the last part of the piece within this file
                     })
@@ -292,8 +294,9 @@ class TorrentUtilsClass:
                     current_file_index += 1
                     current_file_offset = 0
 
-                if current_file_index >= len(files):
-                    break
+            # Only zero-length files were left after the last piece
+            if not piece_to_file_map[current_piece]:
+                del piece_to_file_map[current_piece]
             if current_file_index >= len(files):
                 break
 
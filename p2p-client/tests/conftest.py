@@ -0,0 +1,80 @@
+import hashlib
+import os
+import random
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+from unittest.mock import Mock
+
+import pytest
+
+# Tests import the client as main.py does, from the p2p-client directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.piece_manager import PieceManager
+from src.rate_limiter import TokenBucket
+from src.utils import TorrentUtils
+
+PIECE_LENGTH = 32 * 1024
+
+
+class FakeClient:
+    """The parts of a TorrentClient that the piece manager and the peer connections use. The choker and
+    the download engine are mocks, the tests look at what the connections send and record."""
+
+    def __init__(self, download_dir, executor):
+        self.peer_id = TorrentUtils.generate_peer_id()
+        self.downloading = True
+        self.download_dir = download_dir
+        self.session = SimpleNamespace(io_executor=executor)
+        self.peer_upload_limit = None
+        self.peer_download_limit = None
+        self.upload_bucket = TokenBucket()
+        self.download_bucket = TokenBucket()
+        self.choker = Mock()
+        self.download_engine = Mock()
+        self.piece_manager = None
+        self.peer_connections = {}
+        self.removed_connections = []
+
+    def log(self, message):
+        pass
+
+    def get_peers(self, ids):
+        return list(ids)
+
+    def remove_connection(self, connection):
+        self.removed_connections.append(connection)
+
+
+@pytest.fixture
+def torrent():
+    """Metadata of a single-file torrent of 4 pieces, the last one short, and its content."""
+    data = random.Random(0).randbytes(PIECE_LENGTH * 3 + 1000)
+    pieces = b''.join(hashlib.sha1(data[i:i + PIECE_LENGTH]).digest() for i in range(0, len(data), PIECE_LENGTH))
+    metadata = {'name': 'data', 'piece length': PIECE_LENGTH, 'pieces': pieces,
+                'files': [{'path': ['a.bin'], 'length': len(data)}]}
+    return metadata, data
+
+
+@pytest.fixture
+def make_client(tmp_path, torrent):
+    """make_client(name, pieces) returns a FakeClient with a piece manager of the torrent holding pieces,
+    their data written to its files. With recheck_pieces the files of an earlier client of the same name
+    are left as they are and the pieces are hashed again, as on a fast-resume after a change."""
+    metadata, data = torrent
+    executor = ThreadPoolExecutor(max_workers=2)
+
+    def make_client(name, pieces=(), recheck_pieces=False):
+        client = FakeClient(str(tmp_path / name), executor)
+        client.piece_manager = PieceManager(peer_list=[], metadata=metadata, pieces=set(pieces), client=client,
+                                            recheck_pieces=recheck_pieces)
+        if recheck_pieces:
+            return client
+        for piece_idx in pieces:
+            client.piece_manager.storage.write_piece(piece_idx, data[piece_idx * PIECE_LENGTH:
+                                                                     (piece_idx + 1) * PIECE_LENGTH])
+        return client
+
+    yield make_client
+    executor.shutdown()
@@ -0,0 +1,74 @@
+from types import SimpleNamespace
+from unittest.mock import Mock
+
+from src.choker import Choker
+
+
+def make_choker(rates, seeding=False, num_unchoked=2, optimistic_rounds=3) -> Choker:
+    """A choker of peers with the given rates, all of them connected and interested."""
+    piece_manager = Mock()
+    piece_manager.is_seeding.return_value = seeding
+    piece_manager.get_download_rate.side_effect = lambda id: None if seeding else rates[id]
+    piece_manager.get_upload_rate.side_effect = lambda id: rates[id] if seeding else None
+    client = SimpleNamespace(peer_connections={id: Mock(id=id) for id in rates}, log=lambda message: None,
+                             get_peers=lambda ids: ids)
+    choker = Choker(client, piece_manager, num_unchoked=num_unchoked, optimistic_rounds=optimistic_rounds)
+    choker.interested_peers.update(rates)
+    return choker
+
+
+def unchoke_messages(choker) -> set:
+    return {id for id, connection in choker.client.peer_connections.items()
+            if connection.send_unchoke_message.called}
+
+
+def test_best_rates_and_one_optimistic_peer_are_unchoked():
+    rates = {'a': 10, 'b': 500, 'c': 300, 'd': 0, 'e': 5}
+    for seeding in (False, True):
+        choker = make_choker(rates, seeding)
+        choker.rechoke()
+        assert {'b', 'c'} < choker.unchoked_peers and len(choker.unchoked_peers) == 3
+        assert choker.optimistic_peer in {'a', 'd', 'e'}
+        assert unchoke_messages(choker) == choker.unchoked_peers
+
+
+def test_only_changes_are_sent():
+    rates = {'a': 10, 'b': 500, 'c': 300, 'd': 1}
+    choker = make_choker(rates, num_unchoked=1)
+    connections = choker.client.peer_connections
+    for round in range(10):
+        before = set(choker.unchoked_peers)
+        for connection in connections.values():
+            connection.reset_mock()
+        rates['c'] = 1000 if round % 2 else 0
+        choker.rechoke()
+        assert ('c' if round % 2 else 'b') in choker.unchoked_peers
+        for id, connection in connections.items():
+            assert connection.send_unchoke_message.called == (id in choker.unchoked_peers - before)
+            assert connection.send_choke_message.called == (id in before - choker.unchoked_peers)
+
+
+def test_optimistic_unchoke_moves_every_few_rounds():
+    choker = make_choker({'fast': 100, **{f'p{i}': 0 for i in range(20)}}, num_unchoked=1, optimistic_rounds=3)
+    choker.rechoke()
+    optimistic = [choker.optimistic_peer]
+    for _ in range(8):
+        choker.rechoke()
+        optimistic.append(choker.optimistic_peer)
+    # It changes on rounds 3, 6 and 9, and only then
+    changes = [round for round in range(2, 10) if optimistic[round - 1] != optimistic[round - 2]]
+    assert changes == [3, 6, 9]
+
+
+def test_interest_unchokes_while_a_slot_is_free():
+    choker = make_choker({}, num_unchoked=1)
+    connections = [Mock(id=id) for id in 'abc']
+    for connection in connections:
+        choker.peer_interested(connection)
+    assert [connection.send_unchoke_message.called for connection in connections] == [True, True, False]
+
+    choker.peer_not_interested(connections[0])
+    connections[0].send_choke_message.assert_called_once()
+    assert choker.unchoked_peers == {'b'} and choker.interested_peers == {'b', 'c'}
+    choker.remove_peer('b')
+    assert choker.unchoked_peers == set() and choker.interested_peers == {'c'}
@@ -0,0 +1,113 @@
+import socket
+import time
+from types import SimpleNamespace
+from unittest.mock import Mock
+
+import pytest
+
+from src.connection_manager import ConnectionLimits, ConnectionManager
+from src.utils import RECONNECT_BACKOFF_MIN
+
+LOW_ID, HIGH_ID = 'A' * 20, 'Z' * 20
+
+
+def make_manager(peer_id, max_half_open=8) -> ConnectionManager:
+    client = SimpleNamespace(peer_id=peer_id, running=True, peer_connections={}, log=lambda message: None,
+                             start_connection=Mock(), piece_manager=Mock(), download_engine=Mock(), choker=Mock())
+    return ConnectionManager(client, ConnectionLimits(max_half_open=max_half_open))
+
+
+class Connection:
+    """The attributes of a peer connection the manager reads and sets, with a recording close()."""
+
+    def __init__(self, id, peer_id, outgoing):
+        self.id = id
+        self.peer_id = peer_id.encode().hex()       # As read from the handshake
+        self.outgoing = outgoing
+        self.closed = False
+        self.holds_slot = False
+        self.connected_time = None
+        self.ip, self.port = '127.0.0.1', 6881
+        self.close = Mock()
+
+
+def dial(manager, id):
+    manager.add_peer({'id': id, 'ip': '127.0.0.1', 'port': 6881}, socket.AF_INET)
+    assert id in manager.connecting
+
+
+@pytest.mark.parametrize('outgoing_first', [True, False])
+def test_both_ends_keep_the_connection_of_the_lower_peer_id(outgoing_first):
+    low, high = make_manager(LOW_ID), make_manager(HIGH_ID)
+    dial(low, 'high')
+    dial(high, 'low')
+    # The low side's outgoing connection is the high side's incoming one, and the other way round
+    low_ends = [Connection('high', HIGH_ID, True), Connection('high-in', HIGH_ID, False)]
+    high_ends = [Connection('low', LOW_ID, True), Connection('low-in', LOW_ID, False)]
+    if not outgoing_first:
+        low_ends.reverse()
+        high_ends.reverse()
+
+    kept = {}
+    for manager, (first, second) in ((low, low_ends), (high, high_ends)):
+        first_kept = manager.connection_established(first)
+        second_kept = manager.connection_established(second)
+        assert first_kept
+        (dropped,) = [end for end in (first, second) if end.close.called]
+        kept[manager] = second if dropped is first else first
+        assert second_kept == (kept[manager] is second)
+        manager.connection_closed(dropped)          # As the closed connection reports
+        assert manager.peer_id_connections == {kept[manager].peer_id: kept[manager]}
+        assert list(manager.client.peer_connections.values()) == [kept[manager]]
+
+    # Both kept the connection the low side opened
+    assert kept[low].outgoing and not kept[high].outgoing
+
+
+def test_closing_the_duplicate_keeps_the_peer():
+    manager = make_manager(LOW_ID)
+    dial(manager, 'high')
+    kept, duplicate = Connection('high', HIGH_ID, True), Connection('high-in', HIGH_ID, False)
+    manager.connection_established(kept)
+    manager.connection_established(duplicate)
+    manager.connection_closed(duplicate)
+    # Only the duplicate's own id is forgotten, not the peer it duplicates
+    manager.client.piece_manager.remove_peer.assert_called_once_with('high-in')
+
+    manager.connection_closed(kept)
+    manager.client.piece_manager.remove_peer.assert_called_with('high')
+    manager.client.download_engine.peer_disconnected.assert_called_with('high')
+    assert manager.client.peer_connections == {} and manager.peer_id_connections == {}
+    assert manager.limits.connections == 0
+
+
+def test_connection_to_ourselves_is_dropped_and_not_retried():
+    manager = make_manager(LOW_ID)
+    dial(manager, 'self')
+    connection = Connection('self', LOW_ID, True)
+    assert not manager.connection_established(connection)
+    connection.close.assert_called_once()
+    assert manager.peers['self'].banned
+    manager.connection_closed(connection)
+    manager.peers['self'].retry_time = 0
+    manager.connect_more()
+    manager.client.start_connection.assert_called_once()
+
+
+def test_failed_attempts_back_off_and_half_open_slots_are_bounded():
+    manager = make_manager(LOW_ID, max_half_open=2)
+    for id in ('a', 'b', 'c'):
+        manager.add_peer({'id': id, 'ip': '127.0.0.1', 'port': 6881}, socket.AF_INET)
+    assert manager.connecting == {'a', 'b'}
+
+    # The freed slot goes to the waiting peer, the failed one is retried later
+    manager.connect_failed('a', 'refused')
+    assert manager.connecting == {'b', 'c'}
+    assert manager.limits.half_open == 2
+    entry = manager.peers['a']
+    assert entry.failures == 1 and entry.retry_time - time.monotonic() > RECONNECT_BACKOFF_MIN - 1
+
+    manager.connect_failed('b', 'refused')
+    manager.connect_failed('c', 'refused')
+    assert manager.connecting == set() and manager.limits.half_open == 0
+    assert manager.client.start_connection.call_count == 3
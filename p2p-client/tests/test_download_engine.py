@@ -0,0 +1,136 @@
+import time
+from unittest.mock import Mock
+
+import numpy as np
+import pytest
+
+from src.download_engine import DownloadEngine
+from src.piece_manager import BlockState
+from src.scheduler import FixedDepthScheduler
+from src.utils import SNUB_TIMEOUTS
+
+from conftest import PIECE_LENGTH
+
+PIECES = 4
+BLOCKS = 7      # Two blocks of 16 KiB in each 32 KiB piece, and the short last piece
+
+
+def make_engine(client, depth) -> DownloadEngine:
+    client.download_engine = engine = DownloadEngine(client, client.piece_manager,
+                                                     scheduler=FixedDepthScheduler(depth))
+    return engine
+
+
+def add_peer(client, id, pieces) -> Mock:
+    """Connect a peer holding pieces. Its connection records the messages it is sent."""
+    bits = np.zeros(PIECES, dtype=bool)
+    bits[list(pieces)] = True
+    client.piece_manager.add_peer(id)
+    client.piece_manager.add_peer_bitfield(id, np.packbits(bits).tobytes(), '127.0.0.1', 6881)
+    connection = client.peer_connections[id] = Mock()
+    return connection
+
+
+def requests_of(connection) -> list[tuple[int, int, int]]:
+    return [call.args for call in connection.send_request_message.call_args_list]
+
+
+def test_pipelines_fill_with_distinct_blocks_of_held_pieces(make_client):
+    client = make_client('leecher')
+    engine = make_engine(client, depth=2)
+    a, b = add_peer(client, 'a', {0, 1}), add_peer(client, 'b', range(PIECES))
+    engine.fill_pipelines(['a', 'b'])
+
+    assert len(requests_of(a)) == len(requests_of(b)) == 2
+    assert {index for index, _, _ in requests_of(a)} <= {0, 1}
+    assert len(set(requests_of(a) + requests_of(b))) == 4
+    assert not engine.endgame
+
+
+def test_endgame_duplicates_outstanding_blocks_and_cancels_the_other_copies(make_client, torrent):
+    _, data = torrent
+    client = make_client('leecher')
+    engine = make_engine(client, depth=BLOCKS)
+    a, b = add_peer(client, 'a', range(PIECES)), add_peer(client, 'b', range(PIECES))
+    engine.fill_pipelines(['a'])
+    assert len(requests_of(a)) == BLOCKS
+    engine.fill_pipelines(['b'])
+    assert engine.endgame and sorted(requests_of(b)) == sorted(requests_of(a))
+
+    index, begin, length = requests_of(a)[0]
+    engine.block_received('a', index, begin, data[index * PIECE_LENGTH + begin:][:length])
+    b.send_cancel_message.assert_called_once_with(index, begin, length)
+    a.send_cancel_message.assert_not_called()
+    assert (index, begin, length) not in engine.peer_requests['b']
+
+
+def test_timed_out_requests_are_released_and_the_peer_snubbed(make_client, torrent):
+    _, data = torrent
+    client = make_client('leecher')
+    engine = make_engine(client, depth=2)
+    a, b = add_peer(client, 'a', range(PIECES)), add_peer(client, 'b', range(PIECES))
+    for timeouts in range(1, SNUB_TIMEOUTS + 1):
+        engine.fill_pipelines(['a'])
+        for request in engine.peer_requests['a']:
+            engine.peer_requests['a'][request] -= 100
+        expired = list(engine.peer_requests['a'])
+        engine.expire_requests()
+        assert [call.args for call in a.send_cancel_message.call_args_list[-2:]] == expired
+        assert engine.peer_requests['a'] == {} and engine.peer_timeouts['a'] == timeouts
+    assert 'a' in engine.snubbed_peers
+
+    # The released blocks go to another peer, the snubbed one gets a single request
+    engine.fill_pipelines(['b', 'a'])
+    assert set(requests_of(b)) == set(expired)
+    assert len(engine.peer_requests['a']) == 1
+    index, begin, length = next(iter(engine.peer_requests['a']))
+    engine.block_received('a', index, begin, data[index * PIECE_LENGTH + begin:][:length])
+    assert 'a' not in engine.snubbed_peers and engine.peer_timeouts['a'] == 0
+
+
+def test_choked_and_disconnected_peers_release_their_requests(make_client):
+    client = make_client('leecher')
+    engine = make_engine(client, depth=3)
+    add_peer(client, 'a', range(PIECES))
+    b = add_peer(client, 'b', range(PIECES))
+    engine.fill_pipelines(['a'])
+    first = set(engine.peer_requests['a'])
+
+    engine.peer_choked('a')
+    engine.fill_pipelines(['b'])
+    assert set(requests_of(b)) == first
+
+    engine.peer_disconnected('b')
+    assert 'b' not in engine.peer_requests
+    pieces = client.piece_manager.downloading_pieces
+    assert all(pieces[index].block_states[begin] != BlockState.REQUESTED for index, begin, _ in first)
+
+
+@pytest.mark.parametrize('corrupt', [False, True])
+def test_download_completes(make_client, torrent, corrupt):
+    _, data = torrent
+    client = make_client('leecher')
+    piece_manager = client.piece_manager
+    engine = make_engine(client, depth=3)
+    seeder = add_peer(client, 'seeder', range(PIECES))
+    answered = 0
+    corrupted = False
+
+    deadline = time.monotonic() + 10
+    while not piece_manager.is_download_complete():
+        assert time.monotonic() < deadline, "timed out"
+        engine.fill_pipelines(['seeder'])
+        requests = requests_of(seeder)
+        for index, begin, length in requests[answered:]:
+            block = data[index * PIECE_LENGTH + begin:][:length]
+            if corrupt and not corrupted and index == 1:
+                block, corrupted = bytes(length), True
+            engine.block_received('seeder', index, begin, block)
+        answered = len(requests)
+        engine.block_event.wait(0.05)
+        engine.block_event.clear()
+
+    assert sorted(call.args[0] for call in seeder.send_have_message.call_args_list) == list(range(PIECES))
+    assert piece_manager.corrupt_peers['seeder'] == int(corrupt)
+    with open(piece_manager.storage.get_file_path('a.bin'), 'rb') as f:
+        assert f.read() == data
@@ -0,0 +1,82 @@
+import random
+import struct
+
+import pytest
+
+from src.message_framer import MessageFramer
+
+HANDSHAKE = b'\x13BitTorrent protocol' + bytes(48)
+
+
+def message(type, payload=b'') -> bytes:
+    return struct.pack(">IB", len(payload) + 5, type) + payload
+
+
+def piece_message(index, begin, block) -> bytes:
+    return struct.pack(">IBII", len(block) + 13, 7, index, begin) + block
+
+
+def receive(framer, stream, rng) -> list[tuple[bytes, bytes | None]]:
+    """Feed the handshake and then the stream to the framer in chunks of random size, as recv_into would fill
+    its buffers. The handshake comes in two reads, the second one after the framer was asked for a buffer."""
+    buffer = framer.get_buffer()
+    buffer[:len(HANDSHAKE) - 1] = HANDSHAKE[:-1]
+    framer.buffer_updated(len(HANDSHAKE) - 1)
+    assert framer.read_handshake() is None
+    framer.get_buffer()[:1] = HANDSHAKE[-1:]
+    framer.buffer_updated(1)
+    assert bytes(framer.read_handshake()) == HANDSHAKE
+
+    received = []
+    position = 0
+    while position < len(stream):
+        buffer = framer.get_buffer()
+        nbytes = min(len(buffer), rng.randrange(1, 5000), len(stream) - position)
+        buffer[:nbytes] = stream[position:position + nbytes]
+        framer.buffer_updated(nbytes)
+        position += nbytes
+        received.extend((bytes(m), None if b is None else bytes(b)) for m, b in framer.messages())
+    return received
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_messages_survive_any_chunking(seed):
+    rng = random.Random(seed)
+    messages = [message(2), message(4, b'\0\0\0\x07'), message(5, rng.randbytes(300)),
+                piece_message(1, 0, rng.randbytes(40000)), message(6, rng.randbytes(12)),
+                piece_message(2, 16384, rng.randbytes(100))]
+    framer = MessageFramer()
+    received = receive(framer, b''.join(messages), rng)
+    assert [m for m, _ in received] == messages
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_piece_payloads_go_into_their_block_buffer(seed):
+    rng = random.Random(seed)
+    blocks = {(3, 0): rng.randbytes(16384), (3, 16384): rng.randbytes(16384)}
+    targets = {key: bytearray(len(block)) for key, block in blocks.items()}
+
+    def get_block_buffer(piece_idx, begin, length):
+        target = targets.get((piece_idx, begin))
+        return memoryview(target) if target is not None and len(target) == length else None
+
+    stream = b''.join(piece_message(*key, block) + message(2) for key, block in blocks.items())
+    received = receive(MessageFramer(get_block_buffer), stream, rng)
+
+    assert [m for m, _ in received[1::2]] == [message(2)] * 2
+    for (header, block), key in zip(received[::2], blocks):
+        assert header[:13] == piece_message(*key, blocks[key])[:13]
+        if block is None:       # Complete in the receive buffer before its header was looked at
+            assert header[13:] == blocks[key]
+        else:
+            assert len(header) == 13 and block == blocks[key] == targets[key]
+
+
+@pytest.mark.parametrize('length', [0, 4, 16 * 1024 * 1024 + 1])
+def test_invalid_length_is_an_error(length):
+    framer = MessageFramer()
+    buffer = framer.get_buffer()
+    buffer[:5] = struct.pack(">IB", length, 0)
+    framer.buffer_updated(5)
+    with pytest.raises(ValueError):
+        list(framer.messages())
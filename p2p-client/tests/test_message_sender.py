@@ -0,0 +1,90 @@
+import os
+import random
+import socket
+import threading
+
+import pytest
+
+from src.message_sender import MessageSender, MAX_SEND_BUFFERS
+
+
+class ShortWrites:
+    """A socket whose sendmsg and send write at most a few bytes, as a full socket buffer would."""
+
+    def __init__(self, rng):
+        self.rng = rng
+        self.data = bytearray()
+
+    def sendmsg(self, buffers, ancdata, flags):
+        assert len(buffers) <= MAX_SEND_BUFFERS
+        return self.send(b''.join(buffers), flags)
+
+    def send(self, buffer, flags=0):
+        count = min(len(buffer), self.rng.randrange(1, 50))
+        self.data += bytes(buffer[:count])
+        return count
+
+
+@pytest.mark.parametrize('use_sendmsg', [True, False])
+def test_partial_writes_are_resumed(use_sendmsg):
+    rng = random.Random(0)
+    sock = ShortWrites(rng)
+    sender = MessageSender(sock)
+    sender.use_sendmsg = use_sendmsg
+    buffers = [rng.randbytes(rng.randrange(0, 100)) for _ in range(MAX_SEND_BUFFERS + 100)]
+    for buffer in buffers:
+        sender.add(buffer)
+    sender.flush()
+    assert sock.data == b''.join(buffers)
+    assert sender.pending == 0 and sender.buffers == []
+
+
+@pytest.mark.parametrize('use_sendfile', [True, False])
+def test_file_spans_follow_their_headers(tmp_path, use_sendfile):
+    content = random.Random(1).randbytes(200_000)
+    path = tmp_path / 'data'
+    path.write_bytes(content)
+    sending, receiving = socket.socketpair()
+    received = bytearray()
+    reader = threading.Thread(target=receive_all, args=(receiving, received))
+    reader.start()
+
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        sender = MessageSender(sending)
+        sender.use_sendfile = sender.use_sendfile and use_sendfile
+        for offset, length in [(0, 16384), (100_000, 50_000), (199_000, 1000)]:
+            sender.add(b'header%d' % offset)
+            sender.add_file_span(fd, offset, length)
+        sender.add(b'end')
+        sender.flush()
+    finally:
+        os.close(fd)
+        sending.close()
+    reader.join()
+
+    assert received == b''.join([b'header0', content[:16384], b'header100000', content[100_000:150_000],
+                                 b'header199000', content[199_000:], b'end'])
+
+
+def receive_all(sock, received: bytearray):
+    with sock:
+        while data := sock.recv(65536):
+            received += data
+
+
+def test_span_past_the_end_of_the_file_is_an_error(tmp_path):
+    path = tmp_path / 'data'
+    path.write_bytes(b'x' * 100)
+    sending, receiving = socket.socketpair()
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        sender = MessageSender(sending)
+        if not sender.use_sendfile:
+            pytest.skip("sendfile is not available")
+        with pytest.raises(ValueError):
+            sender.add_file_span(fd, 50, 100)
+    finally:
+        os.close(fd)
+        sending.close()
+        receiving.close()
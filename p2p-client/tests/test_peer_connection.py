@@ -0,0 +1,162 @@
+import asyncio
+import socket
+import struct
+import threading
+import time
+
+import pytest
+
+from src.async_peer_connection import AsyncPeerConnection, run_in_event_loop
+from src.peer_connection import PeerConnection
+from src.resume import ResumeData
+from src.utils import MessageType, MAX_REQUEST_LENGTH
+
+from conftest import PIECE_LENGTH
+
+INFO_HASH = 'ab' * 20
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def tcp_pair() -> tuple[socket.socket, socket.socket]:
+    with socket.create_server(('127.0.0.1', 0)) as server:
+        outgoing = socket.create_connection(server.getsockname())
+        incoming, _ = server.accept()
+    return outgoing, incoming
+
+
+def connect(engine, outgoing_client, incoming_client) -> tuple[PeerConnection, PeerConnection]:
+    """Connect two clients with the given engine, the first one dialing. Return both ends once the
+    handshakes are exchanged."""
+    outgoing_sock, incoming_sock = tcp_pair()
+    address = dict(zip(('ip', 'port'), incoming_sock.getsockname()))
+    target_peer = {'id': 'incoming-peer', **address}
+    if engine == 'threaded':
+        incoming_peer = {'id': 'outgoing-peer', 'ip': '127.0.0.1', 'port': outgoing_sock.getsockname()[1]}
+        incoming_client.piece_manager.add_peer(incoming_peer['id'])
+        accepted = []
+        thread = threading.Thread(target=lambda: accepted.append(PeerConnection(
+            INFO_HASH, incoming_client.peer_id, incoming_sock, incoming_peer, incoming_client.piece_manager,
+            outgoing=False, client=incoming_client)))
+        thread.start()
+        outgoing = PeerConnection(INFO_HASH, outgoing_client.peer_id, outgoing_sock, target_peer,
+                                  outgoing_client.piece_manager, outgoing=True, client=outgoing_client)
+        thread.join()
+        return outgoing, accepted[0]
+
+    outgoing = AsyncPeerConnection(INFO_HASH, outgoing_client.peer_id, target_peer, outgoing_client.piece_manager,
+                                   outgoing=True, client=outgoing_client)
+    incoming = AsyncPeerConnection(INFO_HASH, incoming_client.peer_id, None, incoming_client.piece_manager,
+                                   outgoing=False, client=incoming_client)
+
+    async def open_connections():
+        loop = asyncio.get_running_loop()
+        await loop.create_connection(lambda: incoming, sock=incoming_sock)
+        await loop.create_connection(lambda: outgoing, sock=outgoing_sock)
+        await asyncio.gather(outgoing.handshake_done, incoming.handshake_done)
+
+    run_in_event_loop(open_connections()).result(5)
+    return outgoing, incoming
+
+
+@pytest.mark.parametrize('engine', ['threaded', 'asyncio'])
+@pytest.mark.parametrize('seeder_dials', [True, False])
+def test_both_sides_send_their_bitfield(make_client, engine, seeder_dials):
+    seeder = make_client('seeder', range(4))
+    leecher = make_client('leecher', [1])
+    if seeder_dials:
+        seeder_end, leecher_end = connect(engine, seeder, leecher)
+    else:
+        leecher_end, seeder_end = connect(engine, leecher, seeder)
+
+    # Whichever side dialed, each learns the other's pieces and the leecher can get interested
+    wait_for(lambda: leecher.piece_manager.peer_has_piece(leecher_end.id, 3)
+             and seeder.piece_manager.peer_has_piece(seeder_end.id, 1))
+    assert leecher.piece_manager.peer_has_needed_piece(leecher_end.id)
+    assert not seeder.piece_manager.peer_has_piece(seeder_end.id, 0)
+    seeder_end.close()
+    leecher_end.close()
+
+
+@pytest.mark.parametrize('engine', ['threaded', 'asyncio'])
+def test_resumed_client_advertises_its_pieces_when_dialing(make_client, tmp_path, engine):
+    before = make_client('resumed', [0, 2, 3])
+    piece_manager = before.piece_manager
+    resume_data = ResumeData(str(tmp_path / 'resume'), INFO_HASH)
+    resume_data.save(piece_manager.metadata, piece_manager.pieces, piece_manager.storage_dir, [])
+    piece_manager.storage.close()
+    # Piece 2 is damaged while the client is not running
+    with open(piece_manager.storage.get_file_path('a.bin'), 'r+b') as f:
+        f.seek(2 * piece_manager.piece_size)
+        f.write(b'\0' * 100)
+
+    state = resume_data.load()
+    assert state['recheck']
+    resumed = make_client('resumed', state['pieces'], recheck_pieces=True)
+    assert resumed.piece_manager.pieces == {0, 3}
+
+    # Reconnecting to a cached peer, the resumed client offers the pieces that passed the recheck
+    other = make_client('other', [1])
+    resumed_end, other_end = connect(engine, resumed, other)
+    wait_for(lambda: other.piece_manager.peer_has_piece(other_end.id, 0))
+    assert other.piece_manager.peer_has_piece(other_end.id, 3)
+    assert not other.piece_manager.peer_has_piece(other_end.id, 2)
+    resumed_end.close()
+    other_end.close()
+
+
+@pytest.mark.parametrize('engine', ['threaded', 'asyncio'])
+def test_invalid_requests_are_dropped(make_client, torrent, engine):
+    _, data = torrent
+    seeder = make_client('seeder', [0, 1, 3])
+    leecher = make_client('leecher')
+    leecher_end, seeder_end = connect(engine, leecher, seeder)
+    seeder_end.send_unchoke_message()
+
+    # A piece not held, an index past the last piece, a block running past its piece, one past the short
+    # last piece and one longer than peers may ask for, then a valid request
+    for request in [(2, 0, 1024), (7, 0, 1024), (1, PIECE_LENGTH - 512, 1024), (3, 512, 1024),
+                    (0, 0, MAX_REQUEST_LENGTH + 1), (3, 0, 1000)]:
+        leecher_end.send_request_message(*request)
+
+    # Only the valid one is answered, on a connection still in sync
+    wait_for(lambda: leecher.download_engine.block_received.called)
+    time.sleep(0.1)
+    leecher.download_engine.block_received.assert_called_once()
+    _, index, begin, block = leecher.download_engine.block_received.call_args.args
+    assert (index, begin, bytes(block)) == (3, 0, data[3 * PIECE_LENGTH:])
+    assert seeder_end not in seeder.removed_connections
+    leecher_end.close()
+    seeder_end.close()
+
+
+@pytest.mark.parametrize('engine', ['threaded', 'asyncio'])
+def test_malformed_request_closes_the_connection(make_client, engine):
+    seeder = make_client('seeder', range(4))
+    leecher = make_client('leecher')
+    leecher_end, seeder_end = connect(engine, leecher, seeder)
+
+    # Length prefixes count themselves here, a REQUEST is 17 bytes
+    leecher_end.enqueue_send_message(struct.pack(">IBII", 13, MessageType.REQUEST.value, 0, 0))
+    wait_for(lambda: seeder_end in seeder.removed_connections)
+    leecher_end.close()
+
+
+@pytest.mark.parametrize('engine', ['threaded', 'asyncio'])
+def test_oversized_cancel_is_ignored(make_client, engine):
+    seeder = make_client('seeder', range(4))
+    leecher = make_client('leecher')
+    leecher_end, seeder_end = connect(engine, leecher, seeder)
+    oversized, block = (0, 0, MAX_REQUEST_LENGTH + 1), (1, 0, MAX_REQUEST_LENGTH)
+    seeder_end.upload_requests.update({oversized: None, block: None})
+
+    for request in (oversized, block):
+        seeder_end.handle_cancel_message(struct.pack(">IBIII", 17, MessageType.CANCEL.value, *request))
+    assert list(seeder_end.upload_requests) == [oversized]
+    leecher_end.close()
+    seeder_end.close()
@@ -0,0 +1,90 @@
+import random
+
+import numpy as np
+
+from src.piece_availability import PieceAvailability
+
+PIECES = 21     # Not a multiple of 8, so bitfields have spare bits
+
+
+def bitfield(pieces, length=PIECES) -> bytes:
+    bits = np.zeros(length, dtype=bool)
+    bits[list(pieces)] = True
+    return np.packbits(bits).tobytes()
+
+
+def check(availability: PieceAvailability, holdings: dict[str, set], have: set):
+    """Compare the indexes with the pieces each peer holds and the pieces the client holds."""
+    for piece in range(PIECES):
+        holders = {id for id, pieces in holdings.items() if piece in pieces}
+        assert availability.piece_counter[piece] == len(holders)
+        assert set(availability.get_peers_with_piece(piece)) == holders
+        assert availability.needed[piece] == (piece not in have)
+    for count, bucket in enumerate(availability.buckets):
+        for position, piece in enumerate(bucket):
+            assert availability.piece_counter[piece] == count and availability.needed[piece]
+            assert availability.bucket_positions[piece] == position
+    assert sum(map(len, availability.buckets)) == PIECES - len(have)
+    for id, pieces in holdings.items():
+        assert availability.peer_has_needed_piece(id) == bool(pieces - have)
+
+    counts = {piece: int(availability.piece_counter[piece]) for piece in range(PIECES) if piece not in have}
+    rarest = min((count for count in counts.values() if count), default=None)
+    picked = availability.pick_rarest_piece()
+    assert (picked is None) if rarest is None else counts[picked] == rarest
+
+
+def test_indexes_follow_bitfields_haves_and_disconnects():
+    rng = random.Random(1)
+    availability = PieceAvailability(PIECES, pieces=[3])
+    holdings, have = {}, {3}
+    for _ in range(400):
+        id = f'peer{rng.randrange(12)}'
+        action = rng.random()
+        if action < 0.15:
+            availability.add_peer(id)
+            holdings[id] = set()
+        elif action < 0.3:
+            availability.remove_peer(id)
+            holdings.pop(id, None)
+        elif action < 0.5:
+            pieces = set(rng.sample(range(PIECES), rng.randrange(PIECES)))
+            # Spare bits set by the peer are ignored
+            received = bytearray(bitfield(pieces))
+            received[-1] |= 0x07
+            availability.set_peer_bitfield(id, bytes(received))
+            holdings[id] = pieces
+        elif action < 0.9:
+            if id in holdings:
+                piece = rng.randrange(PIECES)
+                availability.add_peer_piece(id, piece)
+                holdings[id].add(piece)
+        else:
+            piece = rng.randrange(PIECES)
+            availability.add_have_piece(piece)
+            have.add(piece)
+        check(availability, holdings, have)
+
+
+def test_bitfields_before_the_metadata_are_counted_once_it_is_known():
+    availability = PieceAvailability()
+    availability.set_peer_bitfield('a', bitfield({0, 5, 20}))
+    availability.add_peer('b')
+    availability.add_peer_piece('b', 20)
+    availability.add_peer_piece('c', 9)
+    assert availability.peer_has_piece('c', 9) and not availability.is_complete()
+
+    availability.set_number_of_pieces(PIECES, pieces={5})
+    check(availability, {'a': {0, 5, 20}, 'b': {20}, 'c': {9}}, {5})
+
+
+def test_rarest_piece_of_a_peer():
+    availability = PieceAvailability(PIECES)
+    availability.set_peer_bitfield('a', bitfield(range(PIECES)))
+    availability.set_peer_bitfield('b', bitfield({1, 2}))
+    availability.set_peer_bitfield('c', bitfield({2}))
+    assert availability.pick_rarest_piece('b') == 1
+    assert availability.pick_rarest_piece('c') == 2
+    assert availability.pick_rarest_piece('c', exclude={2}) is None
+    assert availability.pick_rarest_piece('unknown') is None
+    assert availability.pick_rarest_piece('a') not in {1, 2}
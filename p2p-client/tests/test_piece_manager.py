@@ -0,0 +1,32 @@
+import pytest
+
+from conftest import PIECE_LENGTH
+
+
+def test_get_block_of_held_piece(make_client, torrent):
+    _, data = torrent
+    piece_manager = make_client('peer', [1, 3]).piece_manager
+    assert bytes(piece_manager.get_block(1, 100, 16384, 'x')) == data[PIECE_LENGTH + 100:PIECE_LENGTH + 16484]
+    # The last piece is shorter than the others
+    last_length = len(data) - 3 * PIECE_LENGTH
+    assert bytes(piece_manager.get_block(3, 0, last_length)) == data[3 * PIECE_LENGTH:]
+    assert sum(length for _, _, length in piece_manager.get_block_spans(1, 0, PIECE_LENGTH)) == PIECE_LENGTH
+    assert piece_manager.uploaded == 16384 + last_length + PIECE_LENGTH
+
+
+@pytest.mark.parametrize('request_', [
+    (0, 0, 16384),                          # Not held, the preallocated file would give zeros
+    (2, 0, 16384),
+    (4, 0, 16384),                          # Past the last piece
+    (1, PIECE_LENGTH - 100, 200),           # Runs past the end of the piece
+    (3, 0, 16384),                          # Past the end of the short last piece
+    (1, 0, 0),
+])
+def test_get_block_rejects_blocks_outside_held_pieces(make_client, request_):
+    piece_manager = make_client('peer', [1, 3]).piece_manager
+    assert not piece_manager.has_block(*request_)
+    with pytest.raises(ValueError):
+        piece_manager.get_block(*request_)
+    with pytest.raises(ValueError):
+        piece_manager.get_block_spans(*request_)
+    assert piece_manager.uploaded == 0
@@ -0,0 +1,54 @@
+from types import SimpleNamespace
+
+import pytest
+
+from src import rate_limiter
+from src.rate_limiter import BandwidthLimiter, TokenBucket
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = SimpleNamespace(now=100.0)
+    monkeypatch.setattr(rate_limiter, 'time', SimpleNamespace(monotonic=lambda: clock.now))
+    return clock
+
+
+def test_unlimited_bucket_never_waits(clock):
+    bucket = TokenBucket()
+    assert bucket.consume(10 ** 12) == 0
+
+
+def test_burst_then_the_debt_sets_the_delay(clock):
+    bucket = TokenBucket(rate=1000)
+    assert bucket.consume(1000) == 0            # One second of rate in the bucket
+    assert bucket.consume(500) == pytest.approx(0.5)
+    assert bucket.consume(500) == pytest.approx(1.0)   # Queued behind the first debt
+    clock.now += 1
+    assert bucket.consume(0) == pytest.approx(0)
+
+
+def test_refill_is_capped_at_the_burst(clock):
+    bucket = TokenBucket(rate=1000, burst=2000)
+    bucket.consume(2000)
+    clock.now += 60
+    assert bucket.consume(2000) == 0
+    assert bucket.consume(1000) == pytest.approx(1.0)
+
+
+def test_rate_change_keeps_the_debt(clock):
+    bucket = TokenBucket(rate=1000)
+    bucket.consume(3000)
+    bucket.set_rate(2000)
+    assert bucket.consume(0) == pytest.approx(1.0)
+    bucket.set_rate(None)
+    assert bucket.consume(10 ** 9) == 0
+    with pytest.raises(ValueError):
+        bucket.set_rate(0)
+
+
+def test_limiter_waits_for_the_most_limiting_bucket(clock):
+    process, torrent, peer = TokenBucket(), TokenBucket(rate=1000), TokenBucket(rate=4000)
+    limiter = BandwidthLimiter(process, torrent, peer)
+    limiter.consume(1000)
+    assert limiter.consume(2000) == pytest.approx(2.0)
+    assert [bucket.throttled_time for bucket in (process, torrent, peer)] == [pytest.approx(2.0)] * 3
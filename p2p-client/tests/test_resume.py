@@ -0,0 +1,52 @@
+import os
+
+from src.resume import ResumeData
+
+INFO_HASH = 'ab' * 20
+
+
+def test_load_missing_file(tmp_path):
+    assert ResumeData(str(tmp_path / 'resume'), INFO_HASH).load() is None
+
+
+def test_load_corrupt_file(tmp_path):
+    resume_data = ResumeData(str(tmp_path), INFO_HASH)
+    for content in (b'garbage', b'd7:bitfield', b'', b'i42e', b'd4:infoi1ee'):
+        with open(resume_data.path, 'wb') as f:
+            f.write(content)
+        assert resume_data.load() is None
+
+
+def test_save_and_load(tmp_path):
+    storage_dir = tmp_path / 'data'
+    storage_dir.mkdir()
+    (storage_dir / 'a.bin').write_bytes(b'x' * 100)
+    metadata = {'name': 'data', 'piece length': 64, 'pieces': b'\0' * 40,
+                'files': [{'path': ['a.bin'], 'length': 100}]}
+    resume_data = ResumeData(str(tmp_path / 'resume'), INFO_HASH)
+    resume_data.save(metadata, {1}, str(storage_dir), [{'ip': '127.0.0.1', 'port': 6881}])
+
+    state = resume_data.load()
+    assert state['pieces'] == {1}
+    assert state['storage_dir'] == os.path.abspath(storage_dir)
+    assert state['peers'] == [{'ip': '127.0.0.1', 'port': 6881}]
+    assert not state['recheck']
+
+
+def test_load_changed_files(tmp_path):
+    storage_dir = tmp_path / 'data'
+    storage_dir.mkdir()
+    (storage_dir / 'a.bin').write_bytes(b'x' * 100)
+    metadata = {'name': 'data', 'piece length': 64, 'pieces': b'\0' * 40,
+                'files': [{'path': ['a.bin'], 'length': 100}]}
+    resume_data = ResumeData(str(tmp_path / 'resume'), INFO_HASH)
+    resume_data.save(metadata, {0, 1}, str(storage_dir), [])
+
+    # The saved pieces are kept to be hashed again rather than thrown away
+    os.utime(storage_dir / 'a.bin', ns=(0, 0))
+    state = resume_data.load()
+    assert state['pieces'] == {0, 1}
+    assert state['recheck']
+
+    (storage_dir / 'a.bin').unlink()
+    assert resume_data.load()['recheck']
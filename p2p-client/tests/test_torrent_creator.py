@@ -0,0 +1,37 @@
+import hashlib
+import random
+
+from src.utils import TorrentCreator
+
+PIECE_SIZE = 16 * 1024
+
+
+def create(tmp_path, max_workers) -> list[tuple[int, int]]:
+    folder = tmp_path / 'share'
+    (folder / 'sub').mkdir(parents=True)
+    rng = random.Random(1)
+    (folder / 'a.bin').write_bytes(rng.randbytes(PIECE_SIZE * 70 + 123))
+    (folder / 'empty.txt').write_bytes(b'')
+    (folder / 'sub' / 'b.bin').write_bytes(rng.randbytes(PIECE_SIZE * 130 + 877))
+
+    progress = []
+    creator = TorrentCreator(str(folder), PIECE_SIZE, max_workers=max_workers,
+                             progress_callback=lambda hashed, total: progress.append((hashed, total)))
+    metadata = creator.create()
+
+    # The pieces run over the files in the order they are listed
+    data = b''.join(open(path, 'rb').read() for path in creator.file_paths)
+    assert metadata['pieces'] == b''.join(hashlib.sha1(data[i:i + PIECE_SIZE]).digest()
+                                          for i in range(0, len(data), PIECE_SIZE))
+    assert progress[-1] == (len(data), len(data))
+    assert all(a[0] <= b[0] for a, b in zip(progress, progress[1:]))
+    return progress
+
+
+def test_create_in_worker_processes(tmp_path):
+    create(tmp_path, max_workers=2)
+
+
+def test_create_reports_every_piece(tmp_path):
+    progress = create(tmp_path, max_workers=1)
+    assert len(progress) == 1 + 201
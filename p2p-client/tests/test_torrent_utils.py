@@ -0,0 +1,56 @@
+import math
+import os
+
+from src.utils import TorrentUtils, MAX_REQUEST_LENGTH
+
+PIECE_SIZE = 256 * 1024
+
+
+def check_map(files, piece_size):
+    piece_map = TorrentUtils.piece2file_map(files, piece_size)
+    total = sum(file['length'] for file in files)
+    assert sorted(piece_map) == list(range(math.ceil(total / piece_size)))
+
+    # The spans of all pieces, in order, cover every byte of every file once
+    file_offsets = {}
+    for piece_idx in sorted(piece_map):
+        spans = piece_map[piece_idx]
+        expected = min(piece_size, total - piece_idx * piece_size)
+        assert sum(span['length_in_file'] for span in spans) == expected
+        for span in spans:
+            assert span['length_in_file'] > 0
+            assert span['offset_in_file'] == file_offsets.get(span['file'], 0)
+            file_offsets[span['file']] = span['offset_in_file'] + span['length_in_file']
+    assert file_offsets == {os.path.join(*file['path']): file['length'] for file in files if file['length']}
+    return piece_map
+
+
+def test_file_ending_on_piece_boundary():
+    files = [{'path': ['a.bin'], 'length': 8 * 1024 * 1024},
+             {'path': ['b.bin'], 'length': 12345},
+             {'path': ['empty'], 'length': 0},
+             {'path': ['dir', 'c.bin'], 'length': 700000}]
+    piece_map = check_map(files, PIECE_SIZE)
+    assert piece_map[32] == [{'file': 'b.bin', 'offset_in_file': 0, 'length_in_file': 12345},
+                             {'file': os.path.join('dir', 'c.bin'), 'offset_in_file': 0,
+                              'length_in_file': PIECE_SIZE - 12345}]
+
+
+def test_last_file_ending_on_piece_boundary():
+    files = [{'path': ['a.bin'], 'length': PIECE_SIZE},
+             {'path': ['b.bin'], 'length': 2 * PIECE_SIZE},
+             {'path': ['empty'], 'length': 0}]
+    check_map(files, PIECE_SIZE)
+
+
+def test_files_spanning_pieces():
+    files = [{'path': [f'{i}.bin'], 'length': length} for i, length in enumerate([1, 0, 300000, 5, 0, 262139, 99])]
+    check_map(files, PIECE_SIZE)
+    check_map(files, 16 * 1024)
+
+
+def test_blocks_fit_in_a_request():
+    blocks = TorrentUtils.divide_piece_into_blocks(5, PIECE_SIZE - 100)
+    assert all(length <= MAX_REQUEST_LENGTH for _, _, length in blocks)
+    assert [begin for _, begin, _ in blocks] == list(range(0, PIECE_SIZE - 100, MAX_REQUEST_LENGTH))
+    assert sum(length for _, _, length in blocks) == PIECE_SIZE - 100
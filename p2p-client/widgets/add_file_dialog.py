@@ -4,6 +4,7 @@ from PyQt6.QtCore import Qt
 import requests
 from PyQt6.QtGui import QPalette, QColor
 from .config import *
+from src.utils import TorrentUtils, choose_piece_size
 
 
 class AddFileDialogMagnet(QDialog):
@@ -179,8 +180,8 @@ class CreateTorrentDialog(QDialog):
         settings_layout = QGridLayout()
 
         piece_size_label = QLabel("Piece size:")
-        piece_size_combo = QComboBox()
-        piece_size_combo.addItems(["512 KiB", "512 KiB", "512 KiB", "512 KiB"])
+        self.piece_size_combo = QComboBox()
+        self.piece_size_combo.addItems(list(PIECE_SIZE_OPTIONS.keys()))
 
         calculate_pieces_button = QPushButton("Get number of pieces")
         calculate_pieces_button.clicked.connect(self.calculate_pieces)
@@ -205,7 +206,7 @@ class CreateTorrentDialog(QDialog):
                 background-color: black;
             }
         """)
-        piece_size_combo.setStyleSheet("""
+        self.piece_size_combo.setStyleSheet("""
             QComboBox {
                 color: white;
                 background-color: black;
@@ -239,7 +240,7 @@ QPushButton:pressed {
         self.setStyleSheet(button_style)
         # Adding widgets to settings layout
         settings_layout.addWidget(piece_size_label, 0, 0)
-        settings_layout.addWidget(piece_size_combo, 0, 1)
+        settings_layout.addWidget(self.piece_size_combo, 0, 1)
         settings_layout.addWidget(calculate_pieces_button, 0, 2)
         settings_layout.addWidget(self.number_of_pieces_label, 0, 3)
         settings_layout.addWidget(private_torrent_checkbox, 1, 0, 1, 3)
@@ -309,10 +310,15 @@ QPushButton:pressed {
                         total_length += os.path.getsize(os.path.join(root, file))
             else:
                 total_length = os.path.getsize(self.file_path.text())
-            num_pieces = total_length // (512 * 1024)
-            num_pieces = num_pieces if total_length % (512 * 1024) == 0 else num_pieces + 1
+            piece_size = self.get_piece_size() or choose_piece_size(total_length)
+            num_pieces = total_length // piece_size
+            num_pieces = num_pieces if total_length % piece_size == 0 else num_pieces + 1
             self.number_of_pieces_label.setText(str(num_pieces))
 
+    def get_piece_size(self) -> int | None:
+        """Return the selected piece size in bytes, None for automatic selection."""
+        return PIECE_SIZE_OPTIONS[self.piece_size_combo.currentText()]
+
     def select_file(self):
         file_dialog = QFileDialog()
         file_path, _ = file_dialog.getOpenFileName(self, "Select File")
@@ -352,10 +358,28 @@ QPushButton:pressed {
             QMessageBox.critical(self, "Error", "The save directory for torrent file does not exist.")
             return
 
+        progress_dialog = QProgressDialog("Hashing pieces...", None, 0, 100, self)
+        progress_dialog.setWindowTitle("Creating Torrent")
+        progress_dialog.setWindowModality(Qt.WindowModality.WindowModal)
+        progress_dialog.setMinimumDuration(0)
+
+        def update_progress(hashed_bytes, total_bytes):
+            progress_dialog.setValue(int(hashed_bytes * 100 / total_bytes) if total_bytes else 100)
+            QApplication.processEvents()
+
+        try:
+            metadata = TorrentUtils.generate_info_dictionary(upload_dir, self.get_piece_size(), update_progress)
+        except OSError as e:
+            QMessageBox.critical(self, "Error", f"Could not read the files to share: {e}")
+            return
+        finally:
+            progress_dialog.close()
+
         self.result = {
             "upload_dir": upload_dir,
             "tracker_url": tracker_url,
             "save_torrent_dir": save_torrent_dir,
+            "metadata": metadata,
         }
         self.done(1)
 
@@ -8,5 +8,16 @@ SAVE_DIR_MAGNET = download_path
 SAVE_DIR = download_path
 TRACKER_URL = 'https://10diembtl.ngrok.app/announce'
 
+PIECE_SIZE_OPTIONS = {
+    "Auto": None,
+    "256 KiB": 256 * 1024,
+    "512 KiB": 512 * 1024,
+    "1 MiB": 1024 * 1024,
+    "2 MiB": 2 * 1024 * 1024,
+    "4 MiB": 4 * 1024 * 1024,
+    "8 MiB": 8 * 1024 * 1024,
+    "16 MiB": 16 * 1024 * 1024,
+}
+
 
 # TRACKER_URL = 'http://10.128.49.47:8000/announce'
@@ -1,8 +1,14 @@
 import hashlib
-from typing import List, Dict
+import math
+import random
+import socket
+import time
+from typing import List, Dict, Set
 from datetime import datetime
 import bencodepy
 
+COMPACT_CACHE_REBUILD_SHARE = 0.02     # Largest share of the time spent repacking a swarm's cached compact peers
+
 
 class Peer:
     def __init__(self, peer_id: str, ip: str, port: int, uploaded: int, downloaded: int, left: int, status: str, info_hash: str):
@@ -16,6 +22,20 @@ class Peer:
         self.last_announce = datetime.now()
         self.info_hash = info_hash
         self.id = f'{peer_id}-{info_hash}'
+        self.pack_compact()
+
+    def pack_compact(self):
+        """Pack the peer's compact form once: 4 or 16 address bytes and 2 port bytes, with its address family."""
+        for family in (socket.AF_INET, socket.AF_INET6):
+            try:
+                self.compact = socket.inet_pton(family, self.ip) + self.port.to_bytes(2, byteorder='big')
+                self.family = family
+                return
+            except (OSError, OverflowError):
+                continue
+        print(f"Invalid address for peer '{self.peer_id}': {self.ip}, {self.port}")
+        self.compact = b''
+        self.family = None
 
     def update_announce(self, uploaded: int, downloaded: int, left: int, status: str):
         """Update peer's stats on each announce."""
@@ -29,36 +49,175 @@ class Peer:
         return f"Peer({self.peer_id}, {self.status}, uploaded={self.uploaded}, downloaded={self.downloaded}, left={self.left})"
 
 
+class PeerIndex:
+    """Peers kept in an array in random order, with each one's position. A new peer swaps places with a
+    random one and a peer is removed by moving the last one into its place, both in O(1), and the order
+    stays a uniformly random permutation.
+    """
+
+    def __init__(self):
+        self.peers: List[Peer] = []
+        self.positions: Dict[str, int] = {}     # Position of each peer ID in peers
+
+    def __len__(self):
+        return len(self.peers)
+
+    def add(self, peer: Peer):
+        position = self.positions.get(peer.peer_id)
+        if position is None:
+            position = random.randrange(len(self.peers) + 1)
+            if position < len(self.peers):
+                other = self.peers[position]
+                self.positions[other.peer_id] = len(self.peers)
+                self.peers.append(other)
+                self.peers[position] = peer
+            else:
+                self.peers.append(peer)
+            self.positions[peer.peer_id] = position
+        else:
+            self.peers[position] = peer
+
+    def remove(self, peer_id: str):
+        position = self.positions.pop(peer_id, None)
+        if position is None:
+            return
+        last = self.peers.pop()
+        if position < len(self.peers):
+            self.peers[position] = last
+            self.positions[last.peer_id] = position
+
+
 class Torrent:
     def __init__(self, info_hash: str):
         self.info_hash = info_hash  # SHA-1 hash of the torrent's info section
-        self.seeders_id_list = []   # List of peer IDs that are seeders
-        self.leechers_id_list = []  # List of peer IDs that are leechers
-        self.peer_list: List[Peer] = []  # List of all peers in the torrent
+        self.seeders = PeerIndex()
+        self.leechers = PeerIndex()
+        self.all_peers = PeerIndex()        # Seeders and leechers in one random order, for peers that download
+        self.peers: Dict[str, Peer] = {}    # All peers of the torrent by peer ID
+        self.version = 0                    # Bumped whenever a peer is added, removed or changes state
+        self.removed_version = 0            # Bumped whenever a listed compact entry may no longer be valid
+        self.completed = 0                  # Peers that went from leeching to seeding, the scrape's downloaded count
+        # (family, seeding) -> (version, removed_version, time the next rebuild is allowed, compact peers)
+        self.compact_cache: Dict[tuple, tuple[int, int, float, List[bytes]]] = {}
+
+    @property
+    def peer_list(self) -> List[Peer]:
+        return list(self.peers.values())
 
     def add_peer(self, peer: Peer):
-        """Add a peer to the torrent, update seeder/leecher lists."""
-        self.peer_list.append(peer)
+        """Add or replace a peer of the torrent, update seeder/leecher indexes."""
+        previous = self.peers.get(peer.peer_id)
+        if previous is not None and previous.compact != peer.compact:
+            self.removed_version += 1       # Its entry with the old address is gone
+        self.peers[peer.peer_id] = peer
+        self.all_peers.add(peer)
+        self.version += 1
 
         if peer.left == 0:
-            self.seeders_id_list.append(peer.peer_id)
+            self.leechers.remove(peer.peer_id)
+            self.seeders.add(peer)
         else:
-            self.leechers_id_list.append(peer.peer_id)
+            self.seeders.remove(peer.peer_id)
+            self.leechers.add(peer)
 
     def remove_peer(self, peer_id: str):
-        """Remove a peer from the torrent, update seeder/leecher lists."""
-        self.peer_list = [peer for peer in self.peer_list if peer.peer_id != peer_id]
-        self.seeders_id_list = [pid for pid in self.seeders_id_list if pid != peer_id]
-        self.leechers_id_list = [pid for pid in self.leechers_id_list if pid != peer_id]
+        """Remove a peer from the torrent, update seeder/leecher indexes."""
+        if self.peers.pop(peer_id, None) is not None:
+            self.version += 1
+            self.removed_version += 1
+        self.all_peers.remove(peer_id)
+        self.seeders.remove(peer_id)
+        self.leechers.remove(peer_id)
+
+    def compact_peers(self, count: int, exclude: bytes, seeding: bool, family) -> bytes:
+        """Up to count compact peers of an address family, picked at random in O(count) from the swarm's cached
+        compact peers: the entries at a random start and a random stride coprime with their number, so they are
+        distinct and two replies are unlikely to have the same peers side by side. The compact entry exclude,
+        the requesting peer, is left out, and the seeders for a peer that is seeding itself.
+        """
+        entries = self.get_compact_entries(family, seeding)
+        n = len(entries)
+        # One more, in case the requesting peer is among them
+        if n > count + 1:
+            start = random.randrange(n)
+            stride = random.randrange(1, n)
+            while math.gcd(stride, n) != 1:
+                stride = random.randrange(1, n)
+            picked = [entries[position % n] for position in range(start, start + (count + 1) * stride, stride)]
+        else:
+            picked = list(entries)
+
+        if exclude in picked:
+            picked.remove(exclude)
+        return b''.join(picked[:count])
+
+    def get_compact_entries(self, family, seeding: bool) -> List[bytes]:
+        """Compact peers of the swarm, in the random order of its indexes, rebuilt once the swarm has changed.
+        Seeders and leechers come from a single index, so any pick of them mixes the two like the swarm does.
+        After a rebuild the next one waits so that at most COMPACT_CACHE_REBUILD_SHARE of the time goes to
+        repacking: a small swarm is always current, a large one that changes all the time is not repacked
+        on every announce. That only delays new peers, a removal is rebuilt at once so that the peers handed
+        out have not left the swarm.
+        """
+        key = (family, seeding)
+        now = time.monotonic()
+        cached = self.compact_cache.get(key)
+        if cached is None or cached[1] != self.removed_version or (cached[0] != self.version and now >= cached[2]):
+            peers = self.leechers.peers if seeding else self.all_peers.peers
+            entries = [peer.compact for peer in peers if peer.family == family]
+            built = time.monotonic()
+            cached = self.compact_cache[key] = (self.version, self.removed_version,
+                                                built + (built - now) / COMPACT_CACHE_REBUILD_SHARE, entries)
+        return cached[3]
 
     def __repr__(self):
-        return f"Torrent({self.info_hash}, seeders={len(self.seeders_id_list)}, leechers={len(self.leechers_id_list)})"
+        return f"Torrent({self.info_hash}, seeders={len(self.seeders)}, leechers={len(self.leechers)})"
+
+
+class ExpiryWheel:
+    """Timing wheel with one-second slots of the peers expiring in them. An announce moves its peer to a later
+    slot in O(1), and a sweep only visits the slots that have passed, so it costs O(expired) however many
+    peers there are.
+    """
+
+    def __init__(self, timeout: int):
+        self.timeout = timeout
+        self.slots: Dict[int, Set[str]] = {}    # Second -> keys of the peers expiring in it
+        self.peer_slots: Dict[str, int] = {}    # Slot of each peer key
+        self.swept = int(time.monotonic())      # Slots before it are swept
+
+    def touch(self, key: str):
+        """(Re)start the timeout of a peer."""
+        self.remove(key)
+        slot = int(time.monotonic()) + self.timeout + 1
+        self.peer_slots[key] = slot
+        self.slots.setdefault(slot, set()).add(key)
+
+    def remove(self, key: str):
+        slot = self.peer_slots.pop(key, None)
+        if slot is not None:
+            keys = self.slots[slot]
+            keys.discard(key)
+            if not keys:
+                del self.slots[slot]
+
+    def expire(self) -> List[str]:
+        """Remove and return the keys of the peers whose timeout has passed."""
+        expired = []
+        now = int(time.monotonic())
+        while self.swept <= now:
+            expired.extend(self.slots.pop(self.swept, ()))
+            self.swept += 1
+        for key in expired:
+            del self.peer_slots[key]
+        return expired
 
 
 class Database:
-    def __init__(self):
+    def __init__(self, peer_timeout: int = 1800):
         self.torrents: Dict[str, Torrent] = {}  # A dictionary of torrents by info_hash
         self.peers: Dict[str, Peer] = {}        # A dictionary of peers by composite key (peer_id + info_hash)
+        self.expiry = ExpiryWheel(peer_timeout)     # Peers are removed peer_timeout seconds after their last announce
 
     def add_torrent(self, torrent: Torrent):
         """Add a new torrent to the database."""
@@ -72,6 +231,7 @@ class Database:
             return
 
         self.peers[peer.id] = peer
+        self.expiry.touch(peer.id)
         torrent = self.torrents[peer.info_hash]
         torrent.add_peer(peer)
         print(f"Peer added to torrent {torrent.info_hash}: {peer}")
@@ -84,21 +244,45 @@ class Database:
 
         if peer_key in self.peers:
             del self.peers[peer_key]
+            self.expiry.remove(peer_key)
             self.torrents[info_hash].remove_peer(peer_id)
             print(f"Peer {peer_id} removed from torrent {info_hash}")
         else:
             print(f"Peer {peer_id} not found in torrent {info_hash}")
 
     def update_peer(self, peer: Peer):
-        """Update an existing peer's data."""
+        """Apply an announce to an existing peer. A peer whose address changes or that moves between the seeders
+        and the leechers is put back in its torrent, which updates the torrent's indexes and counts. A leecher
+        that starts seeding counts as a completed download, however many completed events it sends.
+        """
         peer_key = f"{peer.peer_id}-{peer.info_hash}"
         if peer_key in self.peers:
-            peer = self.peers[peer_key]
-            peer.update_announce(peer.uploaded, peer.downloaded, peer.left, peer.status)
-            print(f"Peer {peer.peer_id} updated: {peer}")
+            stored = self.peers[peer_key]
+            was_seeding = stored.left == 0
+            stored.update_announce(peer.uploaded, peer.downloaded, peer.left, peer.status)
+            if (stored.ip, stored.port) != (peer.ip, peer.port):
+                # Taken out under its old address first, so that its old entry is not handed out any more
+                self.torrents[peer.info_hash].remove_peer(stored.peer_id)
+                stored.ip, stored.port = peer.ip, peer.port
+                stored.pack_compact()
+                self.torrents[peer.info_hash].add_peer(stored)
+            elif (stored.left == 0) != was_seeding:
+                self.torrents[peer.info_hash].add_peer(stored)
+            if not was_seeding and stored.left == 0:
+                self.torrents[peer.info_hash].completed += 1
+            self.expiry.touch(peer_key)
+            print(f"Peer {peer.peer_id} updated: {stored}")
         else:
             print(f"Peer {peer.peer_id} not found!")
 
+    def expire_peers(self) -> int:
+        """Remove the peers that have not announced within the peer timeout. Returns how many were removed."""
+        expired = self.expiry.expire()
+        for key in expired:
+            peer = self.peers.pop(key)
+            self.torrents[peer.info_hash].remove_peer(peer.peer_id)
+        return len(expired)
+
     def get_torrent_peers(self, info_hash: str) -> List[Peer] | None:
         """Retrieve all peers for a specific torrent."""
         if info_hash in self.torrents:
@@ -1,4 +1,7 @@
+import asyncio
 import base64
+from contextlib import asynccontextmanager
+import socket
 import bencodepy
 from fastapi import FastAPI, Query, Request, Response
 from typing import List, Dict
@@ -6,15 +9,43 @@ from fastapi.responses import JSONResponse
 import uvicorn
 
 from database import Database, Torrent, Peer
-from utils import to_compact
+from udp_tracker import UDPTrackerProtocol
 # from test import db
 
-app = FastAPI()
-
-TORRENT_DATABASE = Database()
+INTERVAL = 10
+PEER_EXPIRY_INTERVALS = 3   # A peer is dropped once it has not announced for this many intervals
+REAP_INTERVAL = 5           # Seconds between sweeps for expired peers
+DEFAULT_NUMWANT = 50        # Peers returned by an announce that does not give numwant
+MAX_NUMWANT = 200
+UDP_HOST = "0.0.0.0"
+UDP_PORT = 8000             # UDP tracker (BEP 15), announced as udp://<host>:8000/announce
+
+TORRENT_DATABASE = Database(peer_timeout=PEER_EXPIRY_INTERVALS * INTERVAL)
 # TORRENT_DATABASE = db
 
-INTERVAL = 10
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Serve the UDP tracker and sweep expired peers on the event loop of the HTTP server."""
+    loop = asyncio.get_running_loop()
+    transport, _ = await loop.create_datagram_endpoint(
+        lambda: UDPTrackerProtocol(process_announce, scrape_torrent, INTERVAL), local_addr=(UDP_HOST, UDP_PORT))
+    reaper = asyncio.create_task(reap_peers())
+    yield
+    reaper.cancel()
+    transport.close()
+
+
+async def reap_peers():
+    """Remove the peers that stopped announcing without the stopped event."""
+    while True:
+        await asyncio.sleep(REAP_INTERVAL)
+        expired = TORRENT_DATABASE.expire_peers()
+        if expired:
+            print(f"{expired} peers expired")
+
+
+app = FastAPI(lifespan=lifespan)
 
 
 @app.get("/")
@@ -34,9 +65,28 @@ async def announce(
     compact: int,
     left: int | None = None,
     event: str | None = None,
+    numwant: int | None = None,
 ):
     """Handle GET requests from peers announcing their status to the tracker."""
-    if TORRENT_DATABASE.get_torrent(info_hash) is None:
+    peers, peers6, seeders, leechers = process_announce(info_hash, ip, port, peer_id, uploaded, downloaded, left,
+                                                        event, numwant)
+
+    # Bencoded by hand around the compact peers, the keys in sorted order
+    response = b'd8:completei%de10:incompletei%de8:intervali%de5:peers%d:%s6:peers6%d:%se' % (
+        seeders, leechers, INTERVAL, len(peers), peers, len(peers6), peers6)
+    return Response(content=response, media_type="application/octet-stream")
+
+
+def process_announce(info_hash: str, ip: str, port: int, peer_id: str, uploaded: int, downloaded: int,
+                     left: int | None, event: str | None,
+                     numwant: int | None = None) -> tuple[bytes, bytes, int, int]:
+    """Apply an announce, from the HTTP or the UDP tracker, to the database.
+
+    Returns up to numwant other peers of the torrent, picked at random, compact for IPv4 and for IPv6, and its
+    seeder and leecher counts. A peer that is seeding gets no seeders.
+    """
+    torrent = TORRENT_DATABASE.get_torrent(info_hash)
+    if torrent is None:
         torrent = Torrent(info_hash=info_hash)
         TORRENT_DATABASE.add_torrent(torrent)
 
@@ -51,11 +101,14 @@ async def announce(
         info_hash=info_hash,
     )
 
-    if event == "started":
+    if event == "completed":
+        peer.left = 0
+
+    # A peer that is not in the swarm, as it expired or the tracker restarted, joins again with any announce
+    if event == "started" or (event != "stopped" and peer.id not in TORRENT_DATABASE.peers):
         TORRENT_DATABASE.add_peer(peer)
         print(f"peer {peer_id} has joined the swarm")
     elif event == "completed":
-        peer.left = 0
         TORRENT_DATABASE.update_peer(peer)
         print(f"peer {peer_id} has began seeding")
     elif event == "stopped":
@@ -65,22 +118,48 @@ async def announce(
         TORRENT_DATABASE.update_peer(peer)
         print(f"Peer {peer_id} has updated their status.")
 
-    # Return the list of peers to the requesting peer
-    peer_list = TORRENT_DATABASE.get_torrent_peers(info_hash)
-    peer_list = [p for p in peer_list if p.peer_id != peer_id]
-
-    peers, peers6 = to_compact(peer_list) if compact else peer_list
-
-    response = {
-        b'interval': INTERVAL,
-        b'peers': peers,
-        b'peers6': peers6,
-    }
-
-    response = bencodepy.encode(response)
+    # Return a random sample of the peers to the requesting peer
+    if numwant is None or numwant < 0:
+        numwant = DEFAULT_NUMWANT
+    seeding = left == 0 or event == "completed"
+    numwant = min(numwant, MAX_NUMWANT)
+    exclude = TORRENT_DATABASE.peers.get(peer.id, peer).compact      # As the swarm lists the requesting peer
+    peers = torrent.compact_peers(numwant, exclude, seeding, socket.AF_INET)
+    peers6 = torrent.compact_peers(numwant, exclude, seeding, socket.AF_INET6)
+    return peers, peers6, len(torrent.seeders), len(torrent.leechers)
+
+
+@app.get("/scrape")
+async def scrape(info_hash: List[str] = Query(default=[])):
+    """Handle scrape requests (BEP 48): the seeder, completed and leecher counts of the torrents asked for,
+    or of every torrent when none is given. Unknown torrents are left out.
+    """
+    info_hashes = info_hash or list(TORRENT_DATABASE.torrents)
+    files = {}
+    for info_hash in info_hashes:
+        counts = scrape_torrent(info_hash)
+        if counts is None:
+            continue
+        seeders, completed, leechers = counts
+        try:
+            key = bytes.fromhex(info_hash)
+        except ValueError:
+            key = info_hash.encode()
+        files[key] = {b'complete': seeders, b'downloaded': completed, b'incomplete': leechers}
+
+    response = bencodepy.encode({b'files': files})
     return Response(content=response, media_type="application/octet-stream")
 
 
+def scrape_torrent(info_hash: str) -> tuple[int, int, int] | None:
+    """Seeder, completed and leecher counts of a torrent, kept up to date by its announces, or None if the
+    torrent is unknown.
+    """
+    torrent = TORRENT_DATABASE.get_torrent(info_hash)
+    if torrent is None:
+        return None
+    return len(torrent.seeders), torrent.completed, len(torrent.leechers)
+
 
 @app.get("/peers")
 async def get_peers(info_hash: str):
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Tests import the tracker as uvicorn runs it, from the tracker-server directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,100 @@
+import io
+import math
+import socket
+from contextlib import redirect_stdout
+
+from database import Database, Torrent, Peer
+
+INFO_HASH = 'ab' * 20
+
+
+def make_peer(i, left=100, ip=None):
+    return Peer(f'p{i}', ip or f'10.0.{i >> 8}.{i & 255}', 6881, 0, 0, left, 'started', INFO_HASH)
+
+
+def make_torrent(n) -> Torrent:
+    torrent = Torrent(INFO_HASH)
+    for i in range(n):
+        torrent.add_peer(make_peer(i, left=0 if i % 4 == 0 else 100))
+    return torrent
+
+
+def entries(blob, size=6) -> list[bytes]:
+    return [blob[i:i + size] for i in range(0, len(blob), size)]
+
+
+def freeze_cache(torrent):
+    """Hold off the rebuilds the rate limit allows, as in a large swarm just repacked."""
+    for key, cached in torrent.compact_cache.items():
+        torrent.compact_cache[key] = (*cached[:2], math.inf, cached[3])
+
+
+def test_replies_are_distinct_peers_without_the_requester():
+    torrent = make_torrent(300)
+    exclude = torrent.peers['p7'].compact
+    for _ in range(200):
+        picked = entries(torrent.compact_peers(50, exclude, False, socket.AF_INET))
+        assert len(picked) == 50 == len(set(picked))
+        assert exclude not in picked
+
+
+def test_small_swarm_is_returned_whole():
+    torrent = make_torrent(10)
+    exclude = torrent.peers['p3'].compact
+    picked = entries(torrent.compact_peers(50, exclude, False, socket.AF_INET))
+    assert sorted(picked) == sorted(peer.compact for peer in torrent.peers.values() if peer.compact != exclude)
+    assert torrent.compact_peers(50, b'', False, socket.AF_INET6) == b''
+
+
+def test_seeders_get_only_leechers():
+    torrent = make_torrent(300)
+    leechers = {peer.compact for peer in torrent.peers.values() if peer.left}
+    for _ in range(50):
+        assert set(entries(torrent.compact_peers(50, b'', True, socket.AF_INET))) <= leechers
+
+
+def test_neighbours_change_between_replies():
+    torrent = make_torrent(300)
+    followers = set()
+    for _ in range(200):
+        picked = entries(torrent.compact_peers(50, b'', False, socket.AF_INET))
+        first = torrent.compact_cache[(socket.AF_INET, False)][3][0]
+        if first in picked[:-1]:
+            followers.add(picked[picked.index(first) + 1])
+    # With a fixed window the entry after a peer would always be the same one
+    assert len(followers) > 5
+
+
+def test_removed_peer_is_not_handed_out_before_the_next_rebuild():
+    torrent = make_torrent(300)
+    torrent.compact_peers(50, b'', False, socket.AF_INET)
+    freeze_cache(torrent)
+    removed = torrent.peers['p5'].compact
+    torrent.remove_peer('p5')
+    for _ in range(100):
+        assert removed not in entries(torrent.compact_peers(50, b'', False, socket.AF_INET))
+
+
+def test_new_peer_may_wait_for_the_next_rebuild():
+    torrent = make_torrent(300)
+    torrent.compact_peers(299, b'', False, socket.AF_INET)
+    freeze_cache(torrent)
+    torrent.add_peer(make_peer(400))
+    assert len(entries(torrent.compact_peers(400, b'', False, socket.AF_INET))) == 300
+
+
+def test_old_address_is_not_handed_out_after_a_move():
+    database = Database()
+    with redirect_stdout(io.StringIO()):
+        database.add_torrent(Torrent(INFO_HASH))
+        for i in range(300):
+            database.add_peer(make_peer(i))
+        torrent = database.get_torrent(INFO_HASH)
+        torrent.compact_peers(50, b'', False, socket.AF_INET)
+        freeze_cache(torrent)
+        old = torrent.peers['p5'].compact
+        database.update_peer(make_peer(5, ip='192.168.1.1'))
+
+    assert torrent.peers['p5'].compact != old
+    for _ in range(100):
+        assert old not in entries(torrent.compact_peers(50, b'', False, socket.AF_INET))
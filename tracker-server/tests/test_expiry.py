@@ -0,0 +1,73 @@
+import io
+from contextlib import redirect_stdout
+from types import SimpleNamespace
+
+import pytest
+
+from database import Database, Peer, Torrent
+from database import db
+from database.db import ExpiryWheel
+
+INFO_HASH = 'ab' * 20
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """A monotonic clock the tests move forward."""
+    clock = SimpleNamespace(now=1000.0)
+    monkeypatch.setattr(db, 'time', SimpleNamespace(monotonic=lambda: clock.now))
+    return clock
+
+
+def test_peers_expire_after_the_timeout(clock):
+    wheel = ExpiryWheel(30)
+    wheel.touch('a')
+    clock.now += 10
+    wheel.touch('b')
+    clock.now += 20
+    assert wheel.expire() == []
+    clock.now += 1.5
+    assert wheel.expire() == ['a']
+    clock.now += 10
+    assert wheel.expire() == ['b']
+    assert wheel.slots == {} and wheel.peer_slots == {}
+
+
+def test_touch_restarts_and_remove_cancels_the_timeout(clock):
+    wheel = ExpiryWheel(30)
+    wheel.touch('a')
+    wheel.touch('b')
+    clock.now += 20
+    wheel.touch('a')
+    wheel.remove('b')
+    wheel.remove('unknown')
+    clock.now += 20
+    assert wheel.expire() == []
+    clock.now += 20
+    assert wheel.expire() == ['a']
+
+
+def test_sweep_after_a_long_pause(clock):
+    wheel = ExpiryWheel(5)
+    for i in range(10):
+        wheel.touch(f'p{i}')
+        clock.now += 1
+    clock.now += 100
+    assert sorted(wheel.expire()) == sorted(f'p{i}' for i in range(10))
+    assert wheel.expire() == []
+
+
+def test_database_removes_expired_peers(clock):
+    database = Database(peer_timeout=30)
+    with redirect_stdout(io.StringIO()):
+        database.add_torrent(Torrent(INFO_HASH))
+        for i in range(4):
+            database.add_peer(Peer(f'p{i}', '10.0.0.1', 6881 + i, 0, 0, 100 - i % 2 * 100, 'started', INFO_HASH))
+        clock.now += 20
+        database.update_peer(Peer('p0', '10.0.0.1', 6881, 0, 0, 100, None, INFO_HASH))
+        clock.now += 15
+        assert database.expire_peers() == 3
+
+    torrent = database.get_torrent(INFO_HASH)
+    assert list(torrent.peers) == ['p0'] and list(database.peers) == [f'p0-{INFO_HASH}']
+    assert (len(torrent.seeders), len(torrent.leechers)) == (0, 1)
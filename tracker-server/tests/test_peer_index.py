@@ -0,0 +1,69 @@
+import random
+from collections import Counter
+
+from database import Peer, Torrent
+from database.db import PeerIndex
+
+INFO_HASH = 'ab' * 20
+
+
+def make_peer(i, left=100):
+    return Peer(f'p{i}', f'10.0.{i >> 8}.{i & 255}', 6881, 0, 0, left, 'started', INFO_HASH)
+
+
+def check(index: PeerIndex, expected: set):
+    assert {peer.peer_id for peer in index.peers} == expected
+    assert len(index) == len(expected) == len(index.positions)
+    for peer_id, position in index.positions.items():
+        assert index.peers[position].peer_id == peer_id
+
+
+def test_add_and_remove_keep_positions():
+    index, expected = PeerIndex(), set()
+    rng = random.Random(0)
+    for _ in range(2000):
+        i = rng.randrange(100)
+        if rng.random() < 0.6:
+            index.add(make_peer(i))
+            expected.add(f'p{i}')
+        else:
+            index.remove(f'p{i}')
+            expected.discard(f'p{i}')
+        check(index, expected)
+
+
+def test_replacing_a_peer_keeps_its_place():
+    index = PeerIndex()
+    for i in range(10):
+        index.add(make_peer(i))
+    position = index.positions['p4']
+    replacement = make_peer(4, left=0)
+    index.add(replacement)
+    assert index.peers[position] is replacement
+    check(index, {f'p{i}' for i in range(10)})
+
+
+def test_order_is_random():
+    first = Counter()
+    for _ in range(3000):
+        index = PeerIndex()
+        for i in range(3):
+            index.add(make_peer(i))
+        first[index.peers[0].peer_id] += 1
+    # Each peer is first in about a third of the orders
+    assert all(800 < first[f'p{i}'] < 1200 for i in range(3))
+
+
+def test_torrent_indexes_follow_the_peer_state():
+    torrent = Torrent(INFO_HASH)
+    for i in range(20):
+        torrent.add_peer(make_peer(i, left=0 if i < 5 else 100))
+    torrent.add_peer(make_peer(7, left=0))       # Starts seeding
+    torrent.add_peer(make_peer(2, left=100))     # Leeches again
+    torrent.remove_peer('p3')
+    torrent.remove_peer('p3')
+
+    seeders = {'p0', 'p1', 'p4', 'p7'}
+    check(torrent.seeders, seeders)
+    check(torrent.leechers, {f'p{i}' for i in range(20)} - seeders - {'p3'})
+    check(torrent.all_peers, {f'p{i}' for i in range(20)} - {'p3'})
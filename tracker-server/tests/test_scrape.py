@@ -0,0 +1,40 @@
+import pytest
+
+import main
+from database import Database
+
+INFO_HASH = 'ab' * 20
+
+
+@pytest.fixture(autouse=True)
+def database(monkeypatch):
+    monkeypatch.setattr(main, 'TORRENT_DATABASE', Database())
+
+
+def announce(i, left, event=None, ip='10.0.0.1'):
+    main.process_announce(INFO_HASH, ip, 6881 + i, f'p{i}', 0, 0, left, event)
+
+
+def test_completed_counts_leechers_that_start_seeding():
+    announce(0, 0, 'started')           # Joins as a seeder: nothing was downloaded
+    announce(1, 100, 'started')
+    announce(2, 100, 'started')
+    assert main.scrape_torrent(INFO_HASH) == (1, 0, 2)
+
+    announce(1, 0, 'completed')
+    announce(1, 0, 'completed')         # Repeated
+    announce(1, 0)
+    announce(0, 0, 'completed')         # Already seeding
+    announce(3, 0, 'completed')         # Not in the swarm
+    announce(2, 0)                      # Seeding without the event
+    assert main.scrape_torrent(INFO_HASH) == (4, 2, 0)
+
+
+def test_completed_after_a_move_counts_once():
+    announce(1, 100, 'started')
+    announce(1, 0, 'completed', ip='10.0.0.2')
+    assert main.scrape_torrent(INFO_HASH) == (1, 1, 0)
+
+
+def test_scrape_of_an_unknown_torrent():
+    assert main.scrape_torrent('cd' * 20) is None
@@ -0,0 +1,116 @@
+import struct
+from types import SimpleNamespace
+
+import pytest
+
+import udp_tracker
+from udp_tracker import ConnectionIds, UDPTrackerProtocol, PROTOCOL_ID, ACTION_CONNECT, ACTION_ANNOUNCE, \
+    ACTION_SCRAPE, ACTION_ERROR, ANNOUNCE_REQUEST, CONNECTION_ID_LIFETIME
+
+ADDR = ('10.0.0.1', 6881)
+INFO_HASH = bytes.fromhex('ab' * 20)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = SimpleNamespace(now=CONNECTION_ID_LIFETIME * 1000.0)
+    monkeypatch.setattr(udp_tracker, 'time', SimpleNamespace(time=lambda: clock.now))
+    return clock
+
+
+class Transport:
+    def __init__(self):
+        self.sent = []
+
+    def sendto(self, data, addr):
+        self.sent.append((data, addr))
+
+
+@pytest.fixture
+def tracker():
+    announces = []
+
+    def announce_handler(**fields):
+        announces.append(fields)
+        return b'\x0a\0\0\x02\x1a\xe1', b'', 3, 5
+
+    def scrape_handler(info_hash):
+        return (3, 7, 5) if info_hash == INFO_HASH.hex() else None
+
+    protocol = UDPTrackerProtocol(announce_handler, scrape_handler, interval=10)
+    protocol.connection_made(Transport())
+    protocol.announces = announces
+    return protocol
+
+
+def request(protocol, data, addr=ADDR) -> bytes:
+    protocol.datagram_received(data, addr)
+    response, to = protocol.transport.sent.pop()
+    assert to == addr
+    return response
+
+
+def connect(protocol, addr=ADDR) -> int:
+    action, transaction_id, connection_id = struct.unpack(
+        "!IIQ", request(protocol, struct.pack("!QII", PROTOCOL_ID, ACTION_CONNECT, 17), addr))
+    assert (action, transaction_id) == (ACTION_CONNECT, 17)
+    return connection_id
+
+
+def announce_request(connection_id, event=2) -> bytes:
+    return struct.pack("!QII", connection_id, ACTION_ANNOUNCE, 5) + ANNOUNCE_REQUEST.pack(
+        INFO_HASH, b'-PC0001-' + b'x' * 12, 0, 100, 0, event, b'\0\0\0\0', 0, 50, 6882)
+
+
+def test_connection_ids_expire_after_two_lifetimes(clock):
+    ids = ConnectionIds()
+    connection_id = ids.issue(ADDR)
+    assert ids.is_valid(connection_id, ('10.0.0.1', 9999))      # Any source port
+    assert not ids.is_valid(connection_id, ('10.0.0.2', 6881))
+    clock.now += CONNECTION_ID_LIFETIME
+    assert ids.is_valid(connection_id, ADDR)
+    clock.now += CONNECTION_ID_LIFETIME
+    assert not ids.is_valid(connection_id, ADDR)
+    assert not ConnectionIds().is_valid(ids.issue(ADDR), ADDR)     # Another secret
+
+
+def test_announce_with_a_connection_id(tracker, clock):
+    connection_id = connect(tracker)
+    response = request(tracker, announce_request(connection_id))
+    assert struct.unpack_from("!IIIII", response) == (ACTION_ANNOUNCE, 5, 10, 5, 3)
+    assert response[20:] == b'\x0a\0\0\x02\x1a\xe1'
+    fields = tracker.announces.pop()
+    assert (fields['info_hash'], fields['ip'], fields['port'], fields['left'], fields['event']) == \
+        (INFO_HASH.hex(), ADDR[0], 6882, 100, 'started')
+
+
+@pytest.mark.parametrize('connection_id', [None, 'stale', 'other-address'])
+def test_announce_with_an_invalid_connection_id(tracker, clock, connection_id):
+    if connection_id is None:
+        connection_id = 12345
+    elif connection_id == 'stale':
+        connection_id = connect(tracker)
+        clock.now += 2 * CONNECTION_ID_LIFETIME
+    else:
+        connection_id = connect(tracker, ('10.0.0.2', 6881))
+    response = request(tracker, announce_request(connection_id))
+    assert struct.unpack_from("!II", response) == (ACTION_ERROR, 5)
+    assert tracker.announces == []
+
+
+def test_connect_needs_the_protocol_id(tracker):
+    tracker.datagram_received(struct.pack("!QII", 1234, ACTION_CONNECT, 17), ADDR)
+    tracker.datagram_received(b'\0' * 10, ADDR)
+    assert tracker.transport.sent == []
+
+
+def test_invalid_event_is_an_error(tracker, clock):
+    response = request(tracker, announce_request(connect(tracker), event=9))
+    assert struct.unpack_from("!II", response) == (ACTION_ERROR, 5)
+    assert tracker.announces == []
+
+
+def test_scrape(tracker, clock):
+    data = struct.pack("!QII", connect(tracker), ACTION_SCRAPE, 8) + INFO_HASH + b'\xcd' * 20
+    response = request(tracker, data)
+    assert struct.unpack("!II6I", response) == (ACTION_SCRAPE, 8, 3, 7, 5, 0, 0, 0)
@@ -0,0 +1,104 @@
+import asyncio
+import hashlib
+import os
+import socket
+import struct
+import time
+from typing import Callable
+
+PROTOCOL_ID = 0x41727101980
+ACTION_CONNECT = 0
+ACTION_ANNOUNCE = 1
+ACTION_SCRAPE = 2
+ACTION_ERROR = 3
+EVENTS = {0: None, 1: "completed", 2: "started", 3: "stopped"}
+
+CONNECTION_ID_LIFETIME = 60     # Seconds, a connection id is accepted for one to two lifetimes
+ANNOUNCE_REQUEST = struct.Struct("!20s20sqqqI4sIiH")    # Announce request after the 16-byte header
+ANNOUNCE_LENGTH = 16 + ANNOUNCE_REQUEST.size
+MAX_SCRAPE_HASHES = 74          # Info hashes in a scrape request, as many as fit a response in one packet
+
+
+class ConnectionIds:
+    """Connection ids derived from the client's IP address and the current time bucket with a keyed hash,
+    so they are validated without keeping any state per client. The source port is left out as clients may
+    announce from a new socket with the same connection id.
+    """
+
+    def __init__(self):
+        self.secret = os.urandom(16)
+
+    def make(self, addr, bucket: int) -> int:
+        digest = hashlib.blake2b(f"{addr[0]}:{bucket}".encode(), key=self.secret, digest_size=8)
+        return int.from_bytes(digest.digest(), "big")
+
+    def issue(self, addr) -> int:
+        return self.make(addr, int(time.time() // CONNECTION_ID_LIFETIME))
+
+    def is_valid(self, connection_id: int, addr) -> bool:
+        bucket = int(time.time() // CONNECTION_ID_LIFETIME)
+        return connection_id == self.make(addr, bucket) or connection_id == self.make(addr, bucket - 1)
+
+
+class UDPTrackerProtocol(asyncio.DatagramProtocol):
+    """UDP tracker protocol (BEP 15): connect, announce and scrape.
+
+    announce_handler takes the announce fields as the HTTP endpoint receives them and returns compact IPv4
+    and IPv6 peers of the swarm and its seeder and leecher counts. The peers of the address family the
+    request came in on are returned. scrape_handler takes a hex info_hash and returns the seeder, completed
+    and leecher counts of the torrent, or None if it is unknown.
+    """
+
+    def __init__(self, announce_handler: Callable, scrape_handler: Callable, interval: int):
+        self.announce_handler = announce_handler
+        self.scrape_handler = scrape_handler
+        self.interval = interval
+        self.connection_ids = ConnectionIds()
+        self.transport: asyncio.DatagramTransport | None = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, addr):
+        if len(data) < 16:
+            return
+        connection_id, action, transaction_id = struct.unpack_from("!QII", data)
+        try:
+            if action == ACTION_CONNECT:
+                if connection_id == PROTOCOL_ID:
+                    self.transport.sendto(struct.pack("!IIQ", ACTION_CONNECT, transaction_id,
+                                                      self.connection_ids.issue(addr)), addr)
+            elif not self.connection_ids.is_valid(connection_id, addr):
+                self.send_error(transaction_id, "Invalid connection id", addr)
+            elif action == ACTION_ANNOUNCE and len(data) >= ANNOUNCE_LENGTH:
+                self.transport.sendto(self.announce(data, transaction_id, addr), addr)
+            elif action == ACTION_SCRAPE:
+                self.transport.sendto(self.scrape(data, transaction_id), addr)
+            else:
+                self.send_error(transaction_id, "Unsupported action", addr)
+        except ValueError as e:
+            self.send_error(transaction_id, str(e), addr)
+
+    def announce(self, data: bytes, transaction_id: int, addr) -> bytes:
+        info_hash, peer_id, downloaded, left, uploaded, event, ip, _, numwant, port = \
+            ANNOUNCE_REQUEST.unpack_from(data, 16)
+        if event not in EVENTS:
+            raise ValueError("Invalid event")
+        # An ip of 0 means the address the request came from
+        ip = socket.inet_ntoa(ip) if ip != b"\0\0\0\0" else addr[0]
+        peers, peers6, seeders, leechers = self.announce_handler(
+            info_hash=info_hash.hex(), ip=ip, port=port, peer_id=peer_id.decode("latin-1"),
+            uploaded=uploaded, downloaded=downloaded, left=left, event=EVENTS[event], numwant=numwant)
+        if len(addr) == 4:          # Request over IPv6
+            peers = peers6
+        return struct.pack("!IIIII", ACTION_ANNOUNCE, transaction_id, self.interval, leechers, seeders) + peers
+
+    def scrape(self, data: bytes, transaction_id: int) -> bytes:
+        response = [struct.pack("!II", ACTION_SCRAPE, transaction_id)]
+        for offset in range(16, min(len(data), 16 + 20 * MAX_SCRAPE_HASHES) - 19, 20):
+            counts = self.scrape_handler(data[offset:offset + 20].hex())
+            response.append(struct.pack("!III", *(counts or (0, 0, 0))))
+        return b"".join(response)
+
+    def send_error(self, transaction_id: int, message: str, addr):
+        self.transport.sendto(struct.pack("!II", ACTION_ERROR, transaction_id) + message.encode(), addr)
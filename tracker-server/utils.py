@@ -30,29 +30,10 @@ def is_ipv6(ip: str) -> bool:
 
 def to_compact(peer_list: List[Peer]) -> Tuple[bytes, bytes]:
     """
-    Convert a list of PeerInfo objects to compact binary formats for IPv4 and IPv6.
+    Join the compact forms of the peers, packed when they were announced, for IPv4 and IPv6.
     """
-    def get_validated_bytes_ip(ip: str, family) -> bytes:
-        try:
-            return socket.inet_pton(family, ip)
-        except socket.error as e:
-            print(f"Invalid IP address '{ip}': {e}")
-            return b''
-
-    compact_ipv4 = b''
-    compact_ipv6 = b''
-
-    for peer in peer_list:
-        ip = peer.ip
-        port_bytes = peer.port.to_bytes(2, byteorder='big')
-
-        if is_ipv4(ip):
-            compact_ipv4 += get_validated_bytes_ip(ip, socket.AF_INET) + port_bytes
-        elif is_ipv6(ip):
-            compact_ipv6 += get_validated_bytes_ip(ip, socket.AF_INET6) + port_bytes
-        else:
-            print(f"Invalid IP address format for peer '{peer.peer_id}': {ip}")
-
+    compact_ipv4 = b''.join([peer.compact for peer in peer_list if peer.family == socket.AF_INET])
+    compact_ipv6 = b''.join([peer.compact for peer in peer_list if peer.family == socket.AF_INET6])
     return compact_ipv4, compact_ipv6
 
 